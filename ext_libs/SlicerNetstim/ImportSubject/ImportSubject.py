@@ -213,13 +213,10 @@ class ImportSubjectLogic(ScriptedLoadableModuleLogic):
 
 
   def saveAffineComponent(self,transformNode):
-    # split transforms and get new nodes
-    newNodeNames = TransformsUtil.TransformsUtilLogic().splitAndGetNodeNames(transformNode)
-    # save affine
-    slicer.util.saveNode(transformNode, os.path.join(os.path.dirname(transformNode.GetStorageNode().GetFileName()),'glanat0GenericAffine_backup.mat'))
-    # join again and delete created node
-    transformNode.HardenTransform()
-    slicer.mrmlScene.RemoveNode(slicer.util.getNode(newNodeNames[0]))
+    # save the first layer (affine) from a temporary node
+    affineNode = TransformsUtil.TransformsUtilLogic().getLayers(transformNode)[-1].createNode()
+    slicer.util.saveNode(affineNode, os.path.join(os.path.dirname(transformNode.GetStorageNode().GetFileName()),'glanat0GenericAffine_backup.mat'))
+    slicer.mrmlScene.RemoveNode(affineNode)
     
 
   def updateTranform(self, directory, antsApplyTransformsPath=None):
@@ -0,0 +1,85 @@
+import qt
+import threading
+import queue
+import logging
+
+
+class ComputeWorker():
+  """
+  Runs effect computations on a background thread so that the interactor only
+  records the strokes. Jobs are run one at a time in the order they were
+  submitted. The queue is bounded: submit blocks when maxQueueSize jobs are
+  waiting. Job callbacks are run on the main thread from a QTimer, so they can
+  safely touch MRML nodes and views.
+  """
+
+  maxQueueSize = 16
+  pollInterval = 10 # ms
+
+  def __init__(self):
+    self.jobs = queue.Queue(self.maxQueueSize)
+    self.completedLock = threading.Lock()
+    self.completed = []
+    self.timer = qt.QTimer()
+    self.timer.setInterval(self.pollInterval)
+    self.timer.connect('timeout()', self.processCompleted)
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, function, *args, onDone=None, onError=None):
+    """
+    Queue function(*args). onDone() or onError(exception) is called on the main
+    thread once it has run.
+    """
+    self.jobs.put((function, args, onDone, onError))
+    if not self.timer.isActive():
+      self.timer.start()
+
+  def run(self):
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        self.jobs.task_done()
+        return
+      function, args, onDone, onError = job
+      try:
+        function(*args)
+        result = (onDone, None)
+      except Exception as e:
+        result = (onError, e)
+      with self.completedLock:
+        self.completed.append(result)
+      self.jobs.task_done()
+
+  def wait(self):
+    # block until all submitted jobs have run. callbacks are left to the timer
+    self.jobs.join()
+
+  def processCompleted(self):
+    with self.completedLock:
+      completed, self.completed = self.completed, []
+    previousCallback = None
+    for callback, error in completed:
+      if error is not None:
+        if callback is None:
+          logError(error)
+        else:
+          callback(error)
+      elif callback is not None and callback != previousCallback:
+        # consecutive repeated callbacks (i.e. view updates) are run once
+        callback()
+      previousCallback = callback
+    if not completed and not self.jobs.unfinished_tasks:
+      self.timer.stop()
+
+  def stop(self):
+    # finish queued jobs and end the thread
+    self.timer.stop()
+    self.jobs.put(None)
+    self.thread.join()
+
+
+def logError(error):
+  # exception of a job, with the traceback from the worker thread
+  logging.error('Warp effect computation failed', exc_info=(type(error), error, error.__traceback__))
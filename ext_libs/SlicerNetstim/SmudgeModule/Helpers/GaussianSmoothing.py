@@ -0,0 +1,79 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from scipy import ndimage
+from scipy import fft
+
+
+# number of threads used to filter
+maxThreads = os.cpu_count() or 1
+# kernels with more taps are applied in the frequency domain
+maxDirectKernelSize = 65
+# target voxels per slab sent to a thread
+slabVoxels = 2 ** 21
+
+
+def gaussianKernel(sigma, truncate=4.0):
+  # same weights as ndimage.gaussian_filter1d
+  radius = int(truncate * float(sigma) + 0.5)
+  x = np.arange(-radius, radius + 1)
+  kernel = np.exp(-0.5 / float(sigma) ** 2 * x ** 2)
+  return kernel / kernel.sum()
+
+
+def smoothDisplacementInPlace(array, sigma, truncate=4.0):
+  """
+  Gaussian smoothing of each component of a (K,J,I,3) displacement array, in
+  place. Same result as ndimage.gaussian_filter of each component (reflect
+  mode). The filter is separable: each axis is filtered in turn, splitting the
+  components in slabs along another axis that are filtered in parallel.
+  """
+  if sigma <= 0:
+    return array
+  kernel = gaussianKernel(sigma, truncate)
+  components = [array[...,i] for i in range(array.shape[3])] if array.ndim == 4 else [array]
+  with ThreadPoolExecutor(maxThreads) as executor:
+    for axis in range(3):
+      jobs = [(component, axis, slab) for component in components for slab in getSlabs(component.shape, axis)]
+      list(executor.map(lambda job: filterAxis(job[0][job[2]], kernel, job[1]), jobs))
+  return array
+
+
+def getSlabs(shape, axis):
+  # split along an axis other than the filtered one. slabs need no overlap
+  splitAxis = 1 if axis == 0 else 0
+  n = shape[splitAxis]
+  slabSize = max(1, int(slabVoxels // max(1, np.prod(shape) // n)))
+  slabs = []
+  for start in range(0, n, slabSize):
+    slab = [slice(None)] * len(shape)
+    slab[splitAxis] = slice(start, min(start + slabSize, n))
+    slabs.append(tuple(slab))
+  return slabs
+
+
+def filterAxis(data, kernel, axis):
+  # filter data along axis, writing the result in data
+  if data.shape[axis] == 0:
+    return
+  if len(kernel) <= maxDirectKernelSize:
+    ndimage.correlate1d(data, kernel, axis=axis, output=data, mode='reflect')
+  else:
+    filterAxisFFT(data, kernel, axis)
+
+
+def filterAxisFFT(data, kernel, axis):
+  # same as the direct correlation: reflect padding and linear convolution through the fft
+  radius = len(kernel) // 2
+  n = data.shape[axis]
+  padding = [(0,0)] * data.ndim
+  padding[axis] = (radius, radius)
+  padded = np.pad(data, padding, mode='symmetric')
+  length = fft.next_fast_len(padded.shape[axis] + 2 * radius, real=True)
+  kernelShape = [1] * data.ndim
+  kernelShape[axis] = -1
+  spectrum = fft.rfft(padded, length, axis=axis)
+  spectrum *= fft.rfft(kernel, length).reshape(kernelShape)
+  result = fft.irfft(spectrum, length, axis=axis)
+  data[...] = np.take(result, np.arange(2 * radius, 2 * radius + n), axis=axis)
@@ -0,0 +1,254 @@
+import slicer, vtk
+import numpy as np
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import TransformsUtil
+from . import GaussianSmoothing
+
+
+class OutOfGridError(ValueError):
+  pass
+
+
+class TiledDisplacementGrid():
+  """
+  Displacement grid defined over a (large) grid but only allocated where it is
+  written: tiles of tileSize^3 voxels kept in a dict, allocated on first
+  write, so that memory scales with the edited volume and not the grid size.
+  transformNode only holds the display region (setDisplayRegion, i.e. a slab
+  around the slice being edited, padded with zeros) as a dense grid. Its array is updated on the
+  main thread (updateDisplay) from copies of the written regions queued by
+  add, so that views never render a half written region.
+  The tiles are composed into the warp by chunks (getBoxLayers), only where
+  they move points.
+  Indexes are given in array order (k,j,i) relative to the whole grid.
+  """
+
+  tileSize = 16
+  chunkTiles = 4 # tiles per side of the chunks composed at once
+  interpolationReach = 2 # voxels (cubic)
+  displayMargin = 4 # voxels around the slice plane
+
+  def __init__(self, size, origin, spacing):
+    self.size = [int(s) for s in size]
+    self.origin = [float(o) for o in origin]
+    self.spacing = [float(s) for s in spacing]
+    self.shape = tuple(self.size[::-1])
+    self.tiles = {} # (tk,tj,ti): (n,n,n,3) array
+    self.displayIndex = None
+    self.displayArray = None
+    self.displayUpdates = [] # (start, block) written by the worker
+    self.displayLock = threading.Lock()
+    self.addBuffer = np.empty((0,0,0,3), dtype=np.float32) # scratch of add, grown to the largest box
+    # single voxel until a display region is set
+    self.transformNode = TransformsUtil.TransformsUtilLogic().emptyGridTransform([1,1,1], self.origin, self.spacing)
+    self.RASToIJK = vtk.vtkMatrix4x4()
+    for i in range(3):
+      self.RASToIJK.SetElement(i, i, self.spacing[i])
+      self.RASToIJK.SetElement(i, 3, self.origin[i])
+    self.RASToIJK.Invert()
+
+  def getBoxOrigin(self, start):
+    # RAS of the voxel start (k,j,i)
+    return [o + a * sp for o,a,sp in zip(self.origin, start[::-1], self.spacing)]
+
+  def checkIndex(self, index):
+    # raises OutOfGridError if index is out of the grid
+    if any(s.start < 0 for s in index) or any(s.stop > n for s,n in zip(index, self.shape)):
+      raise OutOfGridError('index out of grid bounds')
+
+  def getTileIndexes(self, start, stop, tileSize = None):
+    # (key, index) of the tiles (of tileSize) touching the box [start, stop)
+    n = tileSize or self.tileSize
+    ranges = [range(a // n, (b - 1) // n + 1) for a,b in zip(start, stop)]
+    for key in itertools.product(*ranges):
+      yield key, tuple(slice(t * n, min((t + 1) * n, s)) for t,s in zip(key, self.shape))
+
+  def getIntersection(self, start, stop, tileIndex):
+    # box [start, stop) intersected with tileIndex, relative to the box and to the tile
+    box = [(max(a, t.start), min(b, t.stop)) for a,b,t in zip(start, stop, tileIndex)]
+    return tuple(slice(a - s, b - s) for (a,b),s in zip(box, start)), tuple(slice(a - t.start, b - t.start) for (a,b),t in zip(box, tileIndex))
+
+  def add(self, index, weight, displacement):
+    # add weight * displacement to the box index, allocating its tiles, and queue the display update (worker thread)
+    self.checkIndex(index)
+    start, stop = [s.start for s in index], [s.stop for s in index]
+    displacement = np.array(displacement, dtype=np.float32)
+    # product in the scratch buffer (add runs in the single worker thread), added to the tiles in place.
+    # no allocation per event once the tiles exist
+    shape = tuple(b - a for a,b in zip(start, stop))
+    if any(n > m for n,m in zip(shape, self.addBuffer.shape)):
+      self.addBuffer = np.empty(tuple(max(n, m) for n,m in zip(shape, self.addBuffer.shape)) + (3,), dtype=np.float32)
+    product = self.addBuffer[tuple(slice(0, n) for n in shape)]
+    for c in range(3):
+      # by component: faster than broadcasting the displacement
+      np.multiply(weight, displacement[c], out=product[...,c])
+    for key, tileIndex in self.getTileIndexes(start, stop):
+      tile = self.tiles.get(key)
+      if tile is None:
+        tile = self.tiles[key] = np.zeros(tuple(t.stop - t.start for t in tileIndex) + (3,), dtype=np.float32)
+      weightBox, tileBox = self.getIntersection(start, stop, tileIndex)
+      tile[tileBox] += product[weightBox]
+    self.queueDisplayUpdate(start, stop)
+
+  def getBlock(self, start, stop):
+    # dense copy of the box [start, stop), zeros where not allocated
+    block = np.zeros(tuple(b - a for a,b in zip(start, stop)) + (3,), dtype=np.float32)
+    for key, tileIndex in self.getTileIndexes(start, stop):
+      tile = self.tiles.get(key)
+      if tile is not None:
+        blockBox, tileBox = self.getIntersection(start, stop, tileIndex)
+        block[blockBox] = tile[tileBox]
+    return block
+
+  def setBlock(self, start, block):
+    # write the dense block at start. tiles left at zero are released
+    stop = [a + n for a,n in zip(start, block.shape[:3])]
+    for key, tileIndex in self.getTileIndexes(start, stop):
+      blockBox, tileBox = self.getIntersection(start, stop, tileIndex)
+      values = block[blockBox]
+      tile = self.tiles.get(key)
+      if tile is None:
+        if not values.any():
+          continue
+        tile = self.tiles[key] = np.zeros(tuple(t.stop - t.start for t in tileIndex) + (3,), dtype=np.float32)
+      tile[tileBox] = values
+      if not tile.any():
+        del self.tiles[key]
+
+  def smooth(self, sigma, truncate=4.0):
+    """
+    Gaussian smoothing of the tiles, same as GaussianSmoothing.smoothDisplacementInPlace
+    of the whole grid. Each axis is filtered in turn along the lines of tiles
+    holding data, extended by the kernel radius, in a thread pool.
+    """
+    if sigma <= 0:
+      return
+    kernel = GaussianSmoothing.gaussianKernel(sigma, truncate)
+    radius = len(kernel) // 2
+    n = self.tileSize
+
+    def filterLine(line):
+      axis, key, positions = line
+      start = [k * n for k in key]
+      stop = [min((k + 1) * n, s) for k,s in zip(key, self.shape)]
+      # zeros around the line are included up to the kernel radius. reflected at the grid sides
+      start[axis] = max(min(positions) * n - radius, 0)
+      stop[axis] = min((max(positions) + 1) * n + radius, self.shape[axis])
+      block = self.getBlock(start, stop)
+      for i in range(3):
+        GaussianSmoothing.filterAxis(block[...,i], kernel, axis)
+      self.setBlock(start, block)
+
+    with ThreadPoolExecutor(GaussianSmoothing.maxThreads) as executor:
+      for axis in range(3):
+        # tiles on the same line along axis. lines don't share tiles
+        lines = {}
+        for key in list(self.tiles):
+          lines.setdefault(key[:axis] + (0,) + key[axis+1:], []).append(key[axis])
+        list(executor.map(filterLine, [(axis, key, positions) for key, positions in lines.items()]))
+
+  def getBoxLayers(self):
+    """
+    (lower, upper, layers) boxes for WarpUndoStack.commitBoxes. The grid is
+    split in chunks of chunkTiles^3 tiles. The box of a chunk bounds the
+    allocated tiles in it, expanded by the interpolation reach, and its layer
+    is a grid with the displacement in the box and as much around, so that it
+    equals the whole grid in the box. Outside of the boxes the grid is the
+    identity.
+    """
+    logic = TransformsUtil.TransformsUtilLogic()
+    reach = self.interpolationReach
+    n = self.tileSize
+    boxes = {} # chunk key: (start, stop)
+    for key in self.tiles:
+      start = [max(k * n - reach, 0) for k in key]
+      stop = [min((k + 1) * n + reach, s) for k,s in zip(key, self.shape)]
+      for chunkKey, chunkIndex in self.getTileIndexes(start, stop, n * self.chunkTiles):
+        box = [(max(a, c.start), min(b, c.stop)) for a,b,c in zip(start, stop, chunkIndex)]
+        if chunkKey in boxes:
+          box = [(min(a, c), max(b, d)) for (a,b),c,d in zip(box, *boxes[chunkKey])]
+        boxes[chunkKey] = ([a for a,b in box], [b for a,b in box])
+    boxLayers = []
+    for start, stop in boxes.values():
+      blockStart = [max(a - reach, 0) for a in start]
+      blockStop = [min(b + reach, s) for b,s in zip(stop, self.shape)]
+      block = self.getBlock(blockStart, blockStop)
+      if not block.any():
+        continue
+      size, origin = block.shape[2::-1], self.getBoxOrigin(blockStart)
+      layer = logic.createGridTransform(size, origin, self.spacing)
+      logic.getGridLayerArray(layer, size, origin, self.spacing)[:] = block
+      boxLayers.append((self.getBoxOrigin(start), self.getBoxOrigin(stop), [layer]))
+    return boxLayers
+
+  def getPlaneBox(self, point, normal):
+    # box (start, stop in k,j,i) around the intersection of the RAS plane with the grid, None if it misses the grid
+    corners = np.array(list(itertools.product(*[[0, s - 1] for s in self.size])), dtype=float) # i,j,k
+    distance = corners.dot(np.array(normal) * self.spacing) - np.dot(normal, np.array(point) - self.origin)
+    points = [corners[distance == 0]]
+    for a, b in itertools.combinations(range(len(corners)), 2):
+      if np.count_nonzero(corners[a] != corners[b]) == 1 and distance[a] * distance[b] < 0:
+        points.append(corners[a] + (corners[b] - corners[a]) * distance[a] / (distance[a] - distance[b]))
+    points = np.vstack(points)
+    if not len(points):
+      return None
+    start = np.maximum(np.floor(points.min(axis=0)).astype(int) - self.displayMargin, 0)
+    stop = np.minimum(np.ceil(points.max(axis=0)).astype(int) + self.displayMargin + 1, self.size)
+    return [int(a) for a in start[::-1]], [int(b) for b in stop[::-1]]
+
+  def setDisplayRegion(self, box):
+    # display grid over box (start, stop), filled from the tiles. main thread, while the worker is idle
+    with self.displayLock:
+      self.displayUpdates = []
+    logic = TransformsUtil.TransformsUtilLogic()
+    if box is None:
+      self.displayIndex = None
+      self.displayArray = None
+      logic.emptyGridTransform([1,1,1], self.origin, self.spacing, self.transformNode)
+      return
+    start, stop = box
+    self.displayIndex = tuple(slice(a, b) for a,b in zip(start, stop))
+    # padded with a zero voxel on each side, so that the slab doesn't extend its faces along the normal
+    block = np.zeros(tuple(b - a + 2 for a,b in zip(start, stop)) + (3,), dtype=np.float32)
+    block[1:-1,1:-1,1:-1] = self.getBlock(start, stop)
+    logic.gridTransformFromArray(block, self.getBoxOrigin([a - 1 for a in start]), self.spacing, self.transformNode)
+    self.displayArray = slicer.util.array(self.transformNode.GetID())[1:-1,1:-1,1:-1]
+
+  def queueDisplayUpdate(self, start, stop):
+    # copy of the box [start, stop) in the display region, for updateDisplay
+    if self.displayIndex is None:
+      return
+    start = [max(a, d.start) for a,d in zip(start, self.displayIndex)]
+    stop = [min(b, d.stop) for b,d in zip(stop, self.displayIndex)]
+    if any(b <= a for a,b in zip(start, stop)):
+      return
+    block = self.getBlock(start, stop)
+    with self.displayLock:
+      self.displayUpdates.append((start, block))
+
+  def updateDisplay(self):
+    # write the queued copies into the display grid (main thread). returns whether anything changed
+    with self.displayLock:
+      updates, self.displayUpdates = self.displayUpdates, []
+    if self.displayArray is None:
+      return False
+    for start, block in updates:
+      self.displayArray[tuple(slice(a - d.start, a - d.start + n) for a,d,n in zip(start, self.displayIndex, block.shape))] = block
+    return bool(updates)
+
+  def reset(self):
+    # release all tiles
+    self.tiles = {}
+    self.setDisplayRegion(None)
+
+  def cleanup(self):
+    # shared between the tools of each slice view
+    if self.transformNode is None:
+      return
+    slicer.mrmlScene.RemoveNode(self.transformNode)
+    self.transformNode = None
+    self.tiles = {}
+    self.displayArray = None
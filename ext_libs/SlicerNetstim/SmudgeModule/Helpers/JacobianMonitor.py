@@ -0,0 +1,193 @@
+import slicer
+import numpy as np
+
+import TransformsUtil
+import SmudgeModule
+from . import ComputeWorker
+
+
+class JacobianMonitor():
+  """
+  Jacobian determinant of the current warp over its grid. After each edit
+  only the changed region is recomputed (finite differences need one more
+  voxel of displacement around it). Min, max and number of folding voxels
+  (determinant <= 0) are kept per tile and set in the JacobianMin,
+  JacobianMax and JacobianFolds parameters. With the JacobianOverlay
+  parameter the folding voxels are shown in the label layer.
+  The first pass over the whole grid runs in a ComputeWorker. Edits made
+  meanwhile are recomputed on the main thread once it is done.
+  """
+
+  tileSize = 16
+  slabSlices = 32 # k slices computed at once
+
+  instance = None
+
+  @classmethod
+  def get(cls):
+    if cls.instance is None:
+      cls.instance = cls()
+    return cls.instance
+
+  def __init__(self):
+    self.parameterNode = SmudgeModule.SmudgeModuleLogic().getParameterNode()
+    self.key = None
+    self.determinant = None
+    self.overlayNode = None
+    self.worker = ComputeWorker.ComputeWorker()
+    self.computing = False # first pass running
+    self.pendingIndexes = [] # edits during the first pass
+
+  def check(self, warpNode):
+    # recompute everything if the warp or its grid changed. returns False if there is no warp
+    if not warpNode:
+      self.reset()
+      return False
+    size, origin, spacing = TransformsUtil.TransformsUtilLogic().getGridDefinition(warpNode)
+    key = (warpNode.GetID(), tuple(size), tuple(origin), tuple(spacing))
+    if key != self.key:
+      # a running first pass stops at its next slab
+      self.key = key
+      self.worker.wait()
+      self.size = np.array(size[::-1]) # k,j,i
+      self.origin, self.spacing = origin, spacing
+      self.determinant = np.ones(tuple(self.size), dtype=np.float32)
+      tiles = tuple(-(-self.size // self.tileSize))
+      self.tileMin, self.tileMax, self.tileFolds = np.ones(tiles), np.ones(tiles), np.zeros(tiles, dtype=int)
+      self.removeOverlay()
+      self.computing = True
+      self.pendingIndexes = []
+      layers = TransformsUtil.TransformsUtilLogic().getLayers(warpNode)
+      self.worker.submit(self.computeFirstPass, layers, key, onDone=lambda: self.onFirstPassDone(warpNode, key), onError=self.onFirstPassError)
+    if not self.computing:
+      self.updateOverlay()
+    return True
+
+  def update(self, warpNode, indexes):
+    # recompute after the warp displacement changed in indexes (k,j,i slices of the warp grid)
+    previousKey = self.key
+    if not self.check(warpNode) or self.key != previousKey or not indexes:
+      return # nothing to do or all recomputed
+    if self.computing:
+      self.pendingIndexes.extend(indexes)
+      return
+    self.computeIndexes(warpNode, indexes)
+    self.updateParameters()
+
+  def computeIndexes(self, warpNode, indexes):
+    for index in indexes:
+      start = np.array([s.start for s in index])
+      stop = np.array([s.stop for s in index])
+      # the determinant changes one voxel around
+      self.computeRegion(warpNode, np.maximum(start - 1, 0), np.minimum(stop + 1, self.size))
+
+  def computeFirstPass(self, layers, key):
+    # whole grid (worker thread). stops if the warp changed
+    for k in range(0, self.size[0], self.slabSlices):
+      if self.key != key:
+        return
+      self.computeBox(layers, np.array([k, 0, 0]), np.array([min(k + self.slabSlices, self.size[0]), self.size[1], self.size[2]]))
+    self.updateTiles(np.zeros(3, dtype=int), self.size)
+
+  def onFirstPassDone(self, warpNode, key):
+    if self.key != key:
+      return
+    self.computing = False
+    indexes, self.pendingIndexes = self.pendingIndexes, []
+    self.computeIndexes(warpNode, indexes)
+    self.updateParameters()
+    self.parameterNode.Modified() # gui shows the result even if the parameters are unchanged
+    self.updateOverlay()
+
+  def onFirstPassError(self, error):
+    ComputeWorker.logError(error)
+    self.computing = False
+    self.pendingIndexes = []
+
+  def reset(self):
+    self.removeOverlay()
+    self.key = None
+    self.worker.wait()
+    self.computing = False
+    self.pendingIndexes = []
+    self.determinant = None
+
+  def computeRegion(self, warpNode, start, stop):
+    layers = TransformsUtil.TransformsUtilLogic().getLayers(warpNode)
+    for k in range(start[0], stop[0], self.slabSlices):
+      slabStart = np.array([k, start[1], start[2]])
+      slabStop = np.array([min(k + self.slabSlices, stop[0]), stop[1], stop[2]])
+      self.computeBox(layers, slabStart, slabStop)
+    self.updateTiles(start, stop)
+    if self.overlayNode:
+      box = tuple(slice(a, b) for a,b in zip(start, stop))
+      self.overlayArray[box] = self.determinant[box] <= 0
+      slicer.util.arrayFromVolumeModified(self.overlayNode)
+
+  def computeBox(self, layers, start, stop):
+    # determinant in [start, stop) from central differences (one sided at the grid sides)
+    lower = np.maximum(start - 1, 0)
+    upper = np.minimum(stop + 1, self.size)
+    if np.any(upper - lower < 2):
+      return
+    displacement = self.getDisplacement(layers, lower, upper)
+    # gradients[c][a]: derivative of component c (x,y,z) along array axis a (k,j,i)
+    gradients = [np.gradient(displacement[...,c], *self.spacing[::-1]) for c in range(3)]
+    crop = tuple(slice(a, b) for a,b in zip(start - lower, stop - lower))
+    j = [[gradients[c][2 - a][crop] + (c == a) for a in range(3)] for c in range(3)]
+    determinant = j[0][0] * (j[1][1] * j[2][2] - j[1][2] * j[2][1]) \
+                - j[0][1] * (j[1][0] * j[2][2] - j[1][2] * j[2][0]) \
+                + j[0][2] * (j[1][0] * j[2][1] - j[1][1] * j[2][0])
+    self.determinant[tuple(slice(a, b) for a,b in zip(start, stop))] = determinant
+
+  def getDisplacement(self, layers, lower, upper):
+    # warp displacement in [lower, upper) of the grid, from the warp layers (handles)
+    logic = TransformsUtil.TransformsUtilLogic()
+    # the first layer doesn't change. drop it if it is the identity
+    if logic.getLayerSupport(layers[-1]) is False:
+      layers = layers[:-1]
+    if not layers:
+      return np.zeros(tuple(upper - lower) + (3,), dtype=np.float32)
+    if len(layers) == 1:
+      array = logic.getGridLayerArray(layers[0], self.size[::-1], self.origin, self.spacing)
+      if array is not None:
+        return array[tuple(slice(a, b) for a,b in zip(lower, upper))]
+    boxOrigin = np.array(self.origin) + lower[::-1] * np.array(self.spacing)
+    return logic.composeTransformLayers(layers, (upper - lower)[::-1], boxOrigin, self.spacing)
+
+  def updateTiles(self, start, stop):
+    n = self.tileSize
+    for tk in range(start[0] // n, (stop[0] - 1) // n + 1):
+      for tj in range(start[1] // n, (stop[1] - 1) // n + 1):
+        for ti in range(start[2] // n, (stop[2] - 1) // n + 1):
+          tile = self.determinant[tk*n:(tk+1)*n, tj*n:(tj+1)*n, ti*n:(ti+1)*n]
+          self.tileMin[tk,tj,ti] = tile.min()
+          self.tileMax[tk,tj,ti] = tile.max()
+          self.tileFolds[tk,tj,ti] = np.count_nonzero(tile <= 0)
+
+  def updateParameters(self):
+    wasModifying = self.parameterNode.StartModify()
+    self.parameterNode.SetParameter("JacobianMin", '%.3f' % self.tileMin.min())
+    self.parameterNode.SetParameter("JacobianMax", '%.3f' % self.tileMax.max())
+    self.parameterNode.SetParameter("JacobianFolds", str(int(self.tileFolds.sum())))
+    self.parameterNode.EndModify(wasModifying)
+
+  def updateOverlay(self):
+    # create or remove the folding voxels label map
+    show = bool(int(self.parameterNode.GetParameter("JacobianOverlay")))
+    if show and not self.overlayNode:
+      self.overlayNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', 'Folds')
+      self.overlayNode.SetHideFromEditors(True)
+      self.overlayNode.SetOrigin(self.origin)
+      self.overlayNode.SetSpacing(self.spacing)
+      slicer.util.updateVolumeFromArray(self.overlayNode, (self.determinant <= 0).astype(np.uint8))
+      self.overlayArray = slicer.util.arrayFromVolume(self.overlayNode)
+      slicer.util.setSliceViewerLayers(label=self.overlayNode.GetID(), labelOpacity=0.6)
+    elif not show:
+      self.removeOverlay()
+
+  def removeOverlay(self):
+    if self.overlayNode:
+      slicer.mrmlScene.RemoveNode(self.overlayNode)
+      self.overlayNode = None
+      self.overlayArray = None
@@ -0,0 +1,332 @@
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy import linalg, sparse, spatial
+from scipy.sparse import csgraph
+import scipy.sparse.linalg
+
+
+class GaussianRBFWarp():
+  """
+  Landmark warp with gaussian radial basis functions, as the gauss rbf of
+  plastimatch landwarp. Basis functions are centered in the target (fixed)
+  landmarks, phi(r) = exp(-(r/radius)^2). Coefficients are the regularized
+  solution of (K + stiffness * I) c = source - target. The resulting
+  displacement field maps target to source (FromParent).
+  """
+
+  # basis functions are neglected further than supportFactor * radius (exp(-16))
+  supportFactor = 4.0
+  # coefficient changes below this are not re-evaluated
+  changeTolerance = 1e-6
+  # number of threads used to evaluate
+  maxThreads = os.cpu_count() or 1
+  # target grid voxels per evaluation slab
+  slabVoxels = 2 ** 18
+
+  def __init__(self, radius, stiffness):
+    self.radius = float(radius)
+    self.stiffness = float(stiffness)
+    self.centers = np.zeros((0,3))
+    self.values = np.zeros((0,3))
+    self.coefficients = np.zeros((0,3))
+    # lower cholesky factor of the system. None if not positive definite
+    self.factor = None
+    self.resetField()
+
+  def kernelMatrix(self, a, b):
+    d2 = ((a[:,np.newaxis,:] - b[np.newaxis,:,:]) ** 2).sum(axis=2)
+    return np.exp(-d2 / self.radius ** 2)
+
+  def systemMatrix(self, points):
+    return self.kernelMatrix(points, points) + self.stiffness * np.eye(len(points))
+
+  def fit(self, sourcePoints, targetPoints):
+    # source and target as (N,3) RAS arrays
+    self.centers = np.array(targetPoints, dtype=float).reshape(-1,3)
+    self.values = np.array(sourcePoints, dtype=float).reshape(-1,3) - self.centers
+    self.factorize()
+    self.resetField()
+    return self.solve()
+
+  def addLandmarks(self, sourcePoints, targetPoints):
+    """
+    Append landmarks to the system. The cholesky factor is extended with the
+    new block instead of factorizing again.
+    """
+    newCenters = np.array(targetPoints, dtype=float).reshape(-1,3)
+    newValues = np.array(sourcePoints, dtype=float).reshape(-1,3) - newCenters
+    if self.factor is not None and len(self.centers):
+      L21 = linalg.solve_triangular(self.factor, self.kernelMatrix(self.centers, newCenters), lower=True).T
+      try:
+        L22 = linalg.cholesky(self.systemMatrix(newCenters) - np.dot(L21, L21.T), lower=True)
+        self.factor = np.block([[self.factor, np.zeros(L21.T.shape)], [L21, L22]])
+      except linalg.LinAlgError:
+        self.factor = None
+    self.centers = np.vstack((self.centers, newCenters))
+    self.values = np.vstack((self.values, newValues))
+    if self.factor is None or len(self.factor) != len(self.centers):
+      self.factorize()
+    return self.solve()
+
+  def removeLandmarks(self, count):
+    # remove the last count landmarks. the factor of the remaining ones is its leading block
+    n = max(len(self.centers) - count, 0)
+    self.centers = self.centers[:n]
+    self.values = self.values[:n]
+    if self.factor is not None:
+      self.factor = self.factor[:n,:n]
+    else:
+      self.factorize()
+    self.validPrefix = min(self.validPrefix, n)
+    return self.solve()
+
+  def factorize(self):
+    try:
+      self.factor = linalg.cholesky(self.systemMatrix(self.centers), lower=True) if len(self.centers) else np.zeros((0,0))
+    except linalg.LinAlgError: # i.e. repeated points without stiffness
+      self.factor = None
+
+  def solve(self):
+    if not len(self.centers):
+      self.coefficients = np.zeros((0,3))
+    elif self.factor is not None:
+      self.coefficients = linalg.cho_solve((self.factor, True), self.values)
+    else:
+      self.coefficients = np.linalg.lstsq(self.systemMatrix(self.centers), self.values, rcond=None)[0]
+    return self.coefficients
+
+  def getSupportIndex(self, centers, size, origin, spacing):
+    # bounding box (k,j,i slices) of the grid voxels where the field of the centers
+    # is not negligible. None if it doesn't reach the grid
+    if not len(centers):
+      return None
+    reach = self.supportFactor * self.radius
+    lower = np.floor((centers.min(axis=0) - reach - np.array(origin)) / np.array(spacing)).astype(int)
+    upper = np.ceil((centers.max(axis=0) + reach - np.array(origin)) / np.array(spacing)).astype(int) + 1
+    lower = np.maximum(lower, 0)
+    upper = np.minimum(upper, np.array(size))
+    if any(upper <= lower):
+      return None
+    return tuple(slice(int(lower[i]), int(upper[i])) for i in [2,1,0])
+
+  def evaluate(self, centers, coefficients, origin, spacing, index):
+    """
+    Displacement (k,j,i,3) in the index block of the grid. The gaussian is
+    separable, so the sum over the basis functions is a matrix product of the
+    per axis factors, evaluated in slabs on a thread pool.
+    """
+    axes = [origin[i] + spacing[i] * np.arange(index[2-i].start, index[2-i].stop) for i in range(3)]
+    Ex, Ey, Ez = [np.exp(-(axes[i][:,np.newaxis] - centers[np.newaxis,:,i]) ** 2 / self.radius ** 2) for i in range(3)]
+    # (N, I*3): x factor times coefficients
+    B = (Ex.T[:,:,np.newaxis] * coefficients[:,np.newaxis,:]).reshape(len(centers), -1)
+    shape = (len(Ez), len(Ey), len(Ex), 3)
+    displacement = np.empty(shape, dtype=np.float32)
+    slabSize = max(1, self.slabVoxels // max(1, len(Ey) * len(Ex)))
+    def evaluateSlab(k):
+      A = (Ez[k:k+slabSize,np.newaxis,:] * Ey[np.newaxis,:,:]).reshape(-1, len(centers))
+      displacement[k:k+slabSize] = np.dot(A, B).reshape((-1,) + shape[1:])
+    with ThreadPoolExecutor(self.maxThreads) as executor:
+      list(executor.map(evaluateSlab, range(0, shape[0], slabSize)))
+    return displacement
+
+  def resetField(self):
+    # evaluated displacement (cropped) and the centers and coefficients it was evaluated with
+    self.field = None
+    self.fieldIndex = None
+    self.fieldGrid = None
+    self.evaluatedCenters = np.zeros((0,3))
+    self.evaluatedCoefficients = np.zeros((0,3))
+    # number of leading centers that are the same as the evaluated ones
+    self.validPrefix = 0
+
+  def updateField(self, size, origin, spacing):
+    # add the contribution of the coefficients that changed since the last evaluation
+    grid = (tuple(size), tuple(origin), tuple(spacing))
+    if grid != self.fieldGrid:
+      self.resetField()
+      self.fieldGrid = grid
+    m, n = self.validPrefix, len(self.centers)
+    # coefficients of the current centers in the field. new centers are not in it
+    evaluatedCoefficients = np.vstack((self.evaluatedCoefficients[:m], np.zeros((n - m, 3))))
+    centers = np.vstack((self.centers, self.evaluatedCenters[m:]))
+    delta = np.vstack((self.coefficients - evaluatedCoefficients, -self.evaluatedCoefficients[m:]))
+    changed = np.abs(delta).max(axis=1) > self.changeTolerance if len(delta) else np.zeros(0, dtype=bool)
+    # removed centers are not kept, so their contribution can't be left for later
+    changed[n:] = np.any(delta[n:] != 0, axis=1)
+    index = self.getSupportIndex(centers[changed], size, origin, spacing)
+    if index is not None:
+      self.growField(index)
+      localIndex = tuple(slice(s.start - f.start, s.stop - f.start) for s,f in zip(index, self.fieldIndex))
+      self.field[localIndex] += self.evaluate(centers[changed], delta[changed], origin, spacing, index)
+    # skipped changes stay in the delta of the next update
+    evaluatedCoefficients[changed[:n]] = self.coefficients[changed[:n]]
+    self.evaluatedCenters = self.centers.copy()
+    self.evaluatedCoefficients = evaluatedCoefficients
+    self.validPrefix = n
+
+  def growField(self, index):
+    if self.field is not None:
+      index = tuple(slice(min(s.start, f.start), max(s.stop, f.stop)) for s,f in zip(index, self.fieldIndex))
+      if index == self.fieldIndex:
+        return
+    field = np.zeros(tuple(s.stop - s.start for s in index) + (3,), dtype=np.float32)
+    if self.field is not None:
+      field[tuple(slice(f.start - s.start, f.stop - s.start) for s,f in zip(index, self.fieldIndex))] = self.field
+    self.field = field
+    self.fieldIndex = index
+
+  def computeGrid(self, size, origin, spacing):
+    """
+    Displacement in the support of the basis functions, cropped from the grid.
+    Returns the (k,j,i,3) array and its origin, or (None, None) if the field
+    doesn't reach the grid. Sides inside the grid are set to zero, so that the
+    cropped grid transform doesn't extend its edge values.
+    Only the contribution of coefficients that changed since the previous call
+    is evaluated.
+    """
+    self.updateField(size, origin, spacing)
+    if self.field is None:
+      return None, None
+    displacement = self.field.copy()
+    for axis,s in enumerate(self.fieldIndex):
+      n = size[2-axis]
+      if s.start > 0:
+        displacement[(slice(None),) * axis + (0,)] = 0
+      if s.stop < n:
+        displacement[(slice(None),) * axis + (-1,)] = 0
+    blockOrigin = [float(origin[i] + self.fieldIndex[2-i].start * spacing[i]) for i in range(3)]
+    return displacement, blockOrigin
+
+
+class WendlandRBFWarp(GaussianRBFWarp):
+  """
+  Landmark warp with compactly supported Wendland C2 basis functions,
+  phi(r) = (1 - r/s)^4 (4r/s + 1) for r < s, with support s = supportFactor * radius.
+  The system matrix is sparse: it is built from the pairs of landmarks closer
+  than the support (kd-tree) and solved with sparse linear algebra, only for the
+  groups of connected landmarks with some displacement. Landmarks with
+  no displacement and far from the rest (i.e. fixed points) get zero
+  coefficients and are not evaluated.
+  """
+
+  supportFactor = 2.0
+
+  def getSupport(self):
+    return self.supportFactor * self.radius
+
+  def kernelFromDistance(self, r):
+    q = np.clip(r / self.getSupport(), 0, 1)
+    return (1 - q) ** 4 * (4 * q + 1)
+
+  def systemMatrix(self, points):
+    tree = spatial.cKDTree(points)
+    # pairs closer than the support, with the distances computed here so that repeated points (zero distance) are kept
+    pairs = tree.query_pairs(self.getSupport(), output_type='ndarray')
+    values = self.kernelFromDistance(np.linalg.norm(points[pairs[:,0]] - points[pairs[:,1]], axis=1))
+    A = sparse.coo_matrix((np.concatenate((values, values)), (np.concatenate((pairs[:,0], pairs[:,1])), np.concatenate((pairs[:,1], pairs[:,0])))), shape=(len(points),)*2).tocsr()
+    A.setdiag(1.0 + self.stiffness)
+    return A
+
+  def factorize(self):
+    # solved directly from the sparse matrix
+    self.factor = None
+
+  def solve(self):
+    self.coefficients = np.zeros(self.values.shape)
+    if not len(self.centers):
+      return self.coefficients
+    A = self.systemMatrix(self.centers)
+    # only the connected landmarks groups with displacement have non zero coefficients
+    nGroups, groups = csgraph.connected_components(A, directed=False)
+    activeGroups = np.unique(groups[np.abs(self.values).max(axis=1) > 0])
+    active = np.flatnonzero(np.isin(groups, activeGroups))
+    if len(active):
+      Aactive = A[active][:,active].tocsc()
+      self.coefficients[active] = np.column_stack([sparse.linalg.spsolve(Aactive, self.values[active,i]) for i in range(3)]).reshape(len(active),3)
+    return self.coefficients
+
+  def evaluate(self, centers, coefficients, origin, spacing, index):
+    # add the basis functions one by one, only in the voxels of their support
+    start = [s.start for s in index]
+    shape = tuple(s.stop - s.start for s in index)
+    displacement = np.zeros(shape + (3,), dtype=np.float32)
+    support = self.getSupport()
+    for center, coefficient in zip(centers, coefficients):
+      # center in block voxel coordinates (k,j,i)
+      position = [(center[2-a] - origin[2-a]) / spacing[2-a] - start[a] for a in range(3)]
+      reach = [support / spacing[2-a] for a in range(3)]
+      box = tuple(slice(max(int(np.floor(p - r)), 0), min(int(np.ceil(p + r)) + 1, n)) for p,r,n in zip(position, reach, shape))
+      if any(b.stop <= b.start for b in box):
+        continue
+      kk, jj, ii = np.ogrid[box]
+      r = np.sqrt(((kk - position[0]) * spacing[2]) ** 2 + ((jj - position[1]) * spacing[1]) ** 2 + ((ii - position[2]) * spacing[0]) ** 2)
+      phi = self.kernelFromDistance(r).astype(np.float32)
+      block = displacement[box]
+      for i in range(3):
+        block[...,i] += phi * coefficient[i]
+    return displacement
+
+
+class ThinPlateSplinePreview():
+  """
+  Thin plate spline (r basis, as vtkThinPlateSplineTransform with SetBasisToR)
+  from fixed source landmarks, evaluated on a coarse grid around the landmarks
+  for previews. The inverse of the system only depends on the source points,
+  so moving the targets costs a matrix product.
+  """
+
+  # voxels of the preview grid along its largest side
+  gridResolution = 24
+  # margin around the landmarks, relative to their extent (with a minimum in mm)
+  marginFactor = 0.5
+  minimumMargin = 20.0
+
+  def __init__(self, sourcePoints):
+    self.sourcePoints = np.array(sourcePoints, dtype=float).reshape(-1,3)
+    n = len(self.sourcePoints)
+    # interpolates the displacements. with less than 4 points the affine part is only a translation
+    P = self.getAffineBasis(self.sourcePoints)
+    m = P.shape[1]
+    L = np.zeros((n+m, n+m))
+    L[:n,:n] = spatial.distance.cdist(self.sourcePoints, self.sourcePoints)
+    L[:n,n:] = P
+    L[n:,:n] = P.T
+    # pseudo inverse: also valid for coplanar points
+    self.systemInverse = np.linalg.pinv(L)
+    self.coefficients = np.zeros((n+m,3))
+
+  def getAffineBasis(self, points):
+    if len(self.sourcePoints) < 4:
+      return np.ones((len(points),1))
+    return np.hstack((np.ones((len(points),1)), points))
+
+  def setTargetPoints(self, targetPoints):
+    displacements = np.array(targetPoints, dtype=float).reshape(-1,3) - self.sourcePoints
+    self.coefficients = np.dot(self.systemInverse[:,:len(displacements)], displacements)
+    return self.coefficients
+
+  def getPreviewGrid(self, targetPoints):
+    # grid around source and target points
+    points = np.vstack((self.sourcePoints, np.array(targetPoints, dtype=float).reshape(-1,3)))
+    lower, upper = points.min(axis=0), points.max(axis=0)
+    margin = max(self.minimumMargin, self.marginFactor * (upper - lower).max())
+    lower, upper = lower - margin, upper + margin
+    spacing = (upper - lower).max() / (self.gridResolution - 1)
+    size = [int(np.ceil((u - l) / spacing)) + 1 for l,u in zip(lower, upper)]
+    return size, list(lower), [spacing] * 3
+
+  def evaluate(self, size, origin, spacing):
+    # displacement (k,j,i,3) of the spline (source to target) in the grid. the
+    # faces are set to zero, so that the cropped grid doesn't extend its edge values
+    axes = [origin[i] + spacing[i] * np.arange(size[i]) for i in range(3)]
+    kk, jj, ii = np.meshgrid(axes[2], axes[1], axes[0], indexing='ij')
+    gridPoints = np.column_stack((ii.ravel(), jj.ravel(), kk.ravel()))
+    n = len(self.sourcePoints)
+    U = spatial.distance.cdist(gridPoints, self.sourcePoints)
+    displacement = np.dot(U, self.coefficients[:n]) + np.dot(self.getAffineBasis(gridPoints), self.coefficients[n:])
+    displacement = displacement.reshape((size[2], size[1], size[0], 3)).astype(np.float32)
+    for axis in range(3):
+      displacement[(slice(None),) * axis + (0,)] = 0
+      displacement[(slice(None),) * axis + (-1,)] = 0
+    return displacement
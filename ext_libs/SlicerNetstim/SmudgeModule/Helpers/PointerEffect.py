@@ -3,13 +3,17 @@ from math import sqrt, cos, sin
 from slicer.util import VTKObservationMixin
 
 from . import Effect
+from . import LandmarkWarp
+from . import SceneRegistry
+
+import TransformsUtil
 
 
 class PointerEffectTool(Effect.EffectTool):
 
   def __init__(self, sliceWidget):
     Effect.EffectTool.__init__(self, sliceWidget)
-    self.previousVisibleIDs = vtk.vtkIdList()
+    self.previousVisibleModels = []
     self.previousBackgroundNodeID = None
 
   def processEvent(self, caller=None, event=None):
@@ -23,17 +27,12 @@ class PointerEffectTool(Effect.EffectTool):
     elif event == "KeyPressEvent":
       key = self.interactor.GetKeySym()
       if key.lower() == 's':
-        if not self.previousVisibleIDs.GetNumberOfIds():
-          # get all ids from subject hierarchy node
-          shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-          shNode.GetItemChildren(shNode.GetSceneItemID(), self.previousVisibleIDs, True)
-          ids = [self.previousVisibleIDs.GetId(i) for i in range(self.previousVisibleIDs.GetNumberOfIds())]
-          for id in ids:
-            data = shNode.GetItemDataNode(id)
-            if isinstance(data, slicer.vtkMRMLModelNode) and data.GetDisplayNode() and data.GetDisplayNode().GetVisibility():
-              data.GetDisplayNode().SetVisibility(0) # hide visible models
-            else:
-              self.previousVisibleIDs.DeleteId(id) # remove non visible models IDs
+        if not self.previousVisibleModels:
+          # hide visible models
+          for model in SceneRegistry.SceneRegistry.get().getModels():
+            if model.GetDisplayNode() and model.GetDisplayNode().GetVisibility():
+              model.GetDisplayNode().SetVisibility(0)
+              self.previousVisibleModels.append(model)
       elif key.lower() == 't':
         if self.previousBackgroundNodeID is None:
           compositeNode = slicer.app.layoutManager().sliceWidget('Red').sliceLogic().GetSliceCompositeNode()
@@ -44,10 +43,10 @@ class PointerEffectTool(Effect.EffectTool):
     elif event == "KeyReleaseEvent":
       key = self.interactor.GetKeySym()
       if key.lower() == 's':
-        shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-        for i in range(self.previousVisibleIDs.GetNumberOfIds()):
-          shNode.GetItemDataNode(self.previousVisibleIDs.GetId(i)).GetDisplayNode().SetVisibility(1)
-        self.previousVisibleIDs.Reset()
+        for model in self.previousVisibleModels:
+          if model.GetDisplayNode():
+            model.GetDisplayNode().SetVisibility(1)
+        self.previousVisibleModels = []
       if key.lower() == 't':
         slicer.util.setSliceViewerLayers(background = self.previousBackgroundNodeID, foregroundOpacity=self.previousForegroundOpacity)
         self.previousBackgroundNodeID = None
@@ -121,6 +120,9 @@ class CircleEffectTool(PointerEffectTool, VTKObservationMixin):
 
 class DrawEffectTool(PointerEffectTool):
 
+  # max preview refreshes per second
+  previewRate = 30
+
   def __init__(self, sliceWidget):
 
     # keep a flag since events such as sliceNode modified
@@ -156,12 +158,22 @@ class DrawEffectTool(PointerEffectTool):
     self.transform.Inverse()
     self.auxNodes = []
 
+    # placing point preview: coarse grid around the landmarks, refreshed at a capped rate
+    self.preview = None
+    self.previewTransformNode = None
+    self.pendingTarget = None
+    self.previewTimer = qt.QTimer()
+    self.previewTimer.setSingleShot(True)
+    self.previewTimer.setInterval(int(1000 / self.previewRate))
+    self.previewTimer.connect('timeout()', self.updatePreview)
+
     self.initialized = True
 
   def cleanup(self):
     """
     call superclass to clean up actor
     """
+    self.previewTimer.stop()
     super(DrawEffectTool,self).cleanup()
 
 
@@ -192,6 +204,10 @@ class DrawEffectTool(PointerEffectTool):
           self.initTransform()
           self.cursorOff()
       elif self.actionState == "placingPoint":
+        # target set once, at the release position
+        p = vtk.vtkPoints()
+        p.InsertNextPoint(self.xyToRAS(self.interactor.GetEventPosition()))
+        self.transform.SetTargetLandmarks(p)
         self.removeAuxNodes()
         self.actionState = None
 
@@ -201,14 +217,17 @@ class DrawEffectTool(PointerEffectTool):
         self.addPoint(self.xyToRAS(xy))
         self.abortEvent(event)
       elif self.actionState == "placingPoint":
-        p = vtk.vtkPoints()
-        xy = self.interactor.GetEventPosition()
-        p.InsertNextPoint(self.xyToRAS(xy))
-        self.transform.SetTargetLandmarks(p)
+        # preview is updated from the timer
+        self.pendingTarget = self.xyToRAS(self.interactor.GetEventPosition())
+        if not self.previewTimer.isActive():
+          self.previewTimer.start()
 
     self.positionActors()
 
   def removeAuxNodes(self):
+    self.previewTimer.stop()
+    self.preview = None
+    self.previewTransformNode = None
     while len(self.auxNodes):
       slicer.mrmlScene.RemoveNode(self.auxNodes.pop())
 
@@ -218,8 +237,13 @@ class DrawEffectTool(PointerEffectTool):
     sourceFiducialNode.SetControlPointPositionsWorld(self.rasPoints)
     self.transform.SetSourceLandmarks(self.rasPoints)
     self.transform.SetTargetLandmarks(self.rasPoints)
-    transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode')
-    transformNode.SetAndObserveTransformFromParent(self.transform)
+    # spline solved once for the source points. only the target moves
+    sourcePoints = [self.rasPoints.GetPoint(i) for i in range(self.rasPoints.GetNumberOfPoints())]
+    self.preview = LandmarkWarp.ThinPlateSplinePreview(sourcePoints)
+    self.pendingTarget = sourcePoints
+    transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
+    self.previewTransformNode = transformNode
+    self.updatePreview()
     transformNode.CreateDefaultDisplayNodes()
     transformNode.GetDisplayNode().SetVisibility(1)
     transformNode.GetDisplayNode().SetVisibility2D(1)
@@ -228,6 +252,15 @@ class DrawEffectTool(PointerEffectTool):
     self.auxNodes.append(sourceFiducialNode)
     self.auxNodes.append(transformNode)
 
+  def updatePreview(self):
+    if self.preview is None or self.pendingTarget is None:
+      return
+    self.preview.setTargetPoints(self.pendingTarget)
+    size, origin, spacing = self.preview.getPreviewGrid(self.pendingTarget)
+    displacement = self.preview.evaluate(size, origin, spacing)
+    TransformsUtil.TransformsUtilLogic().gridTransformFromArray(displacement, origin, spacing, self.previewTransformNode, toParent=True)
+    self.pendingTarget = None
+
   def xyToRAS(self,xyPoint):
     """return r a s for a given x y"""
     sliceNode = self.sliceLogic.GetSliceNode()
@@ -0,0 +1,58 @@
+import qt
+import time
+
+
+class RenderScheduler():
+  """
+  Refresh of a transform being edited interactively. While a drag is in
+  progress, the modified events of the transform node are held back so that
+  only the view being edited is re-resliced, at most once per display frame
+  (or per render time, if rendering takes longer). The held back events are
+  let through on end(), refreshing all views once.
+  """
+
+  frameInterval = 1000.0 / 60 # ms
+
+  def __init__(self, sliceView):
+    self.sliceView = sliceView
+    self.transformNode = None
+    self.wasModifying = False
+    self.pending = False
+    self.lastRenderTime = 0
+    self.renderCost = 0
+    self.timer = qt.QTimer()
+    self.timer.setSingleShot(True)
+    self.timer.connect('timeout()', self.render)
+
+  def begin(self, transformNode):
+    self.end()
+    self.transformNode = transformNode
+    self.wasModifying = transformNode.StartModify()
+
+  def requestRender(self):
+    if self.transformNode is None:
+      return
+    self.pending = True
+    if self.timer.isActive():
+      return
+    elapsed = (time.perf_counter() - self.lastRenderTime) * 1000
+    self.timer.start(int(max(max(self.frameInterval, self.renderCost) - elapsed, 0)))
+
+  def render(self):
+    if not self.pending or self.transformNode is None:
+      return
+    self.pending = False
+    start = time.perf_counter()
+    # transform data changed. the view pipeline picks it up from the transform modified time
+    self.transformNode.GetTransformFromParent().Modified()
+    self.sliceView.forceRender()
+    self.lastRenderTime = time.perf_counter()
+    self.renderCost = (self.lastRenderTime - start) * 1000
+
+  def end(self):
+    self.timer.stop()
+    self.pending = False
+    if self.transformNode is None:
+      return
+    transformNode, self.transformNode = self.transformNode, None
+    transformNode.EndModify(self.wasModifying)
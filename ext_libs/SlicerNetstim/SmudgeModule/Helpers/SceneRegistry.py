@@ -0,0 +1,154 @@
+import vtk, slicer
+import vtk.util.numpy_support
+import numpy as np
+from collections import OrderedDict
+from slicer.util import VTKObservationMixin
+
+
+class SceneRegistry(VTKObservationMixin):
+  """
+  Index of the WarpDrive objects in the scene: drawings, saved warps and
+  models. Kept up to date from the scene node added/removed events and the
+  subject hierarchy item modified events (attributes are set after the node is
+  added), so that lookups don't scan the scene. The scene is only scanned on
+  creation and after a scene close or import.
+  Drawings and saved warps are kept in the order they were tagged.
+  """
+
+  instance = None
+
+  @classmethod
+  def get(cls):
+    if cls.instance is None:
+      cls.instance = cls()
+    return cls.instance
+
+  @classmethod
+  def release(cls):
+    if cls.instance is not None:
+      cls.instance.removeObservers()
+      cls.instance = None
+
+  def __init__(self):
+    VTKObservationMixin.__init__(self)
+    self.shNode = None
+    self.drawings = OrderedDict() # node ID: [itemID, node, enabled]
+    self.savedWarps = OrderedDict() # node ID: [itemID, node]
+    self.models = OrderedDict() # node ID: node
+    self.fixedPointsKey = None
+    self.fixedPoints = np.zeros((0,3))
+    self.addObserver(slicer.mrmlScene, slicer.mrmlScene.NodeAddedEvent, self.onNodeAdded)
+    self.addObserver(slicer.mrmlScene, slicer.mrmlScene.NodeAboutToBeRemovedEvent, self.onNodeAboutToBeRemoved)
+    self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndCloseEvent, self.rebuild)
+    self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndImportEvent, self.rebuild)
+    self.rebuild()
+
+  def rebuild(self, caller=None, event=None):
+    # full scan
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    if shNode != self.shNode:
+      if self.shNode is not None:
+        self.removeObserver(self.shNode, self.shNode.SubjectHierarchyItemModifiedEvent, self.onItemModified)
+      self.shNode = shNode
+      self.addObserver(self.shNode, self.shNode.SubjectHierarchyItemModifiedEvent, self.onItemModified)
+    self.drawings.clear()
+    self.savedWarps.clear()
+    self.models.clear()
+    self.fixedPointsKey = None
+    for className in ['vtkMRMLModelNode', 'vtkMRMLMarkupsFiducialNode', 'vtkMRMLTransformNode']:
+      nodes = slicer.mrmlScene.GetNodesByClass(className)
+      nodes.UnRegister(slicer.mrmlScene)
+      for i in range(nodes.GetNumberOfItems()):
+        node = nodes.GetItemAsObject(i)
+        self.addNode(node)
+        self.updateItem(self.shNode.GetItemByDataNode(node))
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAdded(self, caller, event, node):
+    self.addNode(node)
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAboutToBeRemoved(self, caller, event, node):
+    nodeID = node.GetID()
+    self.models.pop(nodeID, None)
+    self.drawings.pop(nodeID, None)
+    self.savedWarps.pop(nodeID, None)
+
+  @vtk.calldata_type(vtk.VTK_LONG)
+  def onItemModified(self, caller, event, itemID):
+    self.updateItem(itemID)
+
+  def addNode(self, node):
+    if isinstance(node, slicer.vtkMRMLModelNode):
+      self.models[node.GetID()] = node
+
+  def updateItem(self, itemID):
+    # (re)classify an item from its attributes
+    node = self.shNode.GetItemDataNode(itemID) if itemID else None
+    if node is None:
+      return
+    nodeID = node.GetID()
+    attributeNames = self.shNode.GetItemAttributeNames(itemID)
+    if isinstance(node, slicer.vtkMRMLMarkupsFiducialNode):
+      if 'drawing' in attributeNames:
+        enabled = bool(int(self.shNode.GetItemAttribute(itemID, 'drawing') or 0))
+        if nodeID in self.drawings:
+          self.drawings[nodeID][2] = enabled
+        else:
+          self.drawings[nodeID] = [itemID, node, enabled]
+      else:
+        self.drawings.pop(nodeID, None)
+    elif isinstance(node, slicer.vtkMRMLTransformNode):
+      if 'savedWarp' in attributeNames:
+        if nodeID not in self.savedWarps:
+          self.savedWarps[nodeID] = [itemID, node]
+      else:
+        self.savedWarps.pop(nodeID, None)
+
+  def getDrawings(self):
+    # (itemID, node) of the drawings, oldest first
+    return [(itemID, node) for itemID, node, enabled in self.drawings.values()]
+
+  def getLastDrawing(self, attributeName):
+    # most recent enabled drawing with attributeName
+    for itemID, node, enabled in reversed(list(self.drawings.values())):
+      if enabled and attributeName in self.shNode.GetItemAttributeNames(itemID):
+        return itemID, node
+    return None, None
+
+  def getSavedWarps(self):
+    return [node for itemID, node in self.savedWarps.values()]
+
+  def getModels(self):
+    return list(self.models.values())
+
+  def getFixedPoints(self):
+    """
+    Control points of the enabled drawings as a (N,3) array. Rebuilt only when
+    the enabled drawings or their points changed.
+    """
+    drawings = [node for itemID, node, enabled in self.drawings.values() if enabled]
+    key = tuple((node.GetID(), node.GetMTime(), self.getTransformMTime(node)) for node in drawings)
+    if key != self.fixedPointsKey:
+      points = []
+      for node in drawings:
+        p = vtk.vtkPoints()
+        node.GetControlPointPositionsWorld(p)
+        if p.GetNumberOfPoints():
+          points.append(vtk.util.numpy_support.vtk_to_numpy(p.GetData()).reshape(-1,3).astype(float))
+      self.fixedPoints = np.concatenate(points) if points else np.zeros((0,3))
+      self.fixedPointsKey = key
+    return self.fixedPoints
+
+  def getTransformMTime(self, node):
+    # world positions also change with the parent transforms
+    transformNode = node.GetParentTransformNode()
+    return (transformNode.GetID(), transformNode.GetTransformToWorldMTime()) if transformNode else None
+
+  def removeDrawings(self):
+    for itemID, node in self.getDrawings():
+      slicer.mrmlScene.RemoveNode(node)
+
+  def removeSavedWarps(self):
+    for node in self.getSavedWarps():
+      slicer.mrmlScene.RemoveNode(node)
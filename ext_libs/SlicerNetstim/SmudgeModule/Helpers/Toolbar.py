@@ -1,13 +1,14 @@
 import qt, vtk, slicer
 from qt import QToolBar
 import os
+import numpy as np
 from slicer.util import VTKObservationMixin
 
 import SmudgeModule
 import ImportAtlas
 import ImportSubject
 import TransformsUtil
-from . import WarpEffect, FunctionsUtil
+from . import WarpEffect, FunctionsUtil, SceneRegistry, WarpUndoStack, TransformPyramid, WarpSnapshots, JacobianMonitor
 
 class reducedToolbar(QToolBar, VTKObservationMixin):
 
@@ -143,26 +144,18 @@ class reducedToolbar(QToolBar, VTKObservationMixin):
 
       # remove nodes
       SmudgeModule.SmudgeModuleLogic().removeRedoNodes()
+      WarpUndoStack.WarpUndoStack.get().clear()
+      WarpSnapshots.WarpSnapshots.get().clear()
+      JacobianMonitor.JacobianMonitor.get().reset()
       slicer.mrmlScene.RemoveNode(self.parameterNode.GetNodeReference("glanatCompositeID"))
       slicer.mrmlScene.RemoveNode(reducedToolbarLogic().getBackgroundNode())
 
       # delete warps
-      shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-      transformNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLTransformNode')
-      transformNodes.UnRegister(slicer.mrmlScene)
-      for i in range(transformNodes.GetNumberOfItems()):
-        transformNode = transformNodes.GetItemAsObject(i)
-        if 'savedWarp' in shNode.GetItemAttributeNames(shNode.GetItemByDataNode(transformNode)):
-          slicer.mrmlScene.RemoveNode(transformNode)
+      SceneRegistry.SceneRegistry.get().removeSavedWarps()
       self.parameterNode.SetNodeReferenceID("warpID",None)
 
       # delete fiducials
-      markupsNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLMarkupsFiducialNode')
-      markupsNodes.UnRegister(slicer.mrmlScene)
-      for i in range(markupsNodes.GetNumberOfItems()):
-        markupNode = markupsNodes.GetItemAsObject(i)
-        if 'drawing' in shNode.GetItemAttributeNames(shNode.GetItemByDataNode(markupNode)):
-          slicer.mrmlScene.RemoveNode(markupNode)
+      SceneRegistry.SceneRegistry.get().removeDrawings()
       
 
       nextSubjectN = int(self.parameterNode.GetParameter("subjectN"))+1
@@ -194,8 +187,8 @@ class reducedToolbar(QToolBar, VTKObservationMixin):
     newResolution = float(self.resolutionComboBox.itemText(index)[:-2]) # get resolution
     # apply to warp
     reducedToolbarLogic().resampleTransform(self.parameterNode.GetNodeReference("warpID"), newResolution)
-    # apply to glanat comp
-    reducedToolbarLogic().resampleTransform(self.parameterNode.GetNodeReference("glanatCompositeID"), newResolution)
+    # glanat comp from its pyramid
+    reducedToolbarLogic().getGlanatPyramid().setLevel(self.parameterNode.GetNodeReference("glanatCompositeID"), newResolution)
     # save
     self.parameterNode.SetParameter("resolution",str(newResolution))
 
@@ -222,7 +215,7 @@ class reducedToolbarLogic(object):
     glanatCompositeNode = ImportSubject.ImportSubjectLogic().importTransform(subjectPath, 'glanatComposite.nii.gz')
     self.parameterNode.SetNodeReferenceID("glanatCompositeID", glanatCompositeNode.GetID())
     # resample
-    self.resampleTransform(glanatCompositeNode, float(self.parameterNode.GetParameter("resolution")))
+    self.getGlanatPyramid().setLevel(glanatCompositeNode, float(self.parameterNode.GetParameter("resolution")), sourceNode=glanatCompositeNode)
 
     # create warp
     size,origin,spacing = TransformsUtil.TransformsUtilLogic().getGridDefinition(glanatCompositeNode)
@@ -236,22 +229,17 @@ class reducedToolbarLogic(object):
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
     shNode.SetItemAttribute(shNode.GetItemByDataNode(warpNode), 'savedWarp', '1')
 
+  def getGlanatPyramid(self):
+    return TransformPyramid.TransformPyramid(os.path.join(self.parameterNode.GetParameter("subjectPath"), 'glanatComposite.nii.gz'))
+
   def resampleTransform(self, transformNode, resolution):
     # check resolution
     size,origin,spacing = TransformsUtil.TransformsUtilLogic().getGridDefinition(transformNode)
     if spacing[0] == resolution:
       return
-    # aux nodes
-    outNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode')
+    # resample in the MNI grid with the specified resolution
     size,origin,spacing = TransformsUtil.TransformsUtilLogic().getMNIGrid(resolution)
-    referenceVolume = TransformsUtil.TransformsUtilLogic().createEmpyVolume(size,origin,spacing) # aux reference volume with specified resolution 
-    # apply
-    transformsLogic = slicer.modules.transforms.logic()
-    transformsLogic.ConvertToGridTransform(transformNode, referenceVolume, outNode)
-    transformNode.SetAndObserveTransformFromParent(outNode.GetTransformFromParent()) # set new transform to warp node
-    # remove aux nodes
-    slicer.mrmlScene.RemoveNode(outNode)
-    slicer.mrmlScene.RemoveNode(referenceVolume)
+    TransformsUtil.TransformsUtilLogic().resampleToGridTransform(transformNode, size, origin, spacing)
   
   def applyChanges(self):
 
@@ -285,31 +273,59 @@ class reducedToolbarLogic(object):
     
     # harden changes in glanat composite with MNI 0.5 resolution
     glanatCompositeNode = self.parameterNode.GetNodeReference("glanatCompositeID")
+    self.getGlanatPyramid().setLevel(glanatCompositeNode, TransformPyramid.TransformPyramid.finestResolution)
+    # the inverse only changes where the forward maps the support of the edits, before and after hardening them
+    editPoints = self.getEditPoints(glanatCompositeNode)
+    updatePoints = [self.getNativePoints(glanatCompositeNode, editPoints)]
     glanatCompositeNode.HardenTransform()
     TransformsUtil.TransformsUtilLogic().flattenTransform(glanatCompositeNode, includeFirstLayer=True, useMNIGrid=True)
+    updatePoints.append(self.getNativePoints(glanatCompositeNode, editPoints))
+    updatePoints = np.concatenate(updatePoints) if editPoints is not None else None
 
     # save foreward
     slicer.util.saveNode(glanatCompositeNode, os.path.join(subjectPath,'glanatComposite.nii.gz'))
 
-    # invert transform
-    glanatCompositeNode.Inverse()
     # get image to set as reference 
     imageNode = self.getBackgroundNode()
-    # get inverse
-    outNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode')
-    transformsLogic = slicer.modules.transforms.logic()
-    transformsLogic.ConvertToGridTransform(glanatCompositeNode, imageNode, outNode)
+    # get inverse, updating the previous one where the edits are
+    inversePath = os.path.join(subjectPath,'glanatInverseComposite.nii.gz')
+    previousInverseNode = slicer.util.loadTransform(inversePath) if os.path.isfile(inversePath) else None
+    logic = TransformsUtil.TransformsUtilLogic()
+    outNode = logic.invertToGridTransform(glanatCompositeNode, imageNode, previousInverseNode, updatePoints)
     # save inverse
-    slicer.util.saveNode(outNode, os.path.join(subjectPath,'glanatInverseComposite.nii.gz'))
+    slicer.util.saveNode(outNode, inversePath)
+    inversionWarning = logic.getInversionWarning()
 
-    # delete aux node
+    # delete aux nodes
     slicer.mrmlScene.RemoveNode(outNode)
+    if previousInverseNode and previousInverseNode != outNode:
+      slicer.mrmlScene.RemoveNode(previousInverseNode)
     
     qt.QApplication.setOverrideCursor(qt.QCursor(qt.Qt.ArrowCursor))
 
+    if inversionWarning:
+      qt.QMessageBox.warning(qt.QWidget(), '', inversionWarning)
+
     return True
 
 
+  def getEditPoints(self, glanatCompositeNode):
+    # points on the sides of the support of the edits (parent transforms of glanat), None if unbounded
+    logic = TransformsUtil.TransformsUtilLogic()
+    editBounds = logic.getSupportBounds(glanatCompositeNode.GetParentTransformNode())
+    if editBounds is None:
+      return None
+    elif editBounds is False:
+      return np.zeros((0,3))
+    return logic.getBoundsSurfacePoints(editBounds, logic.getMNIGrid(0.5)[2][0])
+
+  def getNativePoints(self, glanatCompositeNode, points):
+    # points mapped with the glanat composite alone
+    if points is None or not len(points):
+      return np.zeros((0,3))
+    logic = TransformsUtil.TransformsUtilLogic()
+    return logic.transformPoints(logic.getLayers(glanatCompositeNode), points)
+
   def getBackgroundNode(self):
     layoutManager = slicer.app.layoutManager()
     compositeNode = layoutManager.sliceWidget('Red').sliceLogic().GetSliceCompositeNode()
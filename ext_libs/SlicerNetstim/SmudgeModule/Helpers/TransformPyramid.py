@@ -0,0 +1,147 @@
+import os
+import numpy as np
+from collections import OrderedDict
+
+import slicer
+
+import TransformsUtil
+import SmudgeModule
+from . import GaussianSmoothing
+
+
+class TransformPyramid():
+  """
+  Displacement of a transform file (the subject glanat composite) over the MNI
+  grid at each resolution. A level is downsampled from the coarsest finer
+  level in memory whose spacing divides its own, else sampled from the
+  transform at its resolution, so that coarse levels don't need the finest
+  one. Levels are kept in a LRU cache shared by all the pyramids, limited by
+  the PyramidMaxMemory parameter (MB), and optionally saved next to the
+  source file (PyramidDiskCache parameter). Levels of previous versions of
+  the source file are dropped.
+  """
+
+  resolutions = [0.5, 1, 2, 5, 10]
+  finestResolution = 0.5
+  # (source key, resolution): array
+  cache = OrderedDict()
+
+  def __init__(self, sourcePath):
+    self.sourcePath = sourcePath
+    self.parameterNode = SmudgeModule.SmudgeModuleLogic().getParameterNode()
+    stat = os.stat(sourcePath)
+    self.sourceKey = (os.path.abspath(sourcePath), stat.st_mtime, stat.st_size)
+    self.cacheDirectory = os.path.splitext(os.path.splitext(sourcePath)[0])[0] + 'Pyramid'
+    self.dropStaleLevels()
+
+  def setLevel(self, transformNode, resolution, sourceNode = None):
+    # set the transform of transformNode to the level at resolution. parent transform is kept
+    size, origin, spacing = TransformsUtil.TransformsUtilLogic().getMNIGrid(resolution)
+    array = self.getLevel(resolution, sourceNode)
+    TransformsUtil.TransformsUtilLogic().gridTransformFromArray(array, origin, spacing, transformNode)
+
+  def getLevel(self, resolution, sourceNode = None):
+    """
+    (k,j,i,3) displacement at resolution. sourceNode, if given, holds the source
+    transform and spares loading it when the finest level is sampled.
+    """
+    key = (self.sourceKey, float(resolution))
+    if key in self.cache:
+      self.cache.move_to_end(key)
+      return self.cache[key]
+    array = self.loadLevel(resolution)
+    if array is None:
+      parentResolution = self.getParentResolution(resolution)
+      if parentResolution is None:
+        array = self.sampleSource(resolution, sourceNode)
+      else:
+        size = TransformsUtil.TransformsUtilLogic().getMNIGrid(resolution)[0]
+        factor = int(round(resolution / parentResolution))
+        array = downsample(self.getLevel(parentResolution), factor, size)
+      self.saveLevel(resolution, array)
+    self.cache[key] = array
+    self.dropOldLevels()
+    return array
+
+  def getParentResolution(self, resolution):
+    # coarsest finer level in memory that divides resolution, None if there is none
+    for parentResolution in reversed(self.resolutions):
+      factor = resolution / parentResolution
+      if parentResolution < resolution and abs(factor - round(factor)) < 1e-6 and (self.sourceKey, float(parentResolution)) in self.cache:
+        return parentResolution
+    return None
+
+  def sampleSource(self, resolution, sourceNode):
+    logic = TransformsUtil.TransformsUtilLogic()
+    size, origin, spacing = logic.getMNIGrid(resolution)
+    loaded = sourceNode is None
+    if loaded:
+      sourceNode = slicer.util.loadTransform(self.sourcePath)
+    layers = logic.getLayers(sourceNode)
+    array = logic.composeTransformLayers(layers, size, origin, spacing)
+    if loaded:
+      slicer.mrmlScene.RemoveNode(sourceNode)
+    return array
+
+  def dropStaleLevels(self):
+    # levels of the same file with another modified time or size
+    for key in [key for key in self.cache if key[0][0] == self.sourceKey[0] and key[0] != self.sourceKey]:
+      del self.cache[key]
+
+  def dropOldLevels(self):
+    maxBytes = float(self.parameterNode.GetParameter("PyramidMaxMemory")) * 2**20
+    while len(self.cache) > 1 and sum(a.nbytes for a in self.cache.values()) > maxBytes:
+      self.cache.popitem(last=False)
+
+  def getLevelPath(self, resolution):
+    return os.path.join(self.cacheDirectory, '%gmm.npy' % resolution)
+
+  def loadLevel(self, resolution):
+    if not int(self.parameterNode.GetParameter("PyramidDiskCache")) or not os.path.isfile(self.getLevelPath(resolution)):
+      return None
+    if self.readDiskKey() != repr(self.sourceKey[1:]):
+      return None
+    return np.load(self.getLevelPath(resolution), mmap_mode='r')
+
+  def saveLevel(self, resolution, array):
+    if not int(self.parameterNode.GetParameter("PyramidDiskCache")):
+      return
+    if not os.path.isdir(self.cacheDirectory):
+      os.makedirs(self.cacheDirectory)
+    if self.readDiskKey() != repr(self.sourceKey[1:]):
+      # levels of a previous version of the source
+      for fileName in os.listdir(self.cacheDirectory):
+        if fileName.endswith('.npy'):
+          os.remove(os.path.join(self.cacheDirectory, fileName))
+      with open(os.path.join(self.cacheDirectory, 'source.txt'), 'w') as f:
+        f.write(repr(self.sourceKey[1:]))
+    np.save(self.getLevelPath(resolution), array)
+
+  def readDiskKey(self):
+    keyPath = os.path.join(self.cacheDirectory, 'source.txt')
+    if not os.path.isfile(keyPath):
+      return None
+    with open(keyPath, 'r') as f:
+      return f.read()
+
+
+def downsample(array, factor, size):
+  """
+  Downsample a (k,j,i,3) displacement array by an integer factor to size
+  (i,j,k), keeping the voxels at multiples of factor (same origin). Gaussian
+  anti-aliasing (sigma = factor/3) evaluated only at the kept voxels, one
+  axis at a time. Edges are extended, like vtkGridTransform does.
+  """
+  kernel = GaussianSmoothing.gaussianKernel(factor / 3.0).astype(np.float32)
+  radius = len(kernel) // 2
+  for axis in range(3):
+    n = int(size[2 - axis])
+    centers = np.minimum(np.arange(n) * factor, array.shape[axis] - 1)
+    shape = list(array.shape)
+    shape[axis] = n
+    output = np.zeros(shape, dtype=np.float32)
+    for tap, weight in enumerate(kernel):
+      index = np.clip(centers + tap - radius, 0, array.shape[axis] - 1)
+      output += weight * np.take(array, index, axis=axis)
+    array = output
+  return array
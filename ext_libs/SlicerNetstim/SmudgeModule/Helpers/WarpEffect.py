@@ -1,53 +1,108 @@
 import slicer, vtk, qt
 import numpy as np
 import sys, os
+from collections import OrderedDict
+from math import sqrt, floor
+from concurrent.futures import ThreadPoolExecutor
 
 from scipy import ndimage
 import SimpleITK as sitk
 import sitkUtils
 
 from . import PointerEffect
+from . import ComputeWorker
+from . import GridTiles
+from . import RenderScheduler
+from . import GaussianSmoothing
+from . import LandmarkWarp
+from . import SceneRegistry
+from . import WarpUndoStack
+from . import JacobianMonitor
 
 import TransformsUtil
 import SmudgeModule
 
 
 
+def kernelFromDistance(d2, r, hardness):
+  """
+  Brush profile evaluated at squared voxel distances d2 from the brush center.
+  Inverse square falloff, flat inside the hardness radius and zero outside the
+  brush radius. Normalized to [0-1].
+  """
+  smallThreshold = (r * hardness / 100.0) ** 2 + 1
+  # value in the edge of the small sphere (first voxel of the small sphere in C order)
+  edge = 0
+  for _ in range(3):
+    remaining = smallThreshold - edge
+    step = int(floor(sqrt(remaining)))
+    while step ** 2 > remaining:
+      step -= 1
+    edge += step ** 2
+  maxValue = 1.0 / max(edge, 1)
+  # invert, replace 0 by 1
+  kernel = 1.0 / np.maximum(d2, 1)
+  # set same value inside the small sphere and delete outside values
+  kernel = np.where(d2 <= smallThreshold, maxValue, kernel)
+  kernel = np.where(d2 <= r ** 2 + 1, kernel, 0)
+  # set range to [0-1]
+  return kernel / maxValue
 
 
 class WarpEffectTool():
 
   _instances = set()
 
+  # brush kernels shared by all tools. key: (radius in voxels, hardness, force, falloff)
+  _kernelCache = OrderedDict()
+  _kernelCacheSize = 8
+  kernelFalloff = 'inverseSquare'
+  # swept stroke line integrals of the kernels. same key
+  _sweptTableCache = OrderedDict()
+  sweptTableStep = 0.25
+  # background thread shared by all tools
+  worker = None
+
   def __init__(self, warpNode = True):
     self._instances.add(self)
     self.parameterNode = SmudgeModule.SmudgeModuleLogic().getParameterNode()
     if warpNode:
       self.warpNode = self.parameterNode.GetNodeReference("warpID")
+    self.kernel = None
+
+  @classmethod
+  def getWorker(cls):
+    if WarpEffectTool.worker is None:
+      WarpEffectTool.worker = ComputeWorker.ComputeWorker()
+    return WarpEffectTool.worker
 
   def createSphere(self, r):
-    # create a sphere with redius
-    xx, yy, zz = np.mgrid[:2*r+1, :2*r+1, :2*r+1]
-    sphereResult = (xx-r) ** 2 + (yy-r) ** 2 + (zz-r) ** 2
-    sphereResult[r][r][r] = 1 # replace 0 by 1
-    sphereLarge = sphereResult <= (r**2+1) # sphere that the mouse shows
-    currentEffect = self.parameterNode.GetParameter("currentEffect")
-    sphereSmall = sphereResult <= ((r * float(self.parameterNode.GetParameter(currentEffect + "Hardness")) / 100.0) **2 + 1 ) # hardness amount
-    sphereResult = 1.0 / sphereResult # invert
-    # get value in the edge of the small sphere
-    i1,i2,i3 = np.nonzero(sphereSmall)
-    newMaxValue = sphereResult[i1[0]][i2[0]][i3[0]]
-    # set same value inside the small sphere
-    sphereResult[sphereSmall] = sphereSmall[sphereSmall] * newMaxValue
-    # delete outside values 
-    sphereResult = sphereResult * sphereLarge
-    # set range to [0-1]
-    newMinValue = sphereResult.min()
-    sphereResult = (sphereResult - newMinValue) / (newMaxValue - newMinValue)
+    # reuse kernel as long as the parameters don't change
+    if self.kernel is not None and self.kernel.shape[0] == 2*r+1:
+      return self.kernel
+    self.kernel = self.getKernel(r, *self.getKernelParameters())
+    return self.kernel
+
+  def resetKernel(self, caller=None, event=None):
+    self.kernel = None
+
+  @classmethod
+  def getKernel(cls, r, hardness, force):
+    key = (r, hardness, force, cls.kernelFalloff)
+    if key in cls._kernelCache:
+      cls._kernelCache.move_to_end(key)
+      return cls._kernelCache[key]
+    # create a sphere with radius
+    xx, yy, zz = np.ogrid[-r:r+1, -r:r+1, -r:r+1]
+    kernel = kernelFromDistance(xx ** 2 + yy ** 2 + zz ** 2, r, hardness)
     # set force
-    if currentEffect == "Smudge":
-      sphereResult = sphereResult * float(self.parameterNode.GetParameter("SmudgeForce")) / 100.0
-    return sphereResult
+    kernel = (kernel * force / 100.0).astype(np.float32)
+    kernel.setflags(write=False) # shared between tools
+    cls._kernelCache[key] = kernel
+    # evict least recently used
+    while len(cls._kernelCache) > cls._kernelCacheSize:
+      cls._kernelCache.popitem(last=False)
+    return kernel
 
   def eventPositionToRAS(self):
     xy = self.interactor.GetEventPosition()
@@ -55,6 +110,83 @@ class WarpEffectTool():
     currentPoint = xyToRAS.MultiplyDoublePoint( (xy[0], xy[1], 0, 1) )[0:3]
     return currentPoint
 
+  @classmethod
+  def getSweptTable(cls, r, hardness, force):
+    # cumulative line integral of the kernel profile, tabulated over distance to
+    # the stroke axis (rows) and position along the axis (columns)
+    key = (r, hardness, force, cls.kernelFalloff)
+    if key in cls._sweptTableCache:
+      cls._sweptTableCache.move_to_end(key)
+      return cls._sweptTableCache[key]
+    step = cls.sweptTableStep
+    distance = np.arange(0, r + 2 + step, step)
+    position = np.arange(-(r + 2), r + 2 + step, step)
+    profile = kernelFromDistance(distance[:,None] ** 2 + position[None,:] ** 2, r, hardness) * force / 100.0
+    table = np.zeros(profile.shape, dtype=np.float32)
+    table[:,1:] = np.cumsum((profile[:,1:] + profile[:,:-1]) * step / 2.0, axis=1)
+    table.setflags(write=False)
+    cls._sweptTableCache[key] = (table, position[0])
+    while len(cls._sweptTableCache) > cls._kernelCacheSize:
+      cls._sweptTableCache.popitem(last=False)
+    return cls._sweptTableCache[key]
+
+  def getKernelParameters(self):
+    currentEffect = self.parameterNode.GetParameter("currentEffect")
+    hardness = float(self.parameterNode.GetParameter(currentEffect + "Hardness"))
+    force = float(self.parameterNode.GetParameter("SmudgeForce")) if currentEffect == "Smudge" else 100.0
+    return hardness, force
+
+  def accumulateDisplacement(self, grid, index, kernel, displacement):
+    # add kernel * displacement to the tiled grid
+    if tuple(s.stop - s.start for s in index) != kernel.shape:
+      raise GridTiles.OutOfGridError('kernel out of grid bounds')
+    grid.add(index, kernel, displacement)
+
+  def accumulateSweptDisplacement(self, grid, startPoint, endPoint, kernel, sweptTable, displacement):
+    # deposit the displacement of a brush swept from startPoint to endPoint (a capsule)
+    # in one pass. each voxel gets the kernel integrated along the segment, which is
+    # what applying the sphere at every intermediate position would add up to
+    r = (kernel.shape[0] - 1) // 2
+    RASToIJK = grid.RASToIJK
+    a = np.array(RASToIJK.MultiplyDoublePoint(tuple(startPoint) + (1,))[:3])
+    b = np.array(RASToIJK.MultiplyDoublePoint(tuple(endPoint) + (1,))[:3])
+    length = np.linalg.norm(b - a)
+    if length < 1e-3:
+      currentIndex = self.getCurrentIndex(r, tuple(endPoint), RASToIJK)
+      self.accumulateDisplacement(grid, currentIndex, kernel, displacement)
+      return
+    index = self.getSweptIndex(r, startPoint, endPoint, RASToIJK)
+    grid.checkIndex(index)
+    kk, jj, ii = np.ogrid[index]
+    # position along the segment and distance to its axis
+    direction = (b - a) / length
+    ii, jj, kk = ii - a[0], jj - a[1], kk - a[2]
+    along = ii * direction[0] + jj * direction[1] + kk * direction[2]
+    across = np.sqrt(np.maximum(ii ** 2 + jj ** 2 + kk ** 2 - along ** 2, 0))
+    # integral of the kernel over the segment, normalized by its length
+    table, position0 = sweptTable
+    weight = (self.lookupSweptTable(table, position0, across, length - along) - self.lookupSweptTable(table, position0, across, -along)) / length
+    grid.add(index, weight.astype(np.float32), displacement)
+
+  def lookupSweptTable(self, table, position0, across, along):
+    # bilinear interpolation in the swept table
+    step = self.sweptTableStep
+    row = np.clip(across / step, 0, table.shape[0] - 1)
+    column = np.clip((along - position0) / step, 0, table.shape[1] - 1)
+    row0 = np.minimum(row.astype(int), table.shape[0] - 2)
+    column0 = np.minimum(column.astype(int), table.shape[1] - 2)
+    row, column = row - row0, column - column0
+    return (table[row0, column0] * (1 - column) + table[row0, column0 + 1] * column) * (1 - row) + \
+           (table[row0 + 1, column0] * (1 - column) + table[row0 + 1, column0 + 1] * column) * row
+
+  def getSweptIndex(self, r, startPoint, endPoint, RASToIJK):
+    # capsule bounding box
+    a = np.array(RASToIJK.MultiplyDoublePoint(tuple(startPoint) + (1,))[:3])
+    b = np.array(RASToIJK.MultiplyDoublePoint(tuple(endPoint) + (1,))[:3])
+    lower = np.floor(np.minimum(a, b)).astype(int) - r - 1
+    upper = np.ceil(np.maximum(a, b)).astype(int) + r + 1
+    return slice(lower[2], upper[2]+1), slice(lower[1], upper[1]+1), slice(lower[0], upper[0]+1)
+
   def getCurrentIndex(self, r, currentPoint, RASToIJK):
     # get current IJK
     pos_i,pos_j,pos_k,aux = RASToIJK.MultiplyDoublePoint(currentPoint + (1,))
@@ -63,19 +195,24 @@ class WarpEffectTool():
     currentIndex = slice(k-r,k+r+1), slice(j-r,j+r+1), slice(i-r,i+r+1)
     return currentIndex
 
-  def applyChanges(self):
+  def applyChanges(self, boxLayers = None, delta = None, deltaIndex = None):
     # remove redo options
     SmudgeModule.SmudgeModuleLogic().removeRedoNodes()
-    # flatten when there already 3 layers
-    if TransformsUtil.TransformsUtilLogic().getNumberOfLayers(self.warpNode) == 3:
-      TransformsUtil.TransformsUtilLogic().flattenTransform(self.warpNode, False)
-    # harden transform
-    self.warpNode.HardenTransform()
+    operation = self.parameterNode.GetParameter("currentEffect")
+    if delta is not None:
+      # delta already added to the flat layer at deltaIndex
+      entry = WarpUndoStack.WarpUndoStack.get().commitDelta(self.warpNode, operation, delta, deltaIndex)
+    elif boxLayers is None:
+      # harden transform and keep the change in the undo stack
+      self.warpNode.HardenTransform()
+      entry = WarpUndoStack.WarpUndoStack.get().commit(self.warpNode, operation)
+    else:
+      # compose the layers given by boxes
+      entry = WarpUndoStack.WarpUndoStack.get().commitBoxes(self.warpNode, operation, boxLayers)
     self.warpNode.InvokeEvent(slicer.vtkMRMLGridTransformNode.TransformModifiedEvent)
-    # save tool name
-    self.parameterNode.SetParameter("lastOperation", self.parameterNode.GetParameter("currentEffect"))
     # update gui
     self.parameterNode.SetParameter("warpModified", str(int(self.parameterNode.GetParameter("warpModified"))+1))
+    return entry
 
   def cleanup(self):
     pass
@@ -87,6 +224,9 @@ class WarpEffectTool():
     for inst in cls._instances:
       inst.cleanup()
     cls._instances = set()
+    if WarpEffectTool.worker is not None:
+      WarpEffectTool.worker.stop()
+      WarpEffectTool.worker = None
 
 
 
@@ -150,20 +290,32 @@ class LinearEffectTool(PointerEffect.PointerEffectTool, WarpEffectTool):
 
 class SmudgeEffectTool(PointerEffect.CircleEffectTool, WarpEffectTool):
 
-  def __init__(self, sliceWidget, auxTransformNode):
+  def __init__(self, sliceWidget, auxGrid):
 
     WarpEffectTool.__init__(self)
     PointerEffect.CircleEffectTool.__init__(self, sliceWidget)
         
-    # transform data
-    self.auxTransformNode = auxTransformNode
-    self.auxTransformSpacing = self.auxTransformNode.GetTransformFromParent().GetDisplacementGrid().GetSpacing()[0] # Asume isotropic!
-    self.auxTransfromRASToIJK = TransformsUtil.TransformsUtilLogic().getTransformRASToIJK(self.auxTransformNode)  
+    # transform data. tiled grid, only allocated where the strokes go
+    self.auxGrid = auxGrid
+    self.auxTransformSpacing = self.auxGrid.spacing[0] # Asume isotropic!
+    self.worker = self.getWorker()
+    # refresh only this view while dragging
+    self.renderScheduler = RenderScheduler.RenderScheduler(self.sliceView)
 
     self.previousPoint = [0,0,0]   
     self.smudging = False
     self.outOfBounds = False
 
+    # swept stroke: pending mouse position applied when the event queue is processed
+    self.pendingPoint = None
+    self.sweptTimer = qt.QTimer()
+    self.sweptTimer.setSingleShot(True)
+    self.sweptTimer.setInterval(0)
+    self.sweptTimer.connect('timeout()', self.applyPendingPath)
+
+    # kernel is re-created only if parameters change
+    self.addObserver(self.parameterNode, vtk.vtkCommand.ModifiedEvent, self.resetKernel)
+
 
   def processEvent(self, caller=None, event=None):
 
@@ -172,47 +324,107 @@ class SmudgeEffectTool(PointerEffect.CircleEffectTool, WarpEffectTool):
     if event == 'LeftButtonPressEvent':
       self.smudging = True
       self.outOfBounds = False
-      self.warpNode.SetAndObserveTransformNodeID(self.auxTransformNode.GetID())    
-      self.auxTransformArray = slicer.util.array(self.auxTransformNode.GetID())
+      # only the slab around this slice is shown while dragging
+      sliceToRAS = self.sliceLogic.GetSliceNode().GetSliceToRAS()
+      self.auxGrid.setDisplayRegion(self.auxGrid.getPlaneBox([sliceToRAS.GetElement(i,3) for i in range(3)], [sliceToRAS.GetElement(i,2) for i in range(3)]))
+      self.warpNode.SetAndObserveTransformNodeID(self.auxGrid.transformNode.GetID())
+      self.renderScheduler.begin(self.auxGrid.transformNode)
       xy = self.interactor.GetEventPosition()
       xyToRAS = self.sliceLogic.GetSliceNode().GetXYToRAS()
       self.previousPoint = xyToRAS.MultiplyDoublePoint( (xy[0], xy[1], 0, 1) )[0:3]
-    elif event == 'LeftButtonReleaseEvent' and not self.outOfBounds:
+    elif event == 'LeftButtonReleaseEvent':
+      self.applyPendingPath()
+      # finish queued stroke
+      self.worker.wait()
+      self.worker.processCompleted()
+      if self.outOfBounds:
+        self.renderScheduler.end()
+        return
       self.smudging = False
-      # smooth
-      if int(self.parameterNode.GetParameter("SmudgePostSmoothing")):
-        sigma = float(self.parameterNode.GetParameter("SmudgeSigma")) / 100.0 * float(self.parameterNode.GetParameter("SmudgeRadius")) / self.auxTransformSpacing
-        self.auxTransformArray[:] = np.stack([ndimage.gaussian_filter(self.auxTransformArray[:,:,:,i], sigma) for i in range(3)], 3).squeeze()
-      # apply
-      self.applyChanges()
-      self.auxTransformArray[:] = np.zeros(self.auxTransformArray.shape)
+      self.warpNode.SetAndObserveTransformNodeID(None)
+      if self.auxGrid.tiles:
+        # smooth
+        if int(self.parameterNode.GetParameter("SmudgePostSmoothing")):
+          sigma = float(self.parameterNode.GetParameter("SmudgeSigma")) / 100.0 * float(self.parameterNode.GetParameter("SmudgeRadius")) / self.auxTransformSpacing
+          self.auxGrid.smooth(sigma)
+        # compose only where the tiles are
+        self.applyChanges(self.auxGrid.getBoxLayers())
+        # release tiles
+        self.auxGrid.reset()
+      # refresh all views
+      self.renderScheduler.end()
       qt.QApplication.setOverrideCursor(qt.QCursor(qt.Qt.ArrowCursor))
 
 
     elif event == 'MouseMoveEvent':
       if self.smudging:
-
-        r = int(round(float(self.parameterNode.GetParameter("SmudgeRadius")) / self.auxTransformSpacing))
-        sphereResult = self.createSphere(r)
         currentPoint = self.eventPositionToRAS()
-        currentIndex = self.getCurrentIndex(r, currentPoint, self.auxTransfromRASToIJK)
-
-        # apply to transform array
-        try:
-          self.auxTransformArray[currentIndex] += np.stack([(sphereResult) * i for i in (np.array(self.previousPoint) - np.array(currentPoint))],3) # original
-        except ValueError:
-          qt.QMessageBox.warning(qt.QWidget(), '', 'Out of bounds. Try expanding the grid.')
-          self.smudging = False
-          self.outOfBounds = True
-          self.cursorOn()
-
-        # update view
-        self.auxTransformNode.Modified()
-        # update previous point
-        self.previousPoint = currentPoint
+        if int(self.parameterNode.GetParameter("SmudgeSwept")):
+          # collapse events queued until the timer fires into one path update
+          self.pendingPoint = currentPoint
+          if not self.sweptTimer.isActive():
+            self.sweptTimer.start()
+        else:
+          self.smudgeTo(currentPoint)
+
+  def applyPendingPath(self):
+    self.sweptTimer.stop()
+    if self.smudging and self.pendingPoint is not None:
+      self.smudgeTo(self.pendingPoint, swept=True)
+    self.pendingPoint = None
+
+  def smudgeTo(self, currentPoint, swept=False):
+    r = int(round(float(self.parameterNode.GetParameter("SmudgeRadius")) / self.auxTransformSpacing))
+    displacement = [p - c for p,c in zip(self.previousPoint, currentPoint)]
+
+    # region in the aux grid
+    if swept:
+      currentIndex = self.getSweptIndex(r, self.previousPoint, currentPoint, self.auxGrid.RASToIJK)
+    else:
+      currentIndex = self.getCurrentIndex(r, currentPoint, self.auxGrid.RASToIJK)
+    try:
+      self.auxGrid.checkIndex(currentIndex)
+    except GridTiles.OutOfGridError:
+      self.onOutOfBounds()
+      return
+
+    # add to the aux grid tiles in the worker
+    sphereResult = self.createSphere(r)
+    if swept:
+      sweptTable = self.getSweptTable(r, *self.getKernelParameters())
+      self.worker.submit(self.accumulateSweptDisplacement, self.auxGrid, self.previousPoint, currentPoint, sphereResult, sweptTable, displacement,
+                         onDone=self.updateView, onError=self.onComputeError)
+    else:
+      self.worker.submit(self.accumulateDisplacement, self.auxGrid, currentIndex, sphereResult, displacement,
+                         onDone=self.updateView, onError=self.onComputeError)
+
+    # update previous point
+    self.previousPoint = currentPoint
+
+  def updateView(self):
+    # written regions to the display grid
+    if self.auxGrid.updateDisplay():
+      self.renderScheduler.requestRender()
+
+  def onComputeError(self, error):
+    if isinstance(error, GridTiles.OutOfGridError):
+      self.onOutOfBounds()
+    else:
+      ComputeWorker.logError(error)
+
+  def onOutOfBounds(self):
+    if self.outOfBounds:
+      return
+    qt.QMessageBox.warning(qt.QWidget(), '', 'Out of bounds. Try expanding the grid.')
+    self.smudging = False
+    self.outOfBounds = True
+    self.cursorOn()
 
   def cleanup(self):
-    slicer.mrmlScene.RemoveNode(self.auxTransformNode)
+    self.sweptTimer.stop()
+    self.worker.wait()
+    self.renderScheduler.end()
+    self.auxGrid.cleanup()
     WarpEffectTool.cleanup(self)
     PointerEffect.CircleEffectTool.cleanup(self)
 
@@ -223,63 +435,134 @@ class SmudgeEffectTool(PointerEffect.CircleEffectTool, WarpEffectTool):
 #
 
 class SmoothEffectTool(PointerEffect.CircleEffectTool, WarpEffectTool):
+  """
+  Smooths the warp field (flat layer plus first layer) and adds the change to
+  the flat layer, so that it is kept in the undo stack. The first layer is left
+  untouched, as with undo all.
+  """
 
   def __init__(self, sliceWidget):
 
     WarpEffectTool.__init__(self)
     PointerEffect.CircleEffectTool.__init__(self, sliceWidget)
     
-    self.transformArray = slicer.util.array(self.warpNode.GetID())
+    self.flatLayer = None
+    self.transformArray = None # flat layer array, the one changed
+    self.firstArray = None
     self.warpRASToIJK = TransformsUtil.TransformsUtilLogic().getTransformRASToIJK(self.warpNode)
     self.warpSpacing = TransformsUtil.TransformsUtilLogic().getGridDefinition(self.warpNode)[2][0]
 
     self.smoothContent = []
+    self.smoothKey = None # parameters smoothContent was computed with
     self.currentIndex = []
     self.preview = False
+    self.previewContent = None # (array, content, index) added to the flat layer
+    self.worker = self.getWorker()
+    self.renderScheduler = RenderScheduler.RenderScheduler(self.sliceView)
+
+    # kernel is re-created only if parameters change
+    self.addObserver(self.parameterNode, vtk.vtkCommand.ModifiedEvent, self.resetKernel)
     
   def processEvent(self, caller=None, event=None):
 
     PointerEffect.CircleEffectTool.processEvent(self, caller, event)
 
-    if self.preview and event in ['LeftButtonDoubleClickEvent','LeftButtonReleaseEvent']:
+    # smoothContent is computed in the worker and added to or removed from the warp array here
+    if event in ['LeftButtonDoubleClickEvent','LeftButtonReleaseEvent']:
       # undo pressed opperation. sometimes double click is called before release and viceversa
-      self.transformArray[self.currentIndex] -= self.smoothContent
       self.preview = False
+      self.renderScheduler.end()
+      self.removePreview()
+
+    if event in ['LeftButtonDoubleClickEvent','LeftButtonPressEvent']:
+      self.flatLayer, self.transformArray, self.firstArray = WarpUndoStack.WarpUndoStack.get().getEditLayers(self.warpNode)
+      if self.flatLayer is None:
+        return
 
     if event =='LeftButtonDoubleClickEvent':
-      self.calculateSmoothContent()
-      self.transformArray[self.currentIndex] += self.smoothContent
-      self.applyChanges()
+      # reuses the preview if nothing changed since
+      self.submitSmooth(self.applySmooth)
     elif event == 'LeftButtonReleaseEvent':
-      self.warpNode.InvokeEvent(slicer.vtkMRMLGridTransformNode.TransformModifiedEvent)
       qt.QApplication.setOverrideCursor(qt.QCursor(qt.Qt.ArrowCursor))
     elif event == 'LeftButtonPressEvent':
       self.preview = True
-      self.calculateSmoothContent()
-      self.transformArray[self.currentIndex] += self.smoothContent
-      self.warpNode.InvokeEvent(slicer.vtkMRMLGridTransformNode.TransformModifiedEvent)
-      
+      self.renderScheduler.begin(self.warpNode)
+      self.submitSmooth(self.addPreview)
+
+  def submitSmooth(self, onDone):
+    # previous callbacks are run first, so that the warp array is not written while the worker reads it
+    self.worker.wait()
+    self.worker.processCompleted()
+    self.worker.submit(self.calculateSmoothContent, *self.getSmoothParameters(), onDone=onDone)
+
+  def addPreview(self):
+    if not self.preview or self.previewContent is not None:
+      return
+    self.previewContent = (self.transformArray, self.smoothContent, self.currentIndex)
+    self.transformArray[self.currentIndex] += self.smoothContent
+    self.renderScheduler.requestRender()
+
+  def removePreview(self):
+    if self.previewContent is None:
+      return
+    array, content, index = self.previewContent
+    self.previewContent = None
+    array[index] -= content
+    self.updateView()
+
+  def updateView(self):
+    self.warpNode.InvokeEvent(slicer.vtkMRMLGridTransformNode.TransformModifiedEvent)
+
+  def applySmooth(self):
+    # the flat layer is changed in place and the delta pushed to the undo stack
+    self.transformArray[self.currentIndex] += self.smoothContent
+    self.applyChanges(delta=self.smoothContent, deltaIndex=self.currentIndex)
+    # only keep the delta until it is committed
+    self.smoothContent = []
+    self.smoothKey = None
 
-  def calculateSmoothContent(self):
+  def getSmoothParameters(self):
+    # read from the parameter node and view in the main thread
     sigma = float(self.parameterNode.GetParameter("SmoothSigma")) / self.warpSpacing
     r = int(round(float(self.parameterNode.GetParameter("SmoothRadius")) / self.warpSpacing))
     if int(self.parameterNode.GetParameter("SmoothUseRadius")):
       # get shpere and index
       sphereResult = self.createSphere(r)
-      currentPoint = self.eventPositionToRAS()
-      self.currentIndex = self.getCurrentIndex(r, currentPoint, self.warpRASToIJK)   
-      # gaussian filter for each component 
-      self.smoothContent =  np.stack([ndimage.gaussian_filter(self.transformArray[self.currentIndex + (slice(i,i+1),)], sigma) for i in range(3)], 3).squeeze()
-      # substract original
-      self.smoothContent = self.smoothContent - self.transformArray[self.currentIndex]
-      # modulate result with the sphere
-      self.smoothContent = np.stack([self.smoothContent[:,:,:,i] * sphereResult for i in range(3)], 3).squeeze()
+      currentIndex = self.getCurrentIndex(r, self.eventPositionToRAS(), self.warpRASToIJK)
     else: # maximum radius: take all warp field
-      self.smoothContent =  np.stack([ndimage.gaussian_filter(self.transformArray[:,:,:,i], sigma) for i in range(3)], 3).squeeze()
-      self.smoothContent = self.smoothContent - self.transformArray
-      self.currentIndex = tuple([slice(0,s) for s in self.smoothContent.shape])
+      sphereResult = None
+      currentIndex = tuple([slice(0,s) for s in self.transformArray.shape[:3]])
+    hardness = self.getKernelParameters()[0]
+    # the writers of the layers mark their grids modified (the preview does not). the transform is modified on render
+    firstGrid = TransformsUtil.TransformsUtilLogic().getLayers(self.warpNode)[-1].grid
+    gridMTimes = (self.flatLayer.GetDisplacementGrid().GetMTime(), firstGrid.GetMTime() if firstGrid else None)
+    key = (tuple((s.start, s.stop) for s in currentIndex), r, sigma, hardness, sphereResult is None, id(self.transformArray), gridMTimes)
+    return sigma, currentIndex, sphereResult, key
+
+  def calculateSmoothContent(self, sigma, currentIndex, sphereResult, key):
+    # worker thread. only reads the warp arrays
+    if key == self.smoothKey:
+      return
+    self.currentIndex = currentIndex
+    self.smoothKey = key
+    original = np.array(self.transformArray[self.currentIndex])
+    if self.firstArray is not None:
+      original += self.firstArray[self.currentIndex]
+    # gaussian filter for each component, in a copy
+    self.smoothContent = np.array(original)
+    GaussianSmoothing.smoothDisplacementInPlace(self.smoothContent, sigma)
+    # substract original
+    np.subtract(self.smoothContent, original, out=self.smoothContent)
+    if sphereResult is not None:
+      # modulate result with the sphere
+      self.smoothContent *= sphereResult[:,:,:,np.newaxis]
 
   def cleanup(self):
+    self.worker.wait()
+    self.preview = False
+    self.worker.processCompleted()
+    self.renderScheduler.end()
+    self.removePreview()
     WarpEffectTool.cleanup(self)
     PointerEffect.CircleEffectTool.cleanup(self)
 
@@ -293,6 +576,16 @@ class SnapEffectTool(PointerEffect.DrawEffectTool, WarpEffectTool):
 
   globalSourceFiducial = None
   globalTargetFiducial = None
+  # landmark system kept between persistent operations
+  persistentWarp = None
+  # last applied landmark warp, to bring the new points back when it is undone, and its undo entry
+  lastWarpTransform = None
+  lastWarpEntry = None
+  # model bounds and cut contours. key includes the models modified time
+  _boundsCache = {}
+  _contourCache = OrderedDict()
+  _contourCacheSize = 256
+  cutThreads = os.cpu_count() or 1
 
     
   def __init__(self, sliceWidget):
@@ -331,18 +624,18 @@ class SnapEffectTool(PointerEffect.DrawEffectTool, WarpEffectTool):
         self.auxNodes.append(targetFiducial)
 
       # undo last transform and apply to source
+      lastUndone = False
       if self.globalSourceFiducial.GetNumberOfControlPoints() > 0:
-        # undo and get transform
-        lastLayerID = TransformsUtil.TransformsUtilLogic().removeLastLayer(self.warpNode) 
-        self.auxNodes.append(slicer.util.getNode(lastLayerID))
-        # apply
-        sourceFiducial.ApplyTransform(slicer.util.getNode(lastLayerID).GetTransformFromParent()) 
+        lastUndone = self.undoLastWarp()
+        if not lastUndone:
+          # other operations since. start a new one
+          self.endPersistent()
+      if lastUndone:
+        sourceFiducial.ApplyTransform(self.lastWarpTransform)
         if sourceCurve: # is drawing
-          sourceCurve.ApplyTransform(slicer.util.getNode(lastLayerID).GetTransformFromParent()) # apply for visualization
+          sourceCurve.ApplyTransform(self.lastWarpTransform) # apply for visualization
         else:
-          targetFiducial.ApplyTransform(slicer.util.getNode(lastLayerID).GetTransformFromParent()) # apply to target as well (was warped)
-      else:
-        lastLayerID = None
+          targetFiducial.ApplyTransform(self.lastWarpTransform) # apply to target as well (was warped)
 
       # add new fiducials to global
       self.copyControlPoints(sourceFiducial, self.globalSourceFiducial)
@@ -362,9 +655,8 @@ class SnapEffectTool(PointerEffect.DrawEffectTool, WarpEffectTool):
 
       if not self.userConfirmOperation():
         self.removeLastPoints()
-        if lastLayerID:
-          self.warpNode.SetAndObserveTransformNodeID(lastLayerID)
-          self.applyChanges()
+        if lastUndone:
+          WarpUndoStack.WarpUndoStack.get().redo(self.warpNode)
         self.endOperation()
         self.globalSourceFiducial.GetDisplayNode().SetVisibility(0)
         return
@@ -384,6 +676,15 @@ class SnapEffectTool(PointerEffect.DrawEffectTool, WarpEffectTool):
      self.addFiducialToHierarchy(fiducialName)
      self.globalTargetFiducial.RemoveAllControlPoints()
      self.globalSourceFiducial.RemoveAllControlPoints()
+     type(self).persistentWarp = None
+     type(self).lastWarpTransform = None
+     type(self).lastWarpEntry = None
+
+  def undoLastWarp(self):
+    # undo the last landmark warp. False if it is no longer the last operation in the undo stack
+    if self.lastWarpEntry is None:
+      return False
+    return WarpUndoStack.WarpUndoStack.get().undo(self.warpNode, self.lastWarpEntry) is not None
 
   def computeAndApply(self):
     # compute warp
@@ -395,7 +696,8 @@ class SnapEffectTool(PointerEffect.DrawEffectTool, WarpEffectTool):
     self.delay()
     # apply
     self.warpNode.SetAndObserveTransformNodeID(landmarkWarp.GetID())
-    self.applyChanges()
+    type(self).lastWarpEntry = self.applyChanges()
+    type(self).lastWarpTransform = landmarkWarp.GetTransformFromParent()
     # remove
     slicer.mrmlScene.RemoveNode(landmarkWarp)
 
@@ -433,26 +735,23 @@ class SnapEffectTool(PointerEffect.DrawEffectTool, WarpEffectTool):
     if resampledPoints.GetNumberOfPoints() <= 1:
       return (None,)*3
 
-    # get closest model sliced
-    slicedModel, originalModel = self.sliceClosestModel(resampledPoints.GetPoint(0))
+    # get closest model contour
+    contour, originalModel = self.sliceClosestModel(resampledPoints.GetPoint(0))
 
-    if not slicedModel:
+    if not contour:
       return (None,)*3
-    
-    self.auxNodes.append(slicedModel)
-
-    # resample sourceCurve in sliced model with same amount of points
-    targetCurve = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsCurveNode')
-    targetCurve.GetDisplayNode().SetVisibility(0)
-    targetCurve.SetControlPointPositionsWorld(resampledPoints)
-    targetCurve.SetCurveTypeToShortestDistanceOnSurface(slicedModel)
-    targetCurve.ResampleCurveSurface(sampleDistance, slicer.vtkMRMLModelNode().SafeDownCast(slicedModel), 0.0025)
-    targetCurve.ResampleCurveWorld(targetCurve.GetCurveLengthWorld() / max((sourceCurve.GetNumberOfControlPoints() - 1), 1))
-    self.auxNodes.append(targetCurve)
-      
+
+    # corresponding points along the contour, same amount of points
+    import vtk.util.numpy_support
+    sourceArray = vtk.util.numpy_support.vtk_to_numpy(resampledPoints.GetData()).reshape(-1,3)
+    targetPoints = vtk.vtkPoints()
+    targetPoints.SetData(vtk.util.numpy_support.numpy_to_vtk(self.matchContour(sourceArray, contour), deep=True))
+
     # curve to fiducial
     sourceFiducial = self.curveToFiducial(sourceCurve)
-    targetFiducial = self.curveToFiducial(targetCurve)
+    targetFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
+    targetFiducial.GetDisplayNode().SetVisibility(0)
+    targetFiducial.SetControlPointPositionsWorld(targetPoints)
 
     # set name
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
@@ -493,15 +792,14 @@ class SnapEffectTool(PointerEffect.DrawEffectTool, WarpEffectTool):
     # add drawing
     sourceFiducial.GetControlPointPositionsWorld(sourcePoints)
     targetFiducial.GetControlPointPositionsWorld(targetPoints)
-    # thin plate
-    transform=vtk.vtkThinPlateSplineTransform()
-    transform.SetSourceLandmarks(sourcePoints)
-    transform.SetTargetLandmarks(targetPoints)
-    transform.SetBasisToR()
-    transform.Inverse()
-    transformNode=slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode')
-    transformNode.SetAndObserveTransformFromParent(transform)
-    return transformNode
+    # thin plate, in a coarse grid around the points
+    import vtk.util.numpy_support
+    sourceArray = vtk.util.numpy_support.vtk_to_numpy(sourcePoints.GetData()).reshape(-1,3)
+    targetArray = vtk.util.numpy_support.vtk_to_numpy(targetPoints.GetData()).reshape(-1,3)
+    preview = LandmarkWarp.ThinPlateSplinePreview(sourceArray)
+    preview.setTargetPoints(targetArray)
+    size, origin, spacing = preview.getPreviewGrid(targetArray)
+    return TransformsUtil.TransformsUtilLogic().gridTransformFromArray(preview.evaluate(size, origin, spacing), origin, spacing, toParent=True)
 
 
   def addFiducialToHierarchy(self, fiducialName):
@@ -522,16 +820,8 @@ class SnapEffectTool(PointerEffect.DrawEffectTool, WarpEffectTool):
       qt.QCoreApplication.processEvents(qt.QEventLoop.AllEvents, 100)
 
   def getFixedPoints(self):
-    points = vtk.vtkPoints()
-    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    nMarkups = slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLMarkupsFiducialNode')
-    for i in range(nMarkups):
-      markupNode = slicer.mrmlScene.GetNthNodeByClass(i, 'vtkMRMLMarkupsFiducialNode')
-      if 'drawing' in shNode.GetItemAttributeNames(shNode.GetItemByDataNode(markupNode)) and int(shNode.GetItemAttribute(shNode.GetItemByDataNode(markupNode),'drawing')):
-        p = vtk.vtkPoints()
-        markupNode.GetControlPointPositionsWorld(p)
-        points.InsertPoints(points.GetNumberOfPoints(), p.GetNumberOfPoints(), 0, p)
-    return points
+    # (N,3) array of the enabled drawings points
+    return SceneRegistry.SceneRegistry.get().getFixedPoints()
 
 
   def computeWarp(self, sourceDrawing, targetDrawing):
@@ -541,41 +831,52 @@ class SnapEffectTool(PointerEffect.DrawEffectTool, WarpEffectTool):
     # add drawing
     sourceDrawing.GetControlPointPositionsWorld(sourcePoints)
     targetDrawing.GetControlPointPositionsWorld(targetPoints)
-    # add fixed points
-    fixedPoints = self.getFixedPoints()
-    sourcePoints.InsertPoints(sourcePoints.GetNumberOfPoints(), fixedPoints.GetNumberOfPoints(), 0, fixedPoints)
-    targetPoints.InsertPoints(targetPoints.GetNumberOfPoints(), fixedPoints.GetNumberOfPoints(), 0, fixedPoints) 
+    # fixed points
+    fixedArray = self.getFixedPoints()
 
-    # source and target fiducials
-    sourceFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
-    targetFiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
-    sourceFiducial.SetControlPointPositionsWorld(sourcePoints)
-    targetFiducial.SetControlPointPositionsWorld(targetPoints)
+    import vtk.util.numpy_support
+    sourceArray = vtk.util.numpy_support.vtk_to_numpy(sourcePoints.GetData()).reshape(-1,3)
+    targetArray = vtk.util.numpy_support.vtk_to_numpy(targetPoints.GetData()).reshape(-1,3)
 
-    # generate aux nodes
+    # gauss rbf in process, only in the support of the landmarks
+    rbfWarp = self.updatePersistentWarp(sourceArray, targetArray, fixedArray)
     size,origin,spacing = TransformsUtil.TransformsUtilLogic().getGridDefinition(self.warpNode)
-    auxVolumeNode = TransformsUtil.TransformsUtilLogic().createEmpyVolume(size,origin,spacing)
-    outWarp = TransformsUtil.TransformsUtilLogic().emptyGridTransform(size,origin,spacing)
+    displacement, blockOrigin = rbfWarp.computeGrid(size, origin, spacing)
 
-    parameters = {}
-    parameters["plmslc_landwarp_fixed_volume"] = auxVolumeNode.GetID()
-    parameters["plmslc_landwarp_moving_volume"] = auxVolumeNode.GetID()
-    parameters["plmslc_landwarp_fixed_fiducials"] = targetFiducial.GetID()
-    parameters["plmslc_landwarp_moving_fiducials"] = sourceFiducial.GetID()
-    parameters["plmslc_landwarp_output_vf"] = outWarp.GetID()
-    parameters["plmslc_landwarp_rbf_type"] = "gauss"
-    parameters["plmslc_landwarp_rbf_radius"] = float(self.parameterNode.GetParameter("DrawSpread"))
-    parameters["plmslc_landwarp_stiffness"] = float(self.parameterNode.GetParameter("DrawStiffness"))
-
-    cli = slicer.cli.run(slicer.modules.plastimatch_slicer_landwarp, None, parameters, wait_for_completion=True, update_display=False)
-
-    slicer.mrmlScene.RemoveNode(auxVolumeNode)
-    slicer.mrmlScene.RemoveNode(sourceFiducial)
-    slicer.mrmlScene.RemoveNode(targetFiducial)
+    if displacement is None: # outside of the grid
+      outWarp = TransformsUtil.TransformsUtilLogic().emptyGridTransform([1,1,1], origin, spacing)
+    else:
+      outWarp = TransformsUtil.TransformsUtilLogic().gridTransformFromArray(displacement, blockOrigin, spacing)
 
     return outWarp
 
    
+  def updatePersistentWarp(self, sourceArray, targetArray, fixedArray):
+    """
+    Landmark system with the fixed points followed by the operations points.
+    When the operations points only changed at the end (new operation or last
+    one removed), the previous system is updated instead of solved again.
+    """
+    radius = float(self.parameterNode.GetParameter("DrawSpread"))
+    stiffness = float(self.parameterNode.GetParameter("DrawStiffness"))
+    rbfClass = LandmarkWarp.WendlandRBFWarp if self.parameterNode.GetParameter("DrawRBFType") == "wendland" else LandmarkWarp.GaussianRBFWarp
+    rbfWarp = type(self).persistentWarp
+    if type(rbfWarp) is rbfClass and rbfWarp.radius == radius and rbfWarp.stiffness == stiffness and np.array_equal(rbfWarp.fixedArray, fixedArray):
+      n = min(len(targetArray), len(rbfWarp.targetArray))
+      if np.array_equal(rbfWarp.targetArray[:n], targetArray[:n]) and np.array_equal(rbfWarp.sourceArray[:n], sourceArray[:n]):
+        if len(targetArray) > n:
+          rbfWarp.addLandmarks(sourceArray[n:], targetArray[n:])
+        elif len(rbfWarp.targetArray) > n:
+          rbfWarp.removeLandmarks(len(rbfWarp.targetArray) - n)
+        rbfWarp.sourceArray, rbfWarp.targetArray = sourceArray.copy(), targetArray.copy()
+        return rbfWarp
+    # new system
+    rbfWarp = rbfClass(radius, stiffness)
+    rbfWarp.fit(np.vstack((fixedArray, sourceArray)), np.vstack((fixedArray, targetArray)))
+    rbfWarp.fixedArray, rbfWarp.sourceArray, rbfWarp.targetArray = fixedArray.copy(), sourceArray.copy(), targetArray.copy()
+    type(self).persistentWarp = rbfWarp
+    return rbfWarp
+
   def curveToFiducial(self, curve):
     fiducial = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode')
     fiducial.GetDisplayNode().SetVisibility(0)
@@ -588,49 +889,154 @@ class SnapEffectTool(PointerEffect.DrawEffectTool, WarpEffectTool):
     originalModel = None
     # set up plane
     normal = np.array([float(self.sliceLogic.GetSliceNode().GetName()==name) for name in ['Yellow','Green','Red']])
+    axis = int(np.argmax(normal))
+    # candidate models: visible ones whose bounds intersect the plane, closest bounds first
+    models, bounds = self.getModelBounds()
+    crossing = (bounds[:,2*axis] <= point[axis]) & (bounds[:,2*axis+1] >= point[axis]) if len(models) else np.zeros(0, dtype=bool)
+    lower = np.delete(bounds[:,0::2], axis, axis=1)
+    upper = np.delete(bounds[:,1::2], axis, axis=1)
+    inPlanePoint = np.delete(np.array(point), axis)
+    boundsDistance = (np.maximum(np.maximum(lower - inPlanePoint, inPlanePoint - upper), 0) ** 2).sum(axis=1)
+    # init output
+    globalMinDistance = 1000
+    outPolyData = None
+    candidates = np.flatnonzero(crossing)[np.argsort(boundsDistance[crossing], kind='stable')]
+    # cut by batches of closest candidates, each batch in parallel
+    with ThreadPoolExecutor(self.cutThreads) as executor:
+      for batchStart in range(0, len(candidates), self.cutThreads):
+        batch = [i for i in candidates[batchStart:batchStart+self.cutThreads] if boundsDistance[i] < globalMinDistance]
+        if not batch: # the rest are further away
+          break
+        contours = self.getModelContours([models[i] for i in batch], axis, point[axis], executor)
+        for i, (cutterOutput, pointsLocator) in zip(batch, contours):
+          if cutterOutput.GetNumberOfCells(): # model intersects with plane
+            # get distance from input point to closest point in model
+            closestPoint = cutterOutput.GetPoint(pointsLocator.FindClosestPoint(point))
+            localMinDistance = vtk.vtkMath().Distance2BetweenPoints(closestPoint, point)
+            if localMinDistance < globalMinDistance: # new min
+              outPolyData = cutterOutput
+              globalMinDistance = localMinDistance
+              originalModel = models[i]
+    # return in case no model found
+    if not originalModel:
+      return False, False
+    return outPolyData, originalModel
+
+  def getContourPolylines(self, contour):
+    # join the cut segments into polylines. (m,3) arrays, closed ones end with the first point
+    stripper = vtk.vtkStripper()
+    stripper.SetInputData(contour)
+    stripper.JoinContiguousSegmentsOn()
+    stripper.Update()
+    output = stripper.GetOutput()
+    import vtk.util.numpy_support
+    points = vtk.util.numpy_support.vtk_to_numpy(output.GetPoints().GetData()).astype(float)
+    polylines = []
+    ids = vtk.vtkIdList()
+    lines = output.GetLines()
+    lines.InitTraversal()
+    while lines.GetNextCell(ids):
+      if ids.GetNumberOfIds() > 1:
+        polylines.append(points[[ids.GetId(i) for i in range(ids.GetNumberOfIds())]])
+    return polylines
+
+  def projectToPolyline(self, points, polyline):
+    # closest point in the polyline for each point. returns arc length position and distance
+    A = polyline[:-1]
+    AB = polyline[1:] - A
+    segmentLength2 = np.maximum((AB ** 2).sum(axis=1), 1e-12)
+    AP = points[:,np.newaxis,:] - A[np.newaxis,:,:]
+    t = np.clip((AP * AB[np.newaxis]).sum(axis=2) / segmentLength2, 0, 1)
+    distance2 = ((AP - t[:,:,np.newaxis] * AB[np.newaxis]) ** 2).sum(axis=2)
+    segment = np.argmin(distance2, axis=1)
+    arcStart = np.concatenate(([0], np.cumsum(np.sqrt(segmentLength2))))
+    rows = np.arange(len(points))
+    position = arcStart[segment] + t[rows, segment] * np.sqrt(segmentLength2[segment])
+    return position, np.sqrt(distance2[rows, segment])
+
+  def matchContour(self, sourceArray, contour):
+    """
+    Target points corresponding to the source points (drawing) in the contour:
+    source points are projected to the closest polyline of the contour, which is
+    then walked by arc length, from the projection of the first point to the one
+    of the last, in as many equally spaced points.
+    """
+    polylines = self.getContourPolylines(contour)
+    # polyline closest to the drawing start
+    distances = [self.projectToPolyline(sourceArray[:1], polyline)[1][0] for polyline in polylines]
+    polyline = polylines[int(np.argmin(distances))]
+    arcLength = np.concatenate(([0], np.cumsum(np.linalg.norm(np.diff(polyline, axis=0), axis=1))))
+    totalLength = arcLength[-1]
+    position, _ = self.projectToPolyline(sourceArray, polyline)
+    closed = np.allclose(polyline[0], polyline[-1]) and len(polyline) > 2
+    if closed and totalLength > 0:
+      # follow the drawing direction around the loop
+      steps = np.diff(position)
+      steps = (steps + totalLength / 2) % totalLength - totalLength / 2
+      targetPosition = (position[0] + np.linspace(0, steps.sum(), len(sourceArray))) % totalLength
+    else:
+      targetPosition = np.linspace(position[0], position[-1], len(sourceArray))
+    return np.column_stack([np.interp(targetPosition, arcLength, polyline[:,i]) for i in range(3)])
+
+  def getModelBounds(self):
+    # visible models with cells and their bounds. bounds cached by model modified time
+    models = []
+    bounds = []
+    for model in SceneRegistry.SceneRegistry.get().getModels():
+      polyData = model.GetPolyData()
+      if model.GetDisplayNode() and model.GetDisplayNode().GetVisibility() and polyData and polyData.GetNumberOfCells() > 1: # model visible and cells available
+        key = (model.GetID(), model.GetMTime(), polyData.GetMTime())
+        if key not in self._boundsCache:
+          self._boundsCache[key] = polyData.GetBounds()
+        models.append(model)
+        bounds.append(self._boundsCache[key])
+    # drop stale entries
+    if len(self._boundsCache) > 2 * len(models) + 16:
+      current = set((m.GetID(), m.GetMTime(), m.GetPolyData().GetMTime()) for m in models)
+      for key in list(self._boundsCache.keys()):
+        if key not in current:
+          del self._boundsCache[key]
+    return models, np.array(bounds).reshape(-1,6)
+
+  @classmethod
+  def getModelContours(cls, models, axis, offset, executor):
+    # cuts of the models with the axis aligned plane, and their point locators. cached per
+    # (plane, model modified time) so that strokes on the same slice reuse them. the
+    # missing ones are cut in the executor (vtk releases the GIL while filtering)
+    keys = [(axis, round(float(offset), 3), model.GetID(), model.GetMTime(), model.GetPolyData().GetMTime()) for model in models]
+    missing = [(key, model) for key, model in zip(keys, models) if key not in cls._contourCache]
+    cuts = executor.map(lambda model: cls.cutModel(model.GetPolyData(), axis, offset), [model for key, model in missing])
+    for (key, model), cut in zip(missing, cuts):
+      cls._contourCache[key] = cut
+    contours = []
+    for key in keys:
+      cls._contourCache.move_to_end(key)
+      contours.append(cls._contourCache[key])
+    while len(cls._contourCache) > cls._contourCacheSize:
+      cls._contourCache.popitem(last=False)
+    return contours
+
+  @staticmethod
+  def cutModel(polyData, axis, offset):
+    # cut of polyData with the axis aligned plane and its point locator. thread safe (one per polyData)
+    normal = [0,0,0]
+    normal[axis] = 1
+    origin = [0,0,0]
+    origin[axis] = offset
     plane = vtk.vtkPlane()
-    plane.SetOrigin(point) # point in plane
+    plane.SetOrigin(origin)
     plane.SetNormal(normal)
-    # set up cutter
     cutter = vtk.vtkCutter()
     cutter.SetCutFunction(plane)
     cutter.SetGenerateCutScalars(0)
+    cutter.SetInputData(polyData)
     cutter.Update()
-    # init point locator and output
-    pointsLocator = vtk.vtkPointLocator() 
-    globalMinDistance = 1000
-    outPolyData = vtk.vtkPolyData()
-    # iterate over models in scene
-    nModels = slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLModelNode')
-    for i in range(nModels):
-      model = slicer.mrmlScene.GetNthNodeByClass(i, 'vtkMRMLModelNode')
-      polyData = model.GetPolyData()
-      if model.GetDisplayNode() and model.GetDisplayNode().GetVisibility() and polyData.GetNumberOfCells() > 1: # model visible and cells available
-        cutter.SetInputData(polyData)
-        cutter.Update()
-        cutterOutput = cutter.GetOutput()
-        if cutterOutput.GetNumberOfCells(): # model intersects with plane
-          # get distance from input point to closest point in model
-          pointsLocator.SetDataSet(cutterOutput)
-          pointsLocator.BuildLocator()
-          closestPoint = cutterOutput.GetPoint(pointsLocator.FindClosestPoint(point))
-          localMinDistance = vtk.vtkMath().Distance2BetweenPoints(closestPoint, point)
-          if localMinDistance < globalMinDistance: # new min
-            outPolyData.DeepCopy(cutterOutput)
-            globalMinDistance = localMinDistance
-            originalModel = model
-    # return in case no model found
-    if not originalModel:
-      return False, False
-    # generate output
-    triangulator = vtk.vtkContourTriangulator()
-    triangulator.SetInputData(outPolyData)
-    triangulator.Update()
-    slicedModel = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode')
-    slicedModel.SetAndObservePolyData(triangulator.GetOutput())
-    slicedModel.CreateDefaultDisplayNodes()
-    slicedModel.GetDisplayNode().SetVisibility(0)
-    return slicedModel, originalModel
+    cutterOutput = cutter.GetOutput()
+    pointsLocator = vtk.vtkPointLocator()
+    if cutterOutput.GetNumberOfCells():
+      pointsLocator.SetDataSet(cutterOutput)
+      pointsLocator.BuildLocator()
+    return cutterOutput, pointsLocator
 
   def cleanup(self):
     if self.globalSourceFiducial and self.globalSourceFiducial.GetNumberOfControlPoints():
@@ -645,4 +1051,7 @@ class SnapEffectTool(PointerEffect.DrawEffectTool, WarpEffectTool):
     slicer.mrmlScene.RemoveNode(cls.globalTargetFiducial)
     cls.globalSourceFiducial = None
     cls.globalTargetFiducial = None
+    cls.persistentWarp = None
+    cls.lastWarpTransform = None
+    cls.lastWarpEntry = None
 
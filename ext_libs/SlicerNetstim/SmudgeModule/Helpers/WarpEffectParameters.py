@@ -7,6 +7,7 @@ from slicer.util import VTKObservationMixin
 import SmudgeModule
 import TransformsUtil
 from . import WarpEffect
+from . import GridTiles
 
 
 class WarpAbstractEffect(VTKObservationMixin):
@@ -225,6 +226,12 @@ class SmudgeEffectParameters(WarpAbstractEffect):
     self.postSmoothingSlider.setToolTip('Smoothing sigma as a percentage of the radius.')
     advancedParametersGroupBox.layout().addRow("Sigma (% Radius):", self.postSmoothingSlider)
 
+    # swept stroke
+    self.sweptCheckBox = qt.QCheckBox('')
+    self.sweptCheckBox.setChecked(int(self.parameterNode.GetParameter("SmudgeSwept")))
+    self.sweptCheckBox.setToolTip('Enable to apply the brush along the whole mouse path. Gives smoother results for fast movements.')
+    advancedParametersGroupBox.layout().addRow("Swept Stroke:", self.sweptCheckBox)
+
     # expand edge
     self.expandGridSlider = ctk.ctkSliderWidget()
     self.expandGridSlider.singleStep = 1
@@ -248,6 +255,7 @@ class SmudgeEffectParameters(WarpAbstractEffect):
     self.forceSlider.connect('valueChanged(double)', self.updateMRMLFromGUI)
     self.postSmoothingCheckBox.connect('toggled(bool)', self.updateMRMLFromGUI)
     self.postSmoothingSlider.connect('valueChanged(double)', self.updateMRMLFromGUI)
+    self.sweptCheckBox.connect('toggled(bool)', self.updateMRMLFromGUI)
     self.expandGridSlider.connect('valueChanged(double)', self.updateMRMLFromGUI)
     self.expandGridSlider.connect('valueChanged(double)', self.resetEffect)
     self.gridBoundsCheckBox.connect('toggled(bool)', self.onGridBoundsCheckBox)
@@ -260,9 +268,9 @@ class SmudgeEffectParameters(WarpAbstractEffect):
   def onEffectButtonClicked(self):
     super().onEffectButtonClicked()
     size,origin,spacing = self.getExpandedGrid()
-    auxTransformNode = TransformsUtil.TransformsUtilLogic().emptyGridTransform(size, origin, spacing)
+    auxGrid = GridTiles.TiledDisplacementGrid(size, origin, spacing)
     for sliceWidget in self.sliceWidgets():
-      WarpEffect.SmudgeEffectTool(sliceWidget, auxTransformNode)
+      WarpEffect.SmudgeEffectTool(sliceWidget, auxGrid)
 
   def updateGuiFromMRML(self, caller=None, event=None):
     super().updateGuiFromMRML(caller,event)
@@ -287,6 +295,7 @@ class SmudgeEffectParameters(WarpAbstractEffect):
     self.parameterNode.SetParameter("SmudgeForce", str(self.forceSlider.value) )
     self.parameterNode.SetParameter("SmudgePostSmoothing", str(int(self.postSmoothingCheckBox.isChecked())))
     self.parameterNode.SetParameter("SmudgeSigma", str(self.postSmoothingSlider.value) )
+    self.parameterNode.SetParameter("SmudgeSwept", str(int(self.sweptCheckBox.isChecked())))
     self.parameterNode.SetParameter("expandGrid", str(self.expandGridSlider.value) )
 
 
@@ -356,6 +365,13 @@ class DrawEffectParameters(WarpAbstractEffect):
     self.stiffnessSlider.setToolTip('Regularization parameter.')
     self.parametersFrame.layout().addRow("Stiffness:", self.stiffnessSlider)
 
+    # rbf type
+    self.rbfTypeComboBox = qt.QComboBox()
+    self.rbfTypeComboBox.addItems(['gauss', 'wendland'])
+    self.rbfTypeComboBox.currentText = self.parameterNode.GetParameter("DrawRBFType")
+    self.rbfTypeComboBox.setToolTip('Radial basis function. Wendland has compact support (twice the spread) and scales to many fixed points.')
+    self.parametersFrame.layout().addRow("RBF Type:", self.rbfTypeComboBox)
+
     # persistent mode
     self.persistentCheckBox = qt.QCheckBox()
     self.parametersFrame.layout().addRow("Persistent:", self.persistentCheckBox)
@@ -386,6 +402,7 @@ class DrawEffectParameters(WarpAbstractEffect):
     self.spreadSlider.connect('valueChanged(double)', self.updateMRMLFromGUI)
     self.sampleDistanceSlider.connect('valueChanged(double)', self.updateMRMLFromGUI)
     self.stiffnessSlider.connect('valueChanged(double)', self.updateMRMLFromGUI)
+    self.rbfTypeComboBox.connect('currentIndexChanged(int)', self.updateMRMLFromGUI)
     self.persistentCheckBox.connect('stateChanged(int)', self.updateMRMLFromGUI)
 
   def onEffectButtonClicked(self):
@@ -405,6 +422,7 @@ class DrawEffectParameters(WarpAbstractEffect):
     self.parameterNode.SetParameter("DrawSpread", str(self.spreadSlider.value))
     self.parameterNode.SetParameter("DrawSampleDistance", str(self.sampleDistanceSlider.value))
     self.parameterNode.SetParameter("DrawStiffness", str(self.stiffnessSlider.value))
+    self.parameterNode.SetParameter("DrawRBFType", self.rbfTypeComboBox.currentText)
     self.parameterNode.SetParameter("DrawPersistent", str(int(self.persistentCheckBox.checked)))
 
   def updateGuiFromMRML(self, caller=None, event=None):
@@ -415,18 +433,27 @@ class DrawEffectParameters(WarpAbstractEffect):
   
   def onRecalculateButton(self):
     if self.tool.globalSourceFiducial.GetNumberOfControlPoints() > 0:
-      lastLayerID = TransformsUtil.TransformsUtilLogic().removeLastLayer(self.parameterNode.GetNodeReference("warpID")) 
-      slicer.mrmlScene.RemoveNode(slicer.util.getNode(lastLayerID))
+      if not self.undoLastWarp():
+        return
+      SmudgeModule.SmudgeModuleLogic().removeRedoNodes()
       self.tool.computeAndApply()
 
   def onRemoveLastButton(self):
     if self.tool.globalSourceFiducial.GetNumberOfControlPoints() > 0:
-      lastLayerID = TransformsUtil.TransformsUtilLogic().removeLastLayer(self.parameterNode.GetNodeReference("warpID")) 
-      slicer.mrmlScene.RemoveNode(slicer.util.getNode(lastLayerID))
+      if not self.undoLastWarp():
+        return
+      SmudgeModule.SmudgeModuleLogic().removeRedoNodes()
       self.tool.removeLastPoints()
       if self.tool.globalSourceFiducial.GetNumberOfControlPoints() > 0:
         self.tool.computeAndApply()
   
+  def undoLastWarp(self):
+    if self.tool.undoLastWarp():
+      return True
+    qt.QMessageBox.warning(qt.QWidget(), '', 'The last persistent operation is no longer the last operation and can not be updated. Its target points are set as fixed.')
+    self.tool.endPersistent()
+    return False
+
   def onSetTargetAsFixedButton(self):
     if self.tool.globalSourceFiducial.GetNumberOfControlPoints() > 0:
       self.tool.endPersistent()
@@ -494,7 +521,8 @@ class SmoothEffectParameters(WarpAbstractEffect):
   def updateGuiFromMRML(self, caller=None, event=None):
     super().updateGuiFromMRML(caller, event)
     warpNumberOfComponents = TransformsUtil.TransformsUtilLogic().getNumberOfLayers(self.parameterNode.GetNodeReference("warpID"))
-    self.effectButton.enabled = warpNumberOfComponents == 1
+    # smooth works on the first layer and the flat layer of the edits (see WarpUndoStack.getEditLayers)
+    self.effectButton.enabled = warpNumberOfComponents in [1, 2]
     radius = float(self.parameterNode.GetParameter("SmoothRadius"))
     self.radiusSlider.setValue( radius )
     if radius < self.radiusSlider.minimum or radius > self.radiusSlider.maximum:
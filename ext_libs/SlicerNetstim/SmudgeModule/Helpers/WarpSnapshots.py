@@ -0,0 +1,146 @@
+import slicer
+import numpy as np
+import zlib
+from slicer.util import VTKObservationMixin
+
+import TransformsUtil
+import SmudgeModule
+
+
+class CompactGrid():
+  """
+  (k,j,i,3) displacement array stored in blocks of blockSlices k slices, as
+  float16 or as int16 scaled by the block maximum. Blocks where that would
+  make an error above maxError (mm) are kept as float32. Blocks are optionally
+  zlib compressed.
+  """
+
+  blockSlices = 16
+
+  def __init__(self, array, precision, compress, maxError):
+    self.shape = array.shape
+    self.compress = compress
+    self.blocks = [] # (data, dtype, scale)
+    for start in range(0, self.shape[0], self.blockSlices):
+      self.blocks.append(self.encodeBlock(array[start:start+self.blockSlices], precision, maxError))
+    self.nbytes = sum(len(data) if isinstance(data, bytes) else data.nbytes for data, dtype, scale in self.blocks)
+
+  def encodeBlock(self, block, precision, maxError):
+    maxValue = float(np.abs(block).max()) if block.size else 0.0
+    if precision == 'float16' and max(maxValue * 2**-11, 2**-24) <= maxError and maxValue < 65504:
+      data, scale = block.astype(np.float16), 1.0
+    elif precision == 'int16' and maxValue / 32767 / 2 <= maxError:
+      scale = maxValue / 32767 if maxValue else 1.0
+      data = np.round(block / scale).astype(np.int16)
+    else:
+      data, scale = np.array(block, dtype=np.float32), 1.0
+    if self.compress:
+      return zlib.compress(data.tobytes(), 1), data.dtype, scale
+    return data, data.dtype, scale
+
+  def decode(self):
+    array = np.empty(self.shape, dtype=np.float32)
+    for n, (data, dtype, scale) in enumerate(self.blocks):
+      start = n * self.blockSlices
+      block = array[start:start+self.blockSlices]
+      if isinstance(data, bytes):
+        data = np.frombuffer(zlib.decompress(data), dtype=dtype).reshape(block.shape)
+      block[:] = data
+      if scale != 1.0:
+        block *= scale
+    return array
+
+
+class WarpSnapshots(VTKObservationMixin):
+  """
+  Compact copies of the inactive saved warps. When a warp stops being the
+  current one its displacement is moved to a CompactGrid (SnapshotPrecision
+  parameter: float32, float16 or int16, SnapshotCompress and SnapshotMaxError
+  in mm) and the node is left with a single voxel grid, marked with the
+  compactAttribute and a 'Compact' description. The displacement is restored
+  when the warp is activated again, or when its layers are accessed through
+  TransformsUtilLogic.getLayers (i.e. a saved warp picked elsewhere). Compact
+  warps are expanded while the scene is saved, so that their full grid is
+  written.
+  """
+
+  instance = None
+  compactAttribute = 'compactWarp'
+
+  @classmethod
+  def get(cls):
+    if cls.instance is None:
+      cls.instance = cls()
+    return cls.instance
+
+  @classmethod
+  def release(cls):
+    if cls.instance is not None:
+      cls.instance.removeObservers()
+      TransformsUtil.TransformsUtilLogic.layerAccessCallbacks.remove(cls.instance.onLayerAccess)
+      cls.instance = None
+
+  def __init__(self):
+    VTKObservationMixin.__init__(self)
+    self.parameterNode = SmudgeModule.SmudgeModuleLogic().getParameterNode()
+    self.snapshots = {} # node ID: (CompactGrid, origin, spacing)
+    self.savingNodes = [] # expanded for the scene save
+    self.addObserver(slicer.mrmlScene, slicer.mrmlScene.StartSaveEvent, self.onStartSave)
+    self.addObserver(slicer.mrmlScene, slicer.mrmlScene.EndSaveEvent, self.onEndSave)
+    TransformsUtil.TransformsUtilLogic.layerAccessCallbacks.append(self.onLayerAccess)
+
+  def isEnabled(self):
+    return self.parameterNode.GetParameter("SnapshotPrecision") != 'float32' or bool(int(self.parameterNode.GetParameter("SnapshotCompress")))
+
+  def compact(self, node):
+    if not self.isEnabled() or node.GetID() in self.snapshots:
+      return
+    logic = TransformsUtil.TransformsUtilLogic()
+    size, origin, spacing = logic.getGridDefinition(node)
+    # flatten to a single grid
+    layers = logic.getLayers(node)
+    if len(layers) != 1 or logic.getGridLayerArray(layers[0], size, origin, spacing) is None:
+      logic.resampleToGridTransform(node, size, origin, spacing)
+    array = logic.getLayers(node)[0].getArray()
+    grid = CompactGrid(array, self.parameterNode.GetParameter("SnapshotPrecision"), bool(int(self.parameterNode.GetParameter("SnapshotCompress"))), float(self.parameterNode.GetParameter("SnapshotMaxError")))
+    self.snapshots[node.GetID()] = (grid, origin, spacing)
+    logic.emptyGridTransform([1,1,1], origin, spacing, node)
+    node.SetAttribute(self.compactAttribute, '1')
+    node.SetDescription('Compact')
+
+  def expand(self, node):
+    if node.GetID() not in self.snapshots:
+      return
+    grid, origin, spacing = self.snapshots.pop(node.GetID())
+    TransformsUtil.TransformsUtilLogic().gridTransformFromArray(grid.decode(), origin, spacing, node)
+    node.RemoveAttribute(self.compactAttribute)
+    node.SetDescription('')
+
+  def discard(self, node):
+    self.snapshots.pop(node.GetID(), None)
+
+  def clear(self):
+    self.snapshots = {}
+    self.savingNodes = []
+
+  def onLayerAccess(self, node):
+    # expanded for good: it stays so until it is activated and left again
+    if self.snapshots and node.GetID() in self.snapshots:
+      self.expand(node)
+
+  def onStartSave(self, caller=None, event=None):
+    # the node files would be written with the single voxel grid
+    for nodeID in list(self.snapshots):
+      node = slicer.mrmlScene.GetNodeByID(nodeID)
+      if node is None:
+        self.snapshots.pop(nodeID)
+        continue
+      self.expand(node)
+      self.savingNodes.append(node)
+
+  def onEndSave(self, caller=None, event=None):
+    currentWarpNode = self.parameterNode.GetNodeReference("warpID")
+    for node in self.savingNodes:
+      if node != currentWarpNode and node.GetScene() is not None:
+        self.compact(node)
+    self.savingNodes = []
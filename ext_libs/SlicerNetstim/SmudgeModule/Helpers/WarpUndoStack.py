@@ -0,0 +1,234 @@
+import slicer
+import numpy as np
+import zlib
+
+import TransformsUtil
+import SmudgeModule
+from . import JacobianMonitor
+
+
+class UndoEntry():
+  # change of the flat warp layer made by one operation, by tiles
+  def __init__(self, operation, tiles, indexes = None):
+    self.operation = operation
+    self.tiles = tiles # [(index, shape, data)]
+    self.nbytes = sum(len(data) if isinstance(data, bytes) else data.nbytes for index, shape, data in tiles)
+    # boxes changed. default the bounding box of the tiles
+    if indexes is None:
+      indexes = [tuple(slice(min(t[0][a].start for t in tiles), max(t[0][a].stop for t in tiles)) for a in range(3))] if tiles else []
+    self.indexes = indexes
+    self.drawingID = None # drawing disabled on undo
+
+
+class WarpUndoStack():
+  """
+  Undo/redo of the warp edits as sparse displacement deltas. Each operation
+  hardened on the warp is composed in place into the grid layer right above
+  the first one (see TransformsUtilLogic.flattenInPlace), so that the warp
+  stays as [flat grid, first layer]. The change of the flat grid is kept in
+  tiles of tileSize^3 voxels, leaving out unchanged tiles, and undo/redo
+  subtract/add them in place. The oldest entries are dropped when the entries
+  take more than the UndoMaxMemory parameter (MB).
+  """
+
+  tileSize = 16
+  compress = False # zlib the tiles
+
+  instance = None
+
+  @classmethod
+  def get(cls):
+    if cls.instance is None:
+      cls.instance = cls()
+    return cls.instance
+
+  def __init__(self):
+    self.parameterNode = SmudgeModule.SmudgeModuleLogic().getParameterNode()
+    self.undoEntries = []
+    self.redoEntries = []
+    self.flatLayer = None
+
+  def getFlatLayer(self, warpNode, adopt=False):
+    # flat layer of the warp (the one added by the stack) and its array. entries are dropped if it changed (other warp, resampled)
+    logic = TransformsUtil.TransformsUtilLogic()
+    flatLayer, flatArray = None, None
+    if warpNode:
+      layers = logic.getLayers(warpNode)
+      if len(layers) > 1 and (adopt or self.isFlatLayer(layers[-2].transform)):
+        size, origin, spacing = logic.getGridDefinition(warpNode)
+        flatArray = logic.getGridLayerArray(layers[-2], size, origin, spacing)
+        flatLayer = layers[-2].transform if flatArray is not None else None
+    if not self.isFlatLayer(flatLayer):
+      self.clear()
+      self.flatLayer = flatLayer
+    return flatLayer, flatArray
+
+  def isFlatLayer(self, layer):
+    if layer is None or self.flatLayer is None:
+      return False
+    return layer.GetAddressAsString('vtkObject') == self.flatLayer.GetAddressAsString('vtkObject')
+
+  def commit(self, warpNode, operation):
+    """
+    Compose the layers hardened on the warp into its flat layer (added the first
+    time) and push the change. Returns the new entry.
+    """
+    logic = TransformsUtil.TransformsUtilLogic()
+    if logic.getNumberOfLayers(warpNode) < 2:
+      return None
+    flatLayer, flatArray = self.getOrAddFlatLayer(warpNode)
+    layers = logic.getLayers(warpNode)
+    size, origin, spacing = logic.getGridDefinition(warpNode)
+    index, previous = logic.flattenInPlace(warpNode, layers, size, origin, spacing)
+    tiles = self.getTiles(flatArray[index] - previous, index) if index is not None else []
+    return self.push(warpNode, UndoEntry(operation, tiles))
+
+  def commitBoxes(self, warpNode, operation, boxLayers):
+    """
+    Compose new layers given by boxes (see TransformsUtilLogic.composeBoxesInPlace)
+    into the flat layer of the warp and push the change. Returns the new entry.
+    """
+    logic = TransformsUtil.TransformsUtilLogic()
+    flatLayer, flatArray = self.getOrAddFlatLayer(warpNode)
+    size, origin, spacing = logic.getGridDefinition(warpNode)
+    updated = logic.composeBoxesInPlace(flatLayer, boxLayers, size, origin, spacing)
+    tiles = []
+    for index, previous in updated:
+      tiles.extend(self.getTiles(flatArray[index] - previous, index))
+    return self.push(warpNode, UndoEntry(operation, tiles, [index for index, previous in updated]))
+
+  def commitDelta(self, warpNode, operation, delta, index):
+    """
+    Push a change already added in place to the flat layer array at index
+    (i.e. by the smooth effect). Returns the new entry.
+    """
+    flatLayer, flatArray = self.getFlatLayer(warpNode)
+    if flatLayer is None:
+      return None
+    flatLayer.GetDisplacementGrid().Modified()
+    flatLayer.Modified()
+    return self.push(warpNode, UndoEntry(operation, self.getTiles(delta, index), [index]))
+
+  def getEditLayers(self, warpNode):
+    """
+    Flat layer, flat array and first layer array (None if it is not a grid over
+    the warp grid) of a warp made of the first layer and at most one grid above
+    it, which is taken as the flat layer. A single layer warp gets an empty flat
+    layer. Returns Nones for other warps.
+    """
+    logic = TransformsUtil.TransformsUtilLogic()
+    numberOfLayers = logic.getNumberOfLayers(warpNode)
+    if numberOfLayers == 1:
+      self.getOrAddFlatLayer(warpNode)
+    elif numberOfLayers != 2:
+      return None, None, None
+    flatLayer, flatArray = self.getFlatLayer(warpNode, adopt=True)
+    if flatLayer is None:
+      return None, None, None
+    size, origin, spacing = logic.getGridDefinition(warpNode)
+    firstArray = logic.getGridLayerArray(logic.getLayers(warpNode)[-1], size, origin, spacing)
+    return flatLayer, flatArray, firstArray
+
+  def getOrAddFlatLayer(self, warpNode):
+    flatLayer, flatArray = self.getFlatLayer(warpNode)
+    if flatLayer is None:
+      TransformsUtil.TransformsUtilLogic().addFlatLayer(warpNode)
+      flatLayer, flatArray = self.getFlatLayer(warpNode, adopt=True)
+    return flatLayer, flatArray
+
+  def push(self, warpNode, entry):
+    self.undoEntries.append(entry)
+    self.redoEntries = []
+    self.dropOldEntries()
+    self.updateParameters()
+    JacobianMonitor.JacobianMonitor.get().update(warpNode, entry.indexes)
+    return entry
+
+  def undo(self, warpNode, expectedEntry=None):
+    # undo the last entry. if expectedEntry is given, only if it is the last one
+    flatLayer, flatArray = self.getFlatLayer(warpNode)
+    if not self.undoEntries:
+      return None
+    if expectedEntry is not None and self.undoEntries[-1] is not expectedEntry:
+      return None
+    entry = self.undoEntries.pop()
+    self.applyEntry(entry, -1, warpNode, flatLayer, flatArray)
+    self.redoEntries.append(entry)
+    self.updateParameters()
+    return entry
+
+  def redo(self, warpNode):
+    flatLayer, flatArray = self.getFlatLayer(warpNode)
+    if not self.redoEntries:
+      return None
+    entry = self.redoEntries.pop()
+    self.applyEntry(entry, 1, warpNode, flatLayer, flatArray)
+    self.undoEntries.append(entry)
+    self.updateParameters()
+    return entry
+
+  def undoAll(self, warpNode):
+    # clear the flat layer. one redo brings it back
+    flatLayer, flatArray = self.getFlatLayer(warpNode)
+    if flatLayer is None:
+      return None
+    entry = UndoEntry('UndoAll', self.getTiles(flatArray, tuple(slice(0, n) for n in flatArray.shape[:3])))
+    if not entry.tiles and not self.undoEntries:
+      return None
+    self.applyEntry(entry, -1, warpNode, flatLayer, flatArray)
+    self.undoEntries = []
+    self.redoEntries = [entry]
+    self.dropOldEntries()
+    self.updateParameters()
+    return entry
+
+  def clearRedo(self):
+    # redo entries dropped, i.e. after a new operation
+    entries, self.redoEntries = self.redoEntries, []
+    self.updateParameters()
+    return entries
+
+  def clear(self):
+    self.undoEntries = []
+    self.redoEntries = []
+    self.flatLayer = None
+    self.updateParameters()
+
+  def getTiles(self, delta, index):
+    # non zero tiles of delta, which is located at index in the flat array
+    tiles = []
+    offset = [s.start for s in index]
+    for k in range(0, delta.shape[0], self.tileSize):
+      for j in range(0, delta.shape[1], self.tileSize):
+        for i in range(0, delta.shape[2], self.tileSize):
+          tile = delta[k:k+self.tileSize, j:j+self.tileSize, i:i+self.tileSize]
+          if not tile.any():
+            continue
+          tileIndex = tuple(slice(o + a, o + a + n) for o,a,n in zip(offset, (k,j,i), tile.shape[:3]))
+          tile = np.ascontiguousarray(tile, dtype=np.float32)
+          data = zlib.compress(tile.tobytes(), 1) if self.compress else tile
+          tiles.append((tileIndex, tile.shape, data))
+    return tiles
+
+  def applyEntry(self, entry, sign, warpNode, flatLayer, flatArray):
+    for index, shape, data in entry.tiles:
+      if isinstance(data, bytes):
+        data = np.frombuffer(zlib.decompress(data), dtype=np.float32).reshape(shape)
+      flatArray[index] += sign * data
+    if entry.tiles:
+      flatLayer.GetDisplacementGrid().Modified()
+      flatLayer.Modified()
+      warpNode.InvokeEvent(slicer.vtkMRMLGridTransformNode.TransformModifiedEvent)
+      JacobianMonitor.JacobianMonitor.get().update(warpNode, entry.indexes)
+
+  def dropOldEntries(self):
+    # the last entry is always kept
+    maxBytes = float(self.parameterNode.GetParameter("UndoMaxMemory")) * 2**20
+    while len(self.undoEntries) > 1 and sum(e.nbytes for e in self.undoEntries + self.redoEntries) > maxBytes:
+      self.undoEntries.pop(0)
+
+  def updateParameters(self):
+    wasModifying = self.parameterNode.StartModify()
+    self.parameterNode.SetParameter("undoSteps", str(len(self.undoEntries)))
+    self.parameterNode.SetParameter("redoSteps", str(len(self.redoEntries)))
+    self.parameterNode.EndModify(wasModifying)
@@ -4,6 +4,7 @@ import os
 import numpy as np
 
 import SmudgeModule, ImportAtlas, TransformsUtil
+from . import WarpSnapshots
 
 
 class treeViewFilter(object):
@@ -150,6 +151,7 @@ class treeViewSavedWarpFilter(treeViewFilter):
 
   def deleteFunction(self, node):
     if node and node.GetDescription() != 'Current':
+      WarpSnapshots.WarpSnapshots.get().discard(node)
       super().deleteFunction(node)
 
   def addFunction(self):
@@ -170,14 +172,7 @@ class treeViewSavedWarpFilter(treeViewFilter):
     newWarpNode = shNode.GetItemDataNode(clonedID)
     newWarpNode.SetName(slicer.mrmlScene.GenerateUniqueName('SavedWarp'))
     size, origin, spacing = TransformsUtil.TransformsUtilLogic().getGridDefinition(newWarpNode)
-    outNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode')
-    referenceVolume = TransformsUtil.TransformsUtilLogic().createEmpyVolume(size, origin, spacing)    
-    transformsLogic = slicer.modules.transforms.logic()
-    transformsLogic.ConvertToGridTransform(newWarpNode, referenceVolume, outNode)
-    newWarpNode.SetAndObserveTransformFromParent(outNode.GetTransformFromParent())
-    # remove aux
-    slicer.mrmlScene.RemoveNode(outNode)
-    slicer.mrmlScene.RemoveNode(referenceVolume)
+    TransformsUtil.TransformsUtilLogic().resampleToGridTransform(newWarpNode, size, origin, spacing)
     # restore visibility
     warpNode.GetDisplayNode().SetVisibility(vis)
     # simulate double click to change
@@ -186,6 +181,8 @@ class treeViewSavedWarpFilter(treeViewFilter):
 
   def doubleClickFunction(self, node):
     SmudgeModule.SmudgeModuleLogic().removeRedoNodes()
+    # restore the displacement if it was compacted
+    WarpSnapshots.WarpSnapshots.get().expand(node)
     # reset descriptions
     previousWarpNode = self.parameterNode.GetNodeReference("warpID")
     previousWarpNode.SetDescription('')
@@ -198,6 +195,9 @@ class treeViewSavedWarpFilter(treeViewFilter):
     node.SetDescription('Current')
     # change parameter node
     self.parameterNode.SetNodeReferenceID("warpID", node.GetID())
+    # keep the previous warp compact while inactive
+    if previousWarpNode.GetID() != node.GetID():
+      WarpSnapshots.WarpSnapshots.get().compact(previousWarpNode)
     
 
 
@@ -15,7 +15,7 @@ import uuid
 from PythonQt import BoolResult
 
 # netstim helpers
-from Helpers import WarpEffect, FunctionsUtil, Toolbar, WarpEffectParameters, treeView
+from Helpers import WarpEffect, FunctionsUtil, Toolbar, WarpEffectParameters, treeView, SceneRegistry, WarpUndoStack, WarpSnapshots, JacobianMonitor
 
 # netstim modules
 import TransformsUtil
@@ -189,6 +189,13 @@ class SmudgeModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     modelsFormLayout = qt.QGridLayout(modelsCollapsibleButton)    
     modelsFormLayout.addWidget(treeView.WarpDriveTreeView(),0,0)
 
+    # folding monitor
+    self.jacobianLabel = qt.QLabel('')
+    self.jacobianLabel.setToolTip('Jacobian determinant of the current warp. Folding voxels have a determinant <= 0.')
+    modelsFormLayout.addWidget(self.jacobianLabel,1,0)
+    self.foldsOverlayCheckBox = qt.QCheckBox('Show folding voxels')
+    modelsFormLayout.addWidget(self.foldsOverlayCheckBox,2,0)
+
     self.layout.addStretch(0)
 
     # connections
@@ -200,6 +207,7 @@ class SmudgeModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     self.undoAllButton.connect("clicked(bool)", self.onUndoAllButton)
     self.undoButton.connect("clicked(bool)", self.onUndoButton)
     self.redoButton.connect("clicked(bool)", self.onRedoButton)
+    self.foldsOverlayCheckBox.connect("toggled(bool)", lambda b: self.parameterNode.SetParameter("JacobianOverlay", str(int(b))))
 
     for button in [self.undoAllButton, self.undoButton, self.redoButton]:
       button.connect("pressed()", self.onEditButtonPressed)
@@ -326,9 +334,18 @@ class SmudgeModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     warpNode = self.parameterNode.GetNodeReference("warpID")
     warpNumberOfComponents = TransformsUtil.TransformsUtilLogic().getNumberOfLayers(warpNode)
     # undo redo button
-    self.undoButton.setEnabled(warpNumberOfComponents > 1 and not self.parameterNode.GetNodeReferenceID("redoTransformID") and self.parameterNode.GetParameter("lastOperation") != "UndoAll") 
-    self.redoButton.setEnabled(self.parameterNode.GetNodeReferenceID("redoTransformID")) 
+    self.undoButton.setEnabled(int(self.parameterNode.GetParameter("undoSteps")) > 0)
+    self.redoButton.setEnabled(int(self.parameterNode.GetParameter("redoSteps")) > 0)
     self.undoAllButton.setEnabled(warpNumberOfComponents > 1)
+    # folding monitor
+    jacobianMonitor = JacobianMonitor.JacobianMonitor.get()
+    if not jacobianMonitor.check(warpNode):
+      self.jacobianLabel.setText('')
+    elif jacobianMonitor.computing: # first pass in the worker. the label is set when done
+      self.jacobianLabel.setText('Folding voxels: computing...')
+    else:
+      self.jacobianLabel.setText('Folding voxels: %s   Jacobian min / max: %s / %s' % tuple(self.parameterNode.GetParameter(p) for p in ["JacobianFolds", "JacobianMin", "JacobianMax"]))
+    self.foldsOverlayCheckBox.setChecked(bool(int(self.parameterNode.GetParameter("JacobianOverlay"))))
     # resolution change
     if float(self.parameterNode.GetParameter("resolution")) != TransformsUtil.TransformsUtilLogic().getGridDefinition(warpNode)[2][0]:
       self.exit()
@@ -383,35 +400,22 @@ class SmudgeModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     qt.QApplication.setOverrideCursor(qt.QCursor(qt.Qt.ArrowCursor))
 
   def onUndoAllButton(self):
-    self.parameterNode.SetParameter("lastOperation","UndoAll")
-    warpNode = self.parameterNode.GetNodeReference("warpID")
-    if TransformsUtil.TransformsUtilLogic().getNumberOfLayers(warpNode) > 2:
-      TransformsUtil.TransformsUtilLogic().flattenTransform(warpNode, False)
-    self.onUndoButton()
+    # drawings of the undone operations are kept
+    SmudgeModuleLogic().removeRedoNodes()
+    WarpUndoStack.WarpUndoStack.get().undoAll(self.parameterNode.GetNodeReference("warpID"))
 
   def onUndoButton(self):
-    # remove redo nodes
-    SmudgeModuleLogic().removeRedoNodes()
-    # apply and save redo transform
-    redoTransformID = TransformsUtil.TransformsUtilLogic().removeLastLayer(self.parameterNode.GetNodeReference("warpID"))
-    self.parameterNode.SetNodeReferenceID("redoTransformID", redoTransformID)
+    entry = WarpUndoStack.WarpUndoStack.get().undo(self.parameterNode.GetNodeReference("warpID"))
     # disable last drawing if was a drawing operation
-    if self.parameterNode.GetParameter("lastOperation") == 'Draw':
-      SmudgeModuleLogic().disableLastDrawing()
+    if entry and entry.operation == 'Draw':
+      entry.drawingID = SmudgeModuleLogic().disableLastDrawing()
 
   def onRedoButton(self):
-    # get nodes
-    warpNode = self.parameterNode.GetNodeReference("warpID")
-    redoTransformNode = self.parameterNode.GetNodeReference("redoTransformID")
-    # apply
-    warpNode.SetAndObserveTransformNodeID(redoTransformNode.GetID())
-    warpNode.HardenTransform()
-    # delete redo transform
-    slicer.mrmlScene.RemoveNode(redoTransformNode)
-    self.parameterNode.SetNodeReferenceID("redoTransformID", None)
+    entry = WarpUndoStack.WarpUndoStack.get().redo(self.parameterNode.GetNodeReference("warpID"))
     # re enable drawing
-    if self.parameterNode.GetParameter("lastOperation") == 'Draw':
-      SmudgeModuleLogic().enableLastDrawing()
+    if entry and entry.drawingID is not None:
+      SmudgeModuleLogic().enableDrawing(entry.drawingID)
+      entry.drawingID = None
 
 
   def exit(self):
@@ -420,6 +424,8 @@ class SmudgeModuleWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
 
   def cleanup(self):
     self.exit()
+    SceneRegistry.SceneRegistry.release()
+    WarpSnapshots.WarpSnapshots.release()
 
   def enter(self):
     WarpEffectParameters.NoneEffectParameters.activateNoneEffect()
@@ -447,10 +453,21 @@ class SmudgeModuleLogic(ScriptedLoadableModuleLogic):
   def createParameterNode(self):
     node = ScriptedLoadableModuleLogic.createParameterNode(self)
     node.SetNodeReferenceID("warpID", None)
-    node.SetNodeReferenceID("redoTransformID", None)
-    node.SetParameter("lastDrawingID", "-1")
+    node.SetParameter("undoSteps","0")
+    node.SetParameter("redoSteps","0")
+    node.SetParameter("UndoMaxMemory","512") # MB
+    node.SetParameter("PyramidMaxMemory","2048") # MB
+    node.SetParameter("PyramidDiskCache","0")
+    # inactive saved warps
+    node.SetParameter("SnapshotPrecision","float32") # float32, float16 or int16
+    node.SetParameter("SnapshotCompress","0")
+    node.SetParameter("SnapshotMaxError","0.01") # mm
+    # folding monitor
+    node.SetParameter("JacobianMin","1")
+    node.SetParameter("JacobianMax","1")
+    node.SetParameter("JacobianFolds","0")
+    node.SetParameter("JacobianOverlay","0")
     node.SetParameter("warpModified","0")
-    node.SetParameter("lastOperation","")
     node.SetParameter("currentEfect","None")
     # linear
     node.SetNodeReferenceID("LinearTransform", None)
@@ -460,6 +477,7 @@ class SmudgeModuleLogic(ScriptedLoadableModuleLogic):
     node.SetParameter("SmudgeForce", "100")
     node.SetParameter("SmudgePostSmoothing", "0")
     node.SetParameter("SmudgeSigma", "10")
+    node.SetParameter("SmudgeSwept", "0")
     node.SetParameter("expandGrid", "0")
     node.SetParameter("maxRadius", "50")
     node.SetNodeReferenceID("gridBoundsROIID", None)
@@ -468,6 +486,7 @@ class SmudgeModuleLogic(ScriptedLoadableModuleLogic):
     node.SetParameter("DrawSampleDistance", "1.5")
     node.SetParameter("DrawStiffness", "0.1")
     node.SetParameter("DrawPersistent", "0")
+    node.SetParameter("DrawRBFType", "gauss")
     # Smooth
     node.SetParameter("SmoothRadius", "25")
     node.SetParameter("SmoothHardness", "50")
@@ -488,59 +507,36 @@ class SmudgeModuleLogic(ScriptedLoadableModuleLogic):
     return node
 
   def removeRedoNodes(self):
-    parameterNode = self.getParameterNode()
-    # redo transform
-    redoTransformID = parameterNode.GetNodeReferenceID("redoTransformID")
-    if redoTransformID:
-      slicer.mrmlScene.RemoveNode(slicer.util.getNode(redoTransformID))
-      parameterNode.SetNodeReferenceID("redoTransformID", None)
-    # last drawing
-    lastDrawingID = int(parameterNode.GetParameter("lastDrawingID"))
-    if lastDrawingID != -1:
-      shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-      shNode.RemoveItem(lastDrawingID)
-      parameterNode.SetParameter("lastDrawingID","-1")
+    # drop redo entries and the drawings disabled by them
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    for entry in WarpUndoStack.WarpUndoStack.get().clearRedo():
+      if entry.drawingID is not None:
+        shNode.RemoveItem(entry.drawingID)
 
   def disableLastDrawing(self):
     shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-    nMarkups = slicer.mrmlScene.GetNumberOfNodesByClass('vtkMRMLMarkupsFiducialNode')
-    for i in range(nMarkups-1,-1,-1):
-      markupNode = slicer.mrmlScene.GetNthNodeByClass(i, 'vtkMRMLMarkupsFiducialNode')
-      if all([att in shNode.GetItemAttributeNames(shNode.GetItemByDataNode(markupNode)) for att in ['drawing','auto']]):
-        lastDrawingID = shNode.GetItemByDataNode(markupNode)
-        shNode.SetItemParent(lastDrawingID, shNode.GetSceneItemID())
-        shNode.SetItemDisplayVisibility(lastDrawingID, 0)
-        shNode.SetItemAttribute(lastDrawingID, 'drawing', '0')
-        self.getParameterNode().SetParameter("lastDrawingID", str(lastDrawingID))
-        return
-
-  def enableLastDrawing(self):
-    parameterNode = self.getParameterNode()
-    lastDrawingID = int(parameterNode.GetParameter("lastDrawingID"))
-    if lastDrawingID != -1:
-      shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
-      shNode.SetItemDisplayVisibility(lastDrawingID, 1)
-      shNode.SetItemAttribute(lastDrawingID, 'drawing', '1')
-      parameterNode.SetParameter("lastDrawingID", "-1")
+    lastDrawingID, markupNode = SceneRegistry.SceneRegistry.get().getLastDrawing('auto')
+    if markupNode is not None:
+      shNode.SetItemParent(lastDrawingID, shNode.GetSceneItemID())
+      shNode.SetItemDisplayVisibility(lastDrawingID, 0)
+      shNode.SetItemAttribute(lastDrawingID, 'drawing', '0')
+      return lastDrawingID
+
+  def enableDrawing(self, drawingID):
+    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    shNode.SetItemDisplayVisibility(drawingID, 1)
+    shNode.SetItemAttribute(drawingID, 'drawing', '1')
 
   def cleanUp(self):
-    shNode = slicer.mrmlScene.GetSubjectHierarchyNode()
+    WarpUndoStack.WarpUndoStack.get().clear()
+    WarpSnapshots.WarpSnapshots.get().clear()
+    JacobianMonitor.JacobianMonitor.get().reset()
     # delete warps
-    transformNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLTransformNode')
-    transformNodes.UnRegister(slicer.mrmlScene)
-    for i in range(transformNodes.GetNumberOfItems()):
-      transformNode = transformNodes.GetItemAsObject(i)
-      if 'savedWarp' in shNode.GetItemAttributeNames(shNode.GetItemByDataNode(transformNode)):
-        slicer.mrmlScene.RemoveNode(transformNode)
+    SceneRegistry.SceneRegistry.get().removeSavedWarps()
     self.getParameterNode().SetNodeReferenceID("warpID", None)
 
     # delete fiducials
-    markupsNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLMarkupsFiducialNode')
-    markupsNodes.UnRegister(slicer.mrmlScene)
-    for i in range(markupsNodes.GetNumberOfItems()):
-      markupNode = markupsNodes.GetItemAsObject(i)
-      if 'drawing' in shNode.GetItemAttributeNames(shNode.GetItemByDataNode(markupNode)):
-        slicer.mrmlScene.RemoveNode(markupNode)
+    SceneRegistry.SceneRegistry.get().removeDrawings()
 
 
 
@@ -561,6 +557,11 @@ class SmudgeModuleTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_SmudgeModule1()
+    self.test_Downsample()
+    self.test_CompactGrid()
+    self.test_GaussianSmoothing()
+    self.test_SmoothUndo()
+    self.test_TiledAccumulation()
 
   def test_SmudgeModule1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -575,6 +576,141 @@ class SmudgeModuleTest(ScriptedLoadableModuleTest):
     """
     pass
 
+  def test_Downsample(self):
+    """ Pyramid downsampling in numpy (no scene). Away from the edges the
+    symmetric kernel keeps a linear field and scales the finest frequency by
+    the kernel response, per axis.
+    """
+    from Helpers import TransformPyramid, GaussianSmoothing
+    shape = (40, 44, 48)
+    k, j, i = np.meshgrid(*[np.arange(n, dtype=float) for n in shape], indexing='ij')
+    field = np.stack([0.5 * i - j, 0.25 * k + 1, i + j + k], -1).astype(np.float32)
+    for factor in [2, 4]:
+      size = [(n - 1) // factor + 1 for n in shape[::-1]]
+      result = TransformPyramid.downsample(field, factor, size)
+      self.assertEqual(result.shape, tuple(size[::-1]) + (3,))
+      # kept voxels at least the kernel radius away from the edges
+      radius = int(4.0 * factor / 3.0 + 0.5)
+      inner = tuple(slice(-(-radius // factor), (n - 1 - radius) // factor + 1) for n in shape)
+      expected = field[tuple(slice(None, None, factor) for n in shape)]
+      self.assertLess(np.abs(result[inner] - expected[inner]).max(), 1e-4)
+    checkerboard = np.broadcast_to(((-1.0) ** (i + j + k))[...,None], shape + (3,)).astype(np.float32)
+    result = TransformPyramid.downsample(checkerboard, 2, [(n - 1) // 2 + 1 for n in shape[::-1]])
+    kernel = GaussianSmoothing.gaussianKernel(2 / 3.0)
+    response = np.sum(kernel * (-1.0) ** np.arange(-(len(kernel) // 2), len(kernel) // 2 + 1))
+    self.assertLess(np.abs(result[2:-2,2:-2,2:-2] - response ** 3).max(), 1e-4)
+    self.assertLess(abs(response), 1)
+    self.delayDisplay('Test passed!')
+
+  def test_CompactGrid(self):
+    """ Snapshot encoding round trip in numpy (no scene), for each precision
+    with and without compression.
+    """
+    from Helpers import WarpSnapshots
+    k, j, i = np.meshgrid(*[np.linspace(0, np.pi, n) for n in (40, 30, 20)], indexing='ij')
+    array = np.stack([np.sin(i) * np.sin(j), np.sin(j) * np.sin(k), np.sin(k) * np.sin(i)], -1).astype(np.float32) * 10
+    array[-5:] = 0 # last block zero
+    for precision, maxError in [('float32', 0.0), ('float16', 0.01), ('int16', 0.001), ('int16', 1e-6)]:
+      for compress in [False, True]:
+        compactGrid = WarpSnapshots.CompactGrid(array, precision, compress, maxError)
+        self.assertLessEqual(np.abs(compactGrid.decode() - array).max(), maxError)
+        if precision != 'float32' and maxError >= 0.001:
+          self.assertLess(compactGrid.nbytes, array.nbytes)
+    self.delayDisplay('Test passed!')
+
+  def test_GaussianSmoothing(self):
+    """ Parallel smoothing against ndimage.gaussian_filter in numpy (no scene):
+    split in many slabs, to check the seams, and with kernels above
+    maxDirectKernelSize taps, applied through the fft. Also reports timings.
+    """
+    import time
+    from scipy import ndimage
+    from Helpers import GaussianSmoothing
+    array = np.random.RandomState(0).standard_normal((30, 70, 80, 3)).astype(np.float32) # k shorter than the largest kernel radius
+    slabVoxels = GaussianSmoothing.slabVoxels
+    try:
+      for sigma, slabs in [(1.5, 2 ** 12), (3.0, slabVoxels), (10.0, 2 ** 12)]:
+        GaussianSmoothing.slabVoxels = slabs
+        startTime = time.time()
+        result = GaussianSmoothing.smoothDisplacementInPlace(array.copy(), sigma)
+        smoothTime = time.time() - startTime
+        startTime = time.time()
+        reference = np.stack([ndimage.gaussian_filter(array[...,i], sigma, mode='reflect') for i in range(3)], -1)
+        referenceTime = time.time() - startTime
+        error = np.abs(result - reference).max()
+        self.delayDisplay('sigma %g (%d taps): gaussian_filter %.3fs, smoothDisplacementInPlace %.3fs, max deviation %.1e' % (sigma, len(GaussianSmoothing.gaussianKernel(sigma)), referenceTime, smoothTime, error))
+        self.assertLess(error, 1e-4)
+    finally:
+      GaussianSmoothing.slabVoxels = slabVoxels
+    self.delayDisplay('Test passed!')
+
+  def test_SmoothUndo(self):
+    """ Smooth effect change on a single layer warp: it gets a flat layer, the
+    delta added to it is undone and redone, and the first layer is kept.
+    """
+    logic = TransformsUtil.TransformsUtilLogic()
+    warpNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
+    warpNode.SetAndObserveTransformFromParent(logic.createGridTransform([20, 20, 20], [0, 0, 0], [1, 1, 1]))
+    firstArray = slicer.util.array(warpNode.GetID())
+    firstArray[:] = np.random.RandomState(0).standard_normal(firstArray.shape)
+    first = firstArray.copy()
+    undoStack = WarpUndoStack.WarpUndoStack.get()
+    flatLayer, flatArray, layerArray = undoStack.getEditLayers(warpNode)
+    self.assertEqual(logic.getNumberOfLayers(warpNode), 2)
+    self.assertFalse(flatArray.any())
+    np.testing.assert_array_equal(layerArray, first)
+    index = (slice(5, 15), slice(2, 12), slice(8, 18))
+    delta = np.random.RandomState(1).standard_normal((10, 10, 10, 3)).astype(np.float32)
+    flatArray[index] += delta
+    entry = undoStack.commitDelta(warpNode, 'Smooth', delta, index)
+    self.assertIsNotNone(entry)
+    # flat layer reused
+    self.assertIs(undoStack.getEditLayers(warpNode)[0], flatLayer)
+    self.assertEqual(logic.getNumberOfLayers(warpNode), 2)
+    self.assertIs(undoStack.undo(warpNode, entry), entry)
+    self.assertFalse(flatArray.any())
+    undoStack.redo(warpNode)
+    np.testing.assert_array_equal(flatArray[index], delta)
+    np.testing.assert_array_equal(layerArray, first)
+    self.delayDisplay('Test passed!')
+
+  def test_TiledAccumulation(self):
+    """ Smudge accumulation into the tiles against a dense array, and the cost
+    per event (r = 20 voxels, i.e. 10 mm at 0.5 mm) compared to stacking the
+    displacement components. Once the tiles exist add doesn't allocate kernel
+    sized arrays (numpy may still copy a tile while adding in place).
+    """
+    import time, tracemalloc
+    from Helpers import GridTiles
+    grid = GridTiles.TiledDisplacementGrid([120, 120, 120], [0, 0, 0], [0.5, 0.5, 0.5])
+    dense = np.zeros(grid.shape + (3,), dtype=np.float32)
+    r = 20
+    weight = np.random.RandomState(0).random_sample((2*r+1,) * 3).astype(np.float32)
+    events = [(tuple(slice(c - r, c + r + 1) for c in (40 + e, 50 + e, 60 - e)), np.array([0.1, -0.2, 0.05]) * (e + 1)) for e in range(20)]
+    def addDense():
+      for index, displacement in events:
+        dense[index] += np.stack([weight * d for d in displacement], 3)
+    def addTiles():
+      for index, displacement in events:
+        grid.add(index, weight, displacement)
+    addDense()
+    addTiles()
+    self.assertLess(np.abs(grid.getBlock([0, 0, 0], list(grid.shape)) - dense).max(), 1e-5)
+    startTime = time.time()
+    addDense()
+    denseTime = (time.time() - startTime) / len(events) * 1000
+    startTime = time.time()
+    addTiles()
+    tilesTime = (time.time() - startTime) / len(events) * 1000
+    tracemalloc.start()
+    addTiles()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    self.delayDisplay('stacked components %.2f ms/event, tiles %.2f ms/event, peak allocation %d bytes' % (denseTime, tilesTime, peak))
+    self.assertLess(peak, weight.nbytes)
+    grid.cleanup()
+    self.delayDisplay('Test passed!')
+
 
 
 
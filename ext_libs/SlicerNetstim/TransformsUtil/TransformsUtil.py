@@ -5,6 +5,7 @@ from slicer.ScriptedLoadableModule import *
 import logging
 
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 #
 # TransformsUtil
@@ -166,6 +167,63 @@ class TransformsUtilWidget(ScriptedLoadableModuleWidget):
     logic = TransformsUtilLogic()
     logic.removeLastLayer(self.inputSelector.currentNode())
 
+#
+# TransformLayer
+#
+
+class TransformLayer():
+  """
+  Handle to one leaf transform (layer) of a transform node, with its grid
+  definition, support and displacement array cached. The handles are
+  rebuilt by TransformsUtilLogic.getLayers when the node transform changes,
+  and dropped when the node is removed. The logic functions taking layers
+  accept handles or transforms.
+  """
+
+  def __init__(self, transform, node = None):
+    self.transform = transform
+    self.node = node # transform node the layer belongs to
+    self.isGrid = isinstance(transform, vtk.vtkGridTransform)
+    self.grid = None
+    if self.isGrid:
+      self.grid = transform.GetDisplacementGrid()
+    elif isinstance(transform, slicer.vtkOrientedBSplineTransform):
+      self.grid = transform.GetCoefficientData()
+    # size, origin, spacing
+    self.gridDefinition = (self.grid.GetDimensions(), self.grid.GetOrigin(), self.grid.GetSpacing()) if self.grid else None
+    self.arrayKey = None
+    self.array = None
+
+  def getArray(self):
+    # (k,j,i,3) view of the displacement grid, or None
+    import vtk.util.numpy_support
+    if not self.isGrid or not self.grid:
+      return None
+    scalars = self.grid.GetPointData().GetScalars()
+    key = (scalars.GetAddressAsString('vtkObject'), scalars.GetNumberOfTuples())
+    if key != self.arrayKey:
+      self.array = vtk.util.numpy_support.vtk_to_numpy(scalars).reshape(tuple(reversed(self.grid.GetDimensions())) + (3,))
+      self.arrayKey = key
+    return self.array
+
+  def getSupport(self):
+    # RAS bounds the layer moves points in (see TransformsUtilLogic.getLayerSupport)
+    return TransformsUtilLogic().getLayerSupport(self.transform)
+
+  def createNode(self, name = None):
+    # new transform node with this layer (shared, not copied)
+    node = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode')
+    if name:
+      node.SetName(name)
+    node.SetAndObserveTransformFromParent(self.transform)
+    return node
+
+@vtk.calldata_type(vtk.VTK_OBJECT)
+def onNodeAboutToBeRemoved(caller, event, node):
+  # drop the layer handles of removed nodes
+  for toParent in [False, True]:
+    TransformsUtilLogic.layerCache.pop((node.GetID(), toParent), None)
+
 #
 # TransformsUtilLogic
 #
@@ -180,6 +238,27 @@ class TransformsUtilLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  # grid composition
+  compositionThreads = os.cpu_count() or 1
+  compositionChunkSize = 2 ** 15 # points per job
+  # layer support bounds, by (layer address, modified time)
+  supportCache = {}
+  supportCacheSize = 64
+  # layer handles, by node ID
+  layerCache = {}
+  layerCacheSize = 64
+  layerCacheObserver = None
+  # called with the node before its layers are read (i.e. to restore a compacted node)
+  layerAccessCallbacks = []
+  # inversion
+  inversionIterations = 50
+  inversionTolerance = 1e-3 # mm
+  inversionResidualSamples = 10000
+  inversionNewtonIterations = 20
+  inversionJacobianStep = 0.1 # mm
+  inversionDamping = 1e-3 # relative to the mean eigenvalue of J'J
+  inversionWarningResidual = 0.1 # mm
+  inversionResidual = None # (max, mean, not converged) of the last inversion
 
   def getMNIGrid(self, resolution):
     size = [394, 466, 378]
@@ -198,6 +277,14 @@ class TransformsUtilLogic(ScriptedLoadableModuleLogic):
     if not transformNode:
       transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLGridTransformNode')
 
+    # Create transform node
+    transformNode.SetAndObserveTransformFromParent(self.createGridTransform(transformSize, transformOrigin, transformSpacing))
+    #transformNode.CreateDefaultDisplayNodes()
+    #transformNode.CreateDefaultStorageNode()  
+
+    return transformNode
+
+  def createGridTransform(self, transformSize, transformOrigin, transformSpacing):
     voxelType = vtk.VTK_FLOAT
     fillVoxelValue = 0
     # Create an empty image volume, filled with fillVoxelValue
@@ -205,20 +292,26 @@ class TransformsUtilLogic(ScriptedLoadableModuleLogic):
     imageData.SetDimensions(transformSize)
     imageData.AllocateScalars(voxelType, 3)
     imageData.GetPointData().GetScalars().Fill(fillVoxelValue)
+    imageData.SetOrigin(transformOrigin)
+    imageData.SetSpacing(transformSpacing)
     # Create transform
     transform = slicer.vtkOrientedGridTransform()
     transform.SetInterpolationModeToCubic()
     transform.SetDisplacementGridData(imageData)
-    # Create transform node
-    transformNode.SetAndObserveTransformFromParent(transform)
-    transformNode.GetTransformFromParent().GetDisplacementGrid().SetOrigin(transformOrigin)
-    transformNode.GetTransformFromParent().GetDisplacementGrid().SetSpacing(transformSpacing)
-    #transformNode.CreateDefaultDisplayNodes()
-    #transformNode.CreateDefaultStorageNode()  
-
+    return transform
+
+
+  def gridTransformFromArray(self, displacementArray, transformOrigin, transformSpacing, transformNode = None, toParent = False, gridDirection = None):
+    # grid transform with the (k,j,i,3) displacement array as data. gridDirection: vtkMatrix4x4
+    transformSize = displacementArray.shape[2::-1]
+    transformNode = self.emptyGridTransform(transformSize, transformOrigin, transformSpacing, transformNode)
+    if gridDirection is not None:
+      transformNode.GetTransformFromParent().SetGridDirectionMatrix(gridDirection)
+    slicer.util.array(transformNode.GetID())[:] = displacementArray
+    if toParent:
+      transformNode.SetAndObserveTransformToParent(transformNode.GetTransformFromParent())
     return transformNode
 
-
   def emptySplineTransfrom(self, transformSize = [19,23,19], transformOrigin = [-96.0, -132.0, -78.0], transformSpacing = [10, 10, 10], transformNode = None):
     """
     Run the actual algorithm
@@ -265,58 +358,58 @@ class TransformsUtilLogic(ScriptedLoadableModuleLogic):
 
     return volumeNode
 
-  def getTransformNodesInScene(self):
-    transformNodes = slicer.mrmlScene.GetNodesByClass('vtkMRMLTransformNode')
-    transformNodes.UnRegister(slicer.mrmlScene)
-    return set([transformNodes.GetItemAsObject(i).GetName() for i in range(transformNodes.GetNumberOfItems())])
+  def getLayers(self, transformNode, toParent = False):
+    """
+    Handles to the layers of transformNode in the order they are applied to a
+    point (the first layer is the last one). Cached until the node transform
+    is modified.
+    """
+    for callback in TransformsUtilLogic.layerAccessCallbacks:
+      callback(transformNode)
+    transform = transformNode.GetTransformToParent() if toParent else transformNode.GetTransformFromParent()
+    if transform is None:
+      return []
+    key = (transform.GetAddressAsString('vtkObject'), transform.GetMTime())
+    cacheID = (transformNode.GetID(), toParent)
+    if cacheID in self.layerCache and self.layerCache[cacheID][0] == key:
+      return self.layerCache[cacheID][1]
+    layers = [TransformLayer(layer, transformNode) for layer in self.getTransformLayers(transform)]
+    if len(self.layerCache) >= self.layerCacheSize:
+      self.layerCache.clear()
+    if TransformsUtilLogic.layerCacheObserver is None:
+      TransformsUtilLogic.layerCacheObserver = slicer.mrmlScene.AddObserver(slicer.mrmlScene.NodeAboutToBeRemovedEvent, onNodeAboutToBeRemoved)
+    self.layerCache[cacheID] = (key, layers)
+    return layers
 
   def getGridDefinition(self, transformNode):
+    # grid of the first layer
     if not transformNode:
       return 0,0,[1,1,1]
-    fp = transformNode.GetTransformFromParent()
-    tp = transformNode.GetTransformToParent()
-    if isinstance(fp, slicer.vtkOrientedGridTransform) and fp.GetDisplacementGrid():
-      grid = fp.GetDisplacementGrid()
-    elif isinstance(tp, slicer.vtkOrientedGridTransform) and tp.GetDisplacementGrid():
-      grid = tp.GetDisplacementGrid()
-    elif isinstance(fp, vtk.vtkGeneralTransform) and fp.GetNumberOfConcatenatedTransforms() and fp.GetConcatenatedTransform(fp.GetNumberOfConcatenatedTransforms()-1).GetDisplacementGrid():
-      grid = fp.GetConcatenatedTransform(fp.GetNumberOfConcatenatedTransforms()-1).GetDisplacementGrid()
-    elif isinstance(tp, vtk.vtkGeneralTransform) and tp.GetNumberOfConcatenatedTransforms() and tp.GetConcatenatedTransform(tp.GetNumberOfConcatenatedTransforms()-1).GetDisplacementGrid():
-      grid = tp.GetConcatenatedTransform(tp.GetNumberOfConcatenatedTransforms()-1).GetDisplacementGrid()
-    elif isinstance(fp, slicer.vtkOrientedBSplineTransform) and fp.GetCoefficientData():
-      grid = fp.GetCoefficientData()
-    else:
-      return False
-    
-    size = grid.GetDimensions()
-    origin = grid.GetOrigin()
-    spacing = grid.GetSpacing()
-
-    return size,origin,spacing
-
+    for toParent in [False, True]:
+      layers = self.getLayers(transformNode, toParent)
+      if layers and layers[-1].gridDefinition:
+        return layers[-1].gridDefinition
+    return False
 
   def getNumberOfLayers(self, transformNode):
     if not transformNode:
       return 0
-    if isinstance(transformNode.GetTransformFromParent(), vtk.vtkGeneralTransform):
-      return max(transformNode.GetTransformFromParent().GetNumberOfConcatenatedTransforms(), transformNode.GetTransformToParent().GetNumberOfConcatenatedTransforms())
-    else:
-      return 1
+    return len(self.getLayers(transformNode))
 
   def hasMinimumNumberOfLayers(self, transformNode, N):
     return self.getNumberOfLayers(transformNode) >= N
 
-
-  def splitAndGetNodeNames(self, transformNode):
-    # split transform and get the created node names
-    preSplitNames = self.getTransformNodesInScene()
-    transformNode.Split()
-    postSplitNames = self.getTransformNodesInScene()
-    newNodeNames = list(postSplitNames - preSplitNames)
-    # sort transforms accordig to the last character in the name
-    newNodeNames.sort(key=lambda e: int(e[-1]) if e[-1].isdigit() else 0)    
-
-    return newNodeNames
+  def setLayers(self, transformNode, layers):
+    # set the transform of transformNode to the layers (handles or transforms) in the order they are applied
+    transforms = [layer.transform if isinstance(layer, TransformLayer) else layer for layer in layers]
+    if len(transforms) == 1:
+      transformNode.SetAndObserveTransformFromParent(transforms[0])
+      return
+    transform = vtk.vtkGeneralTransform()
+    # each concatenated transform is applied before the previous ones
+    for layer in reversed(transforms):
+      transform.Concatenate(layer)
+    transformNode.SetAndObserveTransformFromParent(transform)
 
   def flattenTransform(self, transformNode, includeFirstLayer, useMNIGrid = False):
 
@@ -326,70 +419,461 @@ class TransformsUtilLogic(ScriptedLoadableModuleLogic):
       print('already flat')
       return
 
-    # get current transform ID applied and save for after flatten
-    lastLayerID = transformNode.GetTransformNodeID()
-    transformNode.SetAndObserveTransformNodeID('')
-
     if useMNIGrid:
       size, origin, spacing = self.getMNIGrid(0.5)
     else:
       size, origin, spacing = self.getGridDefinition(transformNode)
-      
-    newNodeNames = self.splitAndGetNodeNames(transformNode)
+
+    # layers in the order they are applied. the first layer is the last one
+    layers = self.getLayers(transformNode)
 
     if includeFirstLayer:
-      newNodeNames.append(transformNode.GetName()) # add first layer in the end
+      self.resampleToGridTransform(transformNode, size, origin, spacing)
+    elif self.flattenInPlace(transformNode, layers, size, origin, spacing):
+      pass
+    else:
+      displacement = self.composeTransformLayers(layers[:-1], size, origin, spacing)
+      self.appendFlatLayer(transformNode, layers[-1].transform, displacement, origin, spacing)
 
-    for nodeName in newNodeNames[1:]:
-      node = slicer.util.getNode(nodeName)
-      node.HardenTransform()
+    return True
 
-    outNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode')
-    referenceVolume = self.createEmpyVolume(size, origin, spacing)    
-    transformsLogic = slicer.modules.transforms.logic()
-    transformsLogic.ConvertToGridTransform(node, referenceVolume, outNode)
+  def flattenInPlace(self, transformNode, layers, size, origin, spacing):
+    """
+    When the oldest layer above the first one is a grid over the reference
+    grid (the previous flatten), compose the newer layers into it, only in the
+    bounding box of their support. Outside of it the newer layers don't move
+    the points, so the composition equals that grid. layers are the handles
+    of the node layers. Returns False if the layers don't allow it, else the index of the recomposed box in the grid
+    array (None if nothing changed) and the values it had.
+    """
+    flatLayer = layers[-2]
+    flatArray = self.getGridLayerArray(flatLayer, size, origin, spacing)
+    if flatArray is None:
+      return False
+    bounds = [self.getLayerSupport(layer) for layer in layers[:-2]]
+    bounds = [b for b in bounds if b is not False] # drop empty layers
+    index, previous = None, None
+    if bounds:
+      bounds = np.array(bounds)
+      lower = np.min(bounds[:,0::2], axis=0)
+      upper = np.max(bounds[:,1::2], axis=0)
+      # grid index box, clipped to the reference grid
+      start = np.floor((lower - np.array(origin)) / np.array(spacing)).clip(0, np.array(size)).astype(int)
+      stop = (np.floor((upper - np.array(origin)) / np.array(spacing)) + 1).clip(0, np.array(size)).astype(int)
+      if np.all(stop > start):
+        boxOrigin = np.array(origin) + start * np.array(spacing)
+        displacement = self.composeTransformLayers(layers[:-1], stop - start, boxOrigin, spacing)
+        index = (slice(start[2], stop[2]), slice(start[1], stop[1]), slice(start[0], stop[0]))
+        previous = flatArray[index].copy()
+        flatArray[index] = displacement
+        flatLayer.transform.GetDisplacementGrid().Modified()
+        flatLayer.transform.Modified()
+    # keep the first layer and the updated grid
+    self.setLayers(transformNode, [flatLayer, layers[-1]])
+    return index, previous
+
+  def composeBoxesInPlace(self, flatLayer, boxLayers, size, origin, spacing):
+    """
+    Compose into the grid layer flatLayer (over size, origin, spacing) new
+    layers given by boxes: boxLayers is a list of (lower, upper, layers), the
+    layers being equal to the new layers in the RAS box [lower, upper). The
+    boxes don't overlap and the new layers are the identity outside of them.
+    Only the grid points in the boxes are recomposed. Returns the index of each
+    recomposed box in the grid array and the values it had.
+    """
+    flatArray = self.getGridLayerArray(flatLayer, size, origin, spacing)
+    boxes = []
+    for lower, upper, layers in boxLayers:
+      # grid points in [lower, upper)
+      start = np.ceil((np.array(lower) - origin) / spacing).clip(0, np.array(size)).astype(int)
+      stop = np.ceil((np.array(upper) - origin) / spacing).clip(0, np.array(size)).astype(int)
+      if np.all(stop > start):
+        boxOrigin = np.array(origin) + start * np.array(spacing)
+        # all boxes are composed before writing, they sample the flat layer
+        boxes.append((start, stop, self.composeTransformLayers(layers + [flatLayer], stop - start, boxOrigin, spacing)))
+    updated = []
+    for start, stop, displacement in boxes:
+      index = (slice(start[2], stop[2]), slice(start[1], stop[1]), slice(start[0], stop[0]))
+      updated.append((index, flatArray[index].copy()))
+      flatArray[index] = displacement
+    if updated:
+      flatLayer.GetDisplacementGrid().Modified()
+      flatLayer.Modified()
+    return updated
+
+  def addFlatLayer(self, transformNode):
+    # insert an empty grid over the first layer grid right above it, for the next layers to be flattened into
+    size, origin, spacing = self.getGridDefinition(transformNode)
+    layers = self.getLayers(transformNode)
+    self.setLayers(transformNode, layers[:-1] + [self.createGridTransform(size, origin, spacing), layers[-1]])
+
+  def getGridLayerArray(self, layer, size, origin, spacing, direction = None):
+    # (k,j,i,3) array of a grid layer defined exactly over size, origin, spacing and direction (3x3, default identity), or None
+    import vtk.util.numpy_support
+    handle = layer if isinstance(layer, TransformLayer) else None
+    if handle:
+      layer = handle.transform
+    if not isinstance(layer, vtk.vtkGridTransform) or layer.GetInverseFlag() or not layer.GetDisplacementGrid():
+      return None
+    if layer.GetDisplacementScale() != 1 or layer.GetDisplacementShift() != 0:
+      return None
+    layerDirection = np.eye(3)
+    if isinstance(layer, slicer.vtkOrientedGridTransform) and layer.GetGridDirectionMatrix():
+      layerDirection = slicer.util.arrayFromVTKMatrix(layer.GetGridDirectionMatrix())[:3,:3]
+    if not np.allclose(layerDirection, np.eye(3) if direction is None else direction):
+      return None
+    grid = layer.GetDisplacementGrid()
+    if list(grid.GetDimensions()) != [int(n) for n in size] or not np.allclose(grid.GetOrigin(), origin) or not np.allclose(grid.GetSpacing(), spacing):
+      return None
+    if handle:
+      return handle.getArray()
+    return vtk.util.numpy_support.vtk_to_numpy(grid.GetPointData().GetScalars()).reshape(tuple(reversed(grid.GetDimensions())) + (3,))
 
-    if includeFirstLayer:
-      transformNode.SetAndObserveTransformFromParent(outNode.GetTransformFromParent())
-      newNodeNames.pop() # remove so that is not deleted later
+  def getLayerSupport(self, layer):
+    """
+    RAS bounds (xmin,xmax,ymin,ymax,zmin,zmax) of the region a layer moves
+    points in. False if it is the identity, infinite bounds if unknown (non
+    grid layers). Cached by layer modified time.
+    """
+    import vtk.util.numpy_support
+    if isinstance(layer, TransformLayer):
+      layer = layer.transform
+    key = (layer.GetAddressAsString('vtkObject'), layer.GetMTime())
+    if key in self.supportCache:
+      return self.supportCache[key]
+    unbounded = [-np.inf, np.inf] * 3
+    array = None
+    if isinstance(layer, vtk.vtkGridTransform) and not layer.GetInverseFlag() and layer.GetDisplacementGrid() and layer.GetDisplacementShift() == 0:
+      if not (isinstance(layer, slicer.vtkOrientedGridTransform) and layer.GetGridDirectionMatrix() and not layer.GetGridDirectionMatrix().IsIdentity()):
+        grid = layer.GetDisplacementGrid()
+        array = vtk.util.numpy_support.vtk_to_numpy(grid.GetPointData().GetScalars()).reshape(tuple(reversed(grid.GetDimensions())) + (3,))
+    if array is None:
+      support = unbounded
     else:
-      transformNode.SetAndObserveTransformNodeID(outNode.GetID())
-      transformNode.HardenTransform()
-    
-    # cleanup
-    slicer.mrmlScene.RemoveNode(referenceVolume)
+      nonZero = np.any(array != 0, axis=3)
+      if not nonZero.any():
+        support = False
+      else:
+        support = []
+        gridSize = array.shape[2::-1]
+        for axis in range(3):
+          # sides of the non zero voxels along axis (array axes are k,j,i)
+          indexes = np.flatnonzero(np.any(nonZero, axis=tuple(a for a in range(3) if a != 2 - axis)))
+          o, sp = grid.GetOrigin()[axis], grid.GetSpacing()[axis]
+          # cubic interpolation reaches 2 voxels away. values at the edges extend outside the grid
+          lower = -np.inf if indexes[0] == 0 else o + (indexes[0] - 2) * sp
+          upper = np.inf if indexes[-1] == gridSize[axis] - 1 else o + (indexes[-1] + 2) * sp
+          support.extend([lower, upper])
+    if len(self.supportCache) >= self.supportCacheSize:
+      self.supportCache.clear()
+    self.supportCache[key] = support
+    return support
+
+  def getSupportBounds(self, transformNode):
+    # union of the supports of the layers of transformNode and its parents. False if they are the identity, None if unbounded
+    bounds = []
+    while transformNode:
+      bounds.extend([layer.getSupport() for layer in self.getLayers(transformNode)])
+      transformNode = transformNode.GetParentTransformNode()
+    bounds = np.array([b for b in bounds if b is not False])
+    if not len(bounds):
+      return False
+    bounds = np.column_stack((np.min(bounds[:,0::2], axis=0), np.max(bounds[:,1::2], axis=0))).ravel()
+    return None if np.any(np.isinf(bounds)) else bounds
+
+  def getBoundsSurfacePoints(self, bounds, step):
+    # (n,3) points on the faces of the box bounds, about step mm apart
+    axes = [np.linspace(bounds[2*a], bounds[2*a+1], max(2, int(np.ceil((bounds[2*a+1] - bounds[2*a]) / step)) + 1)) for a in range(3)]
+    points = []
+    for a in range(3):
+      for side in [bounds[2*a], bounds[2*a+1]]:
+        grids = np.meshgrid(*[[side] if b == a else axes[b] for b in range(3)], indexing='ij')
+        points.append(np.column_stack([g.ravel() for g in grids]))
+    return np.concatenate(points)
+
+  def transformPoints(self, layers, points):
+    # (n,3) RAS points mapped through layers
+    for layer in layers:
+      points = self.getLayerSampler(layer)(points)
+    return points
+
+  def resampleToGridTransform(self, transformNode, size, origin, spacing):
+    # replace the transform of transformNode by a single grid with the composition of its layers
+    layers = self.getLayers(transformNode)
+    displacement = self.composeTransformLayers(layers, size, origin, spacing)
+    return self.gridTransformFromArray(displacement, origin, spacing, transformNode)
+
+  def appendFlatLayer(self, transformNode, firstLayer, displacement, origin, spacing):
+    # leave transformNode with the first layer and the displacement grid hardened on top
+    lastLayerID = transformNode.GetTransformNodeID()
+    transformNode.SetAndObserveTransformNodeID('')
+    transformNode.SetAndObserveTransformFromParent(firstLayer)
+    outNode = self.gridTransformFromArray(displacement, origin, spacing)
+    transformNode.SetAndObserveTransformNodeID(outNode.GetID())
+    transformNode.HardenTransform()
     slicer.mrmlScene.RemoveNode(outNode)
-    for nodeName in newNodeNames:
-      slicer.mrmlScene.RemoveNode(slicer.util.getNode(nodeName))
-
     # re-apply ID
     transformNode.SetAndObserveTransformNodeID(lastLayerID)
 
-    return True
+  def getTransformLayers(self, transform):
+    # leaf transforms of a (nested) general transform in the order they are applied to a point
+    if isinstance(transform, vtk.vtkGeneralTransform):
+      layers = []
+      for i in range(transform.GetNumberOfConcatenatedTransforms()):
+        layers.extend(self.getTransformLayers(transform.GetConcatenatedTransform(i)))
+      return layers
+    return [transform]
 
-  def removeLastLayer(self, transformNode):
+  def composeTransformLayers(self, layers, size, origin, spacing):
+    """
+    Displacement of the composition of layers sampled in the grid defined by
+    size, origin and spacing, as a (k,j,i,3) float32 array. Grid layers are
+    sampled in numpy with the same interpolation as vtkGridTransform, linear
+    layers are applied as matrices and any other transform through vtk. The
+    grid points are split in chunks evaluated in a thread pool.
+    """
+    samplers = [self.getLayerSampler(layer) for layer in layers]
+    size = [int(s) for s in size]
+    origin = np.array(origin, dtype=float)
+    spacing = np.array(spacing, dtype=float)
+    numberOfPoints = int(np.prod(size))
+    displacement = np.empty((numberOfPoints, 3), dtype=np.float32)
+
+    def composeChunk(start):
+      index = np.arange(start, min(start + self.compositionChunkSize, numberOfPoints))
+      points = self.getGridPoints(index, size, origin, spacing)
+      transformed = points
+      for sampler in samplers:
+        transformed = sampler(transformed)
+      displacement[index[0]:index[-1]+1] = transformed - points
+
+    with ThreadPoolExecutor(self.compositionThreads) as executor:
+      list(executor.map(composeChunk, range(0, numberOfPoints, self.compositionChunkSize)))
+    return displacement.reshape(tuple(size[::-1]) + (3,))
+
+  def getGridPoints(self, index, size, origin, spacing, direction = None):
+    # RAS of the grid points with flat index (i fastest)
+    ijk = np.column_stack((index % size[0], (index // size[0]) % size[1], index // (size[0] * size[1])))
+    if direction is None:
+      return origin + ijk * spacing
+    return origin + (ijk * spacing).dot(np.array(direction).T)
+
+  def invertTransformLayers(self, layers, size, origin, spacing, direction = None, initialLayers = None):
+    """
+    Displacement of the inverse of the composition of layers over the grid
+    defined by size, origin, spacing and direction (3x3), as a (k,j,i,3) float32
+    array. For each grid point y, x is updated with the fixed point iteration
+    x <- x + y - f(x), f being the forward transform, until it moves less than
+    inversionTolerance. x starts at the previous inverse (initialLayers) if
+    given, else at y. The iteration only converges where |I - J| < 1 (J the
+    jacobian of f), so the points still moving at the end are solved with
+    damped newton steps (refineInverse). The grid points are split in chunks
+    solved in a thread pool. Also returns the max and mean of |f(x) - y| (mm)
+    over a subsample of the grid points and the refined points, and the
+    number of points left above inversionTolerance.
+    """
+    samplers = [self.getLayerSampler(layer) for layer in layers]
+    initialSamplers = [self.getLayerSampler(layer) for layer in initialLayers] if initialLayers else []
+    size = [int(s) for s in size]
+    origin = np.array(origin, dtype=float)
+    spacing = np.array(spacing, dtype=float)
+    numberOfPoints = int(np.prod(size))
+    displacement = np.empty((numberOfPoints, 3), dtype=np.float32)
+
+    def forward(points, samplerList):
+      for sampler in samplerList:
+        points = sampler(points)
+      return points
+
+    def invertChunk(start):
+      index = np.arange(start, min(start + self.compositionChunkSize, numberOfPoints))
+      targets = self.getGridPoints(index, size, origin, spacing, direction)
+      points = np.array(forward(targets, initialSamplers))
+      active = np.arange(len(index))
+      for iteration in range(self.inversionIterations):
+        step = targets[active] - forward(points[active], samplers)
+        points[active] += step
+        active = active[np.linalg.norm(step, axis=1) > self.inversionTolerance]
+        if not len(active):
+          break
+      residual = np.zeros(0)
+      if len(active):
+        points[active], residual = self.refineInverse(lambda x: forward(x, samplers), points[active], targets[active])
+      displacement[index[0]:index[-1]+1] = points - targets
+      return residual
+
+    with ThreadPoolExecutor(self.compositionThreads) as executor:
+      refinedResidual = np.concatenate(list(executor.map(invertChunk, range(0, numberOfPoints, self.compositionChunkSize))))
+
+    # inverse consistency on a subsample
+    sample = np.random.RandomState(0).choice(numberOfPoints, min(numberOfPoints, self.inversionResidualSamples), replace=False)
+    targets = self.getGridPoints(sample, size, origin, spacing, direction)
+    residual = np.linalg.norm(forward(targets + displacement[sample], samplers) - targets, axis=1)
+    residual = np.concatenate((residual, refinedResidual))
+
+    return displacement.reshape(tuple(size[::-1]) + (3,)), (residual.max(), residual.mean(), np.count_nonzero(refinedResidual > self.inversionTolerance))
+
+  def refineInverse(self, forward, points, targets):
+    """
+    Damped newton (levenberg-marquardt) steps solving forward(x) = targets from
+    points, for the points where the fixed point iteration did not converge.
+    The jacobian is estimated with central differences. Steps that don't
+    reduce the residual are halved, and dropped after a few halvings. Returns
+    the points and the norm of their residual.
+    """
+    h = self.inversionJacobianStep
+    error = targets - forward(points)
+    norm = np.linalg.norm(error, axis=1)
+    for iteration in range(self.inversionNewtonIterations):
+      active = np.flatnonzero(norm > self.inversionTolerance)
+      if not len(active):
+        break
+      x = points[active]
+      jacobian = np.empty((len(active), 3, 3))
+      for axis in range(3):
+        offset = np.zeros(3)
+        offset[axis] = h
+        jacobian[:,:,axis] = (forward(x + offset) - forward(x - offset)) / (2 * h)
+      normal = np.einsum('nji,njk->nik', jacobian, jacobian)
+      damping = self.inversionDamping * np.trace(normal, axis1=1, axis2=2) / 3 + 1e-12
+      normal += damping[:,None,None] * np.eye(3)
+      step = np.linalg.solve(normal, np.einsum('nji,nj->ni', jacobian, error[active])[...,None])[...,0]
+      # backtracking
+      for halving in range(4):
+        candidate = x + step
+        candidateError = targets[active] - forward(candidate)
+        candidateNorm = np.linalg.norm(candidateError, axis=1)
+        better = candidateNorm < norm[active]
+        points[active[better]] = candidate[better]
+        error[active[better]] = candidateError[better]
+        norm[active[better]] = candidateNorm[better]
+        active, x, step = active[~better], x[~better], step[~better] / 2
+        if not len(active):
+          break
+    return points, norm
+
+  def getLayerSampler(self, layer):
+    # function mapping (n,3) RAS points through layer (handle or transform)
+    import vtk.util.numpy_support
+    handle = layer if isinstance(layer, TransformLayer) else None
+    if handle:
+      layer = handle.transform
+    layer.Update()
+    if isinstance(layer, vtk.vtkGridTransform) and not layer.GetInverseFlag() and layer.GetDisplacementGrid():
+      grid = layer.GetDisplacementGrid()
+      if handle:
+        array = handle.getArray()
+      else:
+        array = vtk.util.numpy_support.vtk_to_numpy(grid.GetPointData().GetScalars()).reshape(tuple(reversed(grid.GetDimensions())) + (3,))
+      direction = np.eye(3)
+      if isinstance(layer, slicer.vtkOrientedGridTransform) and layer.GetGridDirectionMatrix():
+        direction = slicer.util.arrayFromVTKMatrix(layer.GetGridDirectionMatrix())[:3,:3]
+      RASToIJK = np.linalg.inv(direction * np.array(grid.GetSpacing())) # columns scaled by spacing
+      RASToIJKOffset = -RASToIJK.dot(np.array(grid.GetOrigin()))
+      interpolationMode = layer.GetInterpolationMode()
+      scale, shift = layer.GetDisplacementScale(), layer.GetDisplacementShift()
+      def sampleLayer(points):
+        ijk = points.dot(RASToIJK.T) + RASToIJKOffset
+        return points + self.sampleDisplacementGrid(array, ijk, interpolationMode) * scale + shift
+      return sampleLayer
+    elif isinstance(layer, vtk.vtkLinearTransform):
+      matrix = slicer.util.arrayFromVTKMatrix(layer.GetMatrix())
+      return lambda points: points.dot(matrix[:3,:3].T) + matrix[:3,3]
+    else:
+      def transformLayer(points):
+        inputPoints = vtk.vtkPoints()
+        inputPoints.SetData(vtk.util.numpy_support.numpy_to_vtk(np.ascontiguousarray(points), deep=True))
+        outputPoints = vtk.vtkPoints()
+        layer.TransformPoints(inputPoints, outputPoints)
+        return vtk.util.numpy_support.vtk_to_numpy(outputPoints.GetData()).reshape(-1,3).astype(float)
+      return transformLayer
+
+  def sampleDisplacementGrid(self, array, ijk, interpolationMode):
+    """
+    Interpolate the (k,j,i,3) array at the continuous indexes ijk (n,3). As
+    vtkGridTransform: points outside take the value at the edge, and cubic is
+    catmull-rom inside and quadratic/linear next to the grid edges. Points on
+    the grid nodes (i.e. not displaced by the previous layers) are looked up
+    directly.
+    """
+    size = np.array(array.shape[2::-1])
+    ijk = np.clip(ijk, 0, size - 1)
+    nodes = np.rint(ijk)
+    if interpolationMode == vtk.VTK_NEAREST_INTERPOLATION:
+      onNode = np.ones(len(ijk), dtype=bool)
+    else:
+      onNode = np.all(np.abs(ijk - nodes) < 1e-6, axis=1)
+    displacement = np.empty((len(ijk), 3), dtype=float)
+    nodes = nodes[onNode].astype(np.intp)
+    displacement[onNode] = array[nodes[:,2], nodes[:,1], nodes[:,0]]
+    if not onNode.all():
+      displacement[~onNode] = self.interpolateDisplacementGrid(array, ijk[~onNode], interpolationMode)
+    return displacement
+
+  def interpolateDisplacementGrid(self, array, ijk, interpolationMode):
+    # separable interpolation gathering a window of taps around each point
+    taps = 4 if interpolationMode == vtk.VTK_CUBIC_INTERPOLATION else 2
+    size = np.array(array.shape[2::-1])
+    if np.any(size < taps):
+      # padded taps get zero weight
+      array = np.pad(array, [(0, max(taps - n, 0)) for n in array.shape[:3]] + [(0,0)], mode='edge')
+    # (k,j,i,3,taps,taps,taps) view of the windows starting at each voxel
+    windowsShape = tuple(n - taps + 1 for n in array.shape[:3]) + (3,) + (taps,)*3
+    windows = np.lib.stride_tricks.as_strided(array, windowsShape, array.strides + array.strides[:3], writeable=False)
+    start = []
+    weights = []
+    for axis in range(3):
+      axisStart, axisWeights = self.getInterpolationWeights(ijk[:,axis], size[axis], taps)
+      # shift windows that would go out of the array (next to the edges), moving the weights
+      clippedStart = np.clip(axisStart, 0, windows.shape[2-axis] - 1)
+      shifted = clippedStart != axisStart
+      if shifted.any():
+        columns = np.arange(taps) + (clippedStart - axisStart)[shifted,None] + taps
+        axisWeights[shifted] = np.take_along_axis(np.pad(axisWeights[shifted], ((0,0),(taps,taps))), columns, axis=1)
+      start.append(clippedStart)
+      weights.append(axisWeights)
+    values = windows[start[2], start[1], start[0]].reshape(len(ijk), 3, -1) # (n,3,k*j*i)
+    weights = (weights[2][:,:,None,None] * weights[1][:,None,:,None] * weights[0][:,None,None,:]).reshape(len(ijk), -1)
+    return np.einsum('ncx,nx->nc', values, weights.astype(values.dtype))
+
+  def getInterpolationWeights(self, x, n, taps):
+    # index of the first tap and tap weights along one axis (vtkGridTransform)
+    i = np.minimum(np.floor(x).astype(np.intp), n - 1)
+    f = x - i
+    weights = np.zeros((len(x), taps))
+    if taps == 2:
+      weights[:,0] = 1 - f
+      weights[:,1] = f
+      return i, weights
+    fm1 = f - 1
+    hasLower = i > 0
+    hasUpper = i + 2 <= n - 1
+    cubic = hasLower & hasUpper
+    weights[cubic,0] = (-f * fm1 * fm1 / 2)[cubic]
+    weights[cubic,1] = (((3 * f - 2) * f - 2) * fm1 / 2)[cubic]
+    weights[cubic,2] = (-((3 * f - 4) * f - 1) * f / 2)[cubic]
+    weights[cubic,3] = (f * f * fm1 / 2)[cubic]
+    lower = ~hasLower & hasUpper
+    weights[lower,1] = (fm1 * (fm1 - 1) / 2)[lower]
+    weights[lower,2] = (-f * (fm1 - 1))[lower]
+    weights[lower,3] = (f * fm1 / 2)[lower]
+    upper = hasLower & ~hasUpper
+    weights[upper,0] = (f * fm1 / 2)[upper]
+    weights[upper,1] = (-(f + 1) * fm1)[upper]
+    weights[upper,2] = ((f + 1) * f / 2)[upper]
+    linear = ~hasLower & ~hasUpper
+    weights[linear,1] = (1 - f)[linear]
+    weights[linear,2] = f[linear]
+    return i - 1, weights
 
-    if not self.hasMinimumNumberOfLayers(transformNode, 2):
+  def removeLastLayer(self, transformNode):
+    # move the most recent layer to a new node and return its ID
+    layers = self.getLayers(transformNode)
+    if len(layers) < 2:
       return None
-
-    newNodeNames = self.splitAndGetNodeNames(transformNode)
-    newNodeNames.append(transformNode.GetName())
-
-    # remove last transform
-    node = slicer.util.getNode(newNodeNames[1])
-    node.SetAndObserveTransformNodeID('')
-
-    lastLayer = slicer.util.getNode(newNodeNames.pop(0)) # get last layer and remove from list
-
-    for nodeName in newNodeNames[1:]:
-      slicer.util.getNode(nodeName).HardenTransform()
-
-    newNodeNames.pop() # so as to not delete it
-
-    for nodeName in newNodeNames:
-      slicer.mrmlScene.RemoveNode(slicer.util.getNode(nodeName))
-    
-    return lastLayer.GetID()
+    lastLayerNode = layers[0].createNode()
+    self.setLayers(transformNode, layers[1:])
+    return lastLayerNode.GetID()
 
 
   def transformToGridTransform(self, transformNode, size,origin,spacing):
@@ -402,6 +886,63 @@ class TransformsUtilLogic(ScriptedLoadableModuleLogic):
     return outNode
 
 
+  def invertToGridTransform(self, transformNode, referenceVolume, initialTransformNode = None, updatePoints = None):
+    """
+    Grid transform node with the inverse of transformNode over the geometry of
+    referenceVolume, starting from the previous inverse initialTransformNode.
+    With updatePoints, (n,3) RAS points bounding the region where the inverse
+    changed, and a previous inverse over the same grid, only the voxels in the
+    bounding box of the points are recomputed. They are written in the
+    previous inverse, which is returned.
+    """
+    self.inversionResidual = None
+    size = referenceVolume.GetImageData().GetDimensions()
+    origin = np.array(referenceVolume.GetOrigin())
+    spacing = np.array(referenceVolume.GetSpacing())
+    directionMatrix = vtk.vtkMatrix4x4()
+    referenceVolume.GetIJKToRASDirectionMatrix(directionMatrix)
+    direction = slicer.util.arrayFromVTKMatrix(directionMatrix)[:3,:3]
+    layers = self.getLayers(transformNode)
+    initialLayers = self.getLayers(initialTransformNode) if initialTransformNode else None
+    initialArray = None
+    if initialLayers and len(initialLayers) == 1 and updatePoints is not None:
+      initialArray = self.getGridLayerArray(initialLayers[0], size, origin, spacing, direction)
+    if initialArray is None:
+      displacement, self.inversionResidual = self.invertTransformLayers(layers, size, origin, spacing, direction, initialLayers)
+      self.logInversionResidual(self.inversionResidual)
+      return self.gridTransformFromArray(displacement, origin, spacing, gridDirection=directionMatrix)
+    if not len(updatePoints):
+      return initialTransformNode
+    # index box of the points, with the cubic interpolation margin
+    ijk = (updatePoints - origin).dot(np.linalg.inv(direction * spacing).T)
+    start = (np.floor(ijk.min(axis=0)) - 2).clip(0, size).astype(int)
+    stop = (np.ceil(ijk.max(axis=0)) + 3).clip(0, size).astype(int)
+    if np.any(stop <= start):
+      return initialTransformNode
+    boxOrigin = origin + direction.dot(start * spacing)
+    displacement, self.inversionResidual = self.invertTransformLayers(layers, stop - start, boxOrigin, spacing, direction, initialLayers)
+    initialArray[start[2]:stop[2], start[1]:stop[1], start[0]:stop[0]] = displacement
+    initialLayers[0].transform.GetDisplacementGrid().Modified()
+    initialLayers[0].transform.Modified()
+    logging.info('Inverse updated in %d of %d voxels' % (np.prod(stop - start), np.prod(size)))
+    self.logInversionResidual(self.inversionResidual)
+    return initialTransformNode
+
+  def logInversionResidual(self, residual):
+    message = 'Inverse consistency residual: max %.4f mm, mean %.4f mm, %d points not converged' % residual
+    if residual[0] > self.inversionWarningResidual:
+      logging.warning(message)
+    else:
+      logging.info(message)
+
+  def getInversionWarning(self):
+    # message for the user if the last inversion left a residual above inversionWarningResidual, else None
+    residual = self.inversionResidual
+    if residual is None or residual[0] <= self.inversionWarningResidual:
+      return None
+    return 'The inverse transform did not converge everywhere: %d points are off by up to %.2f mm. The forward transform may be folded.' % (residual[2], residual[0])
+
+
   def arrayFromGeneralTransform(self, transformNode, componentNumber):
     # https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/util.py
     transformGrid = transformNode.GetTransformFromParent().GetConcatenatedTransform(componentNumber)
@@ -448,6 +989,9 @@ class TransformsUtilTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_TransformsUtil1()
+    self.setUp()
+    self.test_ComposeTransformLayers()
+    self.test_SampleDisplacementGrid()
 
   def test_TransformsUtil1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -477,3 +1021,59 @@ class TransformsUtilTest(ScriptedLoadableModuleTest):
     logic = TransformsUtilLogic()
     self.assertIsNotNone( logic.hasImageData(volumeNode) )
     self.delayDisplay('Test passed!')
+
+  def test_ComposeTransformLayers(self):
+    """ Flatten a warp with a local edit on top with the numpy composition and with
+    ConvertToGridTransform, comparing results and timing.
+    """
+    import time
+    logic = TransformsUtilLogic()
+    size, origin, spacing = [193,229,193], [-96.0, -132.0, -78.0], [1.0, 1.0, 1.0]
+    # base layer with a smooth displacement everywhere
+    k, j, i = np.meshgrid(*[np.linspace(0, np.pi, n) for n in size[::-1]], indexing='ij')
+    base = np.stack([np.sin(i) * np.sin(j), np.sin(j) * np.sin(k), np.sin(k) * np.sin(i)], -1).astype(np.float32) * 3
+    warpNode = logic.gridTransformFromArray(base, origin, spacing)
+    # local edit, zero at the sides
+    edit = np.zeros((40,40,40,3), dtype=np.float32)
+    edit[1:-1,1:-1,1:-1,0] = 2
+    editNode = logic.gridTransformFromArray(edit, [-20.0, -20.0, -20.0], spacing)
+    warpNode.SetAndObserveTransformNodeID(editNode.GetID())
+    warpNode.HardenTransform()
+    slicer.mrmlScene.RemoveNode(editNode)
+
+    startTime = time.time()
+    referenceNode = logic.transformToGridTransform(warpNode, size, origin, spacing)
+    referenceTime = time.time() - startTime
+    reference = slicer.util.array(referenceNode.GetID())
+
+    startTime = time.time()
+    displacement = logic.composeTransformLayers(logic.getTransformLayers(warpNode.GetTransformFromParent()), size, origin, spacing)
+    composeTime = time.time() - startTime
+
+    deviation = np.abs(displacement - reference).max()
+    self.delayDisplay('ConvertToGridTransform: %.2fs, composeTransformLayers: %.2fs (x%.1f), max deviation %.2e mm' % (referenceTime, composeTime, referenceTime / composeTime, deviation))
+    self.assertLess(deviation, 1e-3)
+    self.delayDisplay('Test passed!')
+
+  def test_SampleDisplacementGrid(self):
+    """ Interpolate grids of analytic fields in numpy (no scene). Linear
+    interpolation is exact for a linear field, and cubic (also the quadratic
+    next to the edges) for a quadratic one. Points outside take the value at
+    the edge.
+    """
+    logic = TransformsUtilLogic()
+    size = np.array([14, 13, 12])
+    k, j, i = np.meshgrid(*[np.arange(n) for n in size[::-1]], indexing='ij')
+    linearField = lambda i, j, k: np.stack([0.5 * i - j + 2, 0.25 * k, i + j + k], -1)
+    quadraticField = lambda i, j, k: np.stack([0.3 * i * i + j, 0.1 * j * k + 2, 0.05 * k * k - i], -1)
+    points = np.random.RandomState(0).uniform(0, size - 1, (2000, 3))
+    points[:10] = np.rint(points[:10]) # on the nodes
+    for field, interpolationMode in [(linearField, vtk.VTK_LINEAR_INTERPOLATION), (quadraticField, vtk.VTK_CUBIC_INTERPOLATION)]:
+      array = field(i, j, k).astype(np.float32)
+      expected = field(points[:,0], points[:,1], points[:,2])
+      error = np.abs(logic.sampleDisplacementGrid(array, points, interpolationMode) - expected).max()
+      self.assertLess(error, 1e-4)
+      outside = points + np.where(points > size / 2, 5, -5)
+      error = np.abs(logic.sampleDisplacementGrid(array, outside, interpolationMode) - field(*np.clip(outside, 0, size - 1).T)).max()
+      self.assertLess(error, 1e-4)
+    self.delayDisplay('Test passed!')